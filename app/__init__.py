@@ -1,16 +1,16 @@
 from flask import Flask
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_bootstrap import Bootstrap
+from app.database import Database
 from logging.handlers import RotatingFileHandler
 
 import logging
 import os
 
 
-db = SQLAlchemy()
+db = Database()
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -22,7 +22,9 @@ def create_app(debug=False):
     app.config.from_object(Config)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    # The search tables aren't models, so autogenerate mustn't drop them.
+    from app.search import include_object
+    migrate.init_app(app, db, include_object=include_object)
     login.init_app(app)
     bootstrap = Bootstrap(app)
 
@@ -33,6 +35,21 @@ def create_app(debug=False):
     from app.api import api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    # Lets the feed templates use cached post fragments, see cache.py.
+    from app.cache import render_post
+    app.add_template_global(render_post)
+
+    from app.metrics import init_metrics
+    init_metrics(app)
+
+    if app.config['RANKING_WORKER'] == 'thread':
+        from app.ranking import start_ranking_worker
+        app.before_first_request(start_ranking_worker)
+
+    if app.config['VOTE_DURABILITY'] == 'buffered':
+        from app.votebuffer import start_vote_flusher, flush_on_sigterm
+        app.before_first_request(start_vote_flusher)
+        flush_on_sigterm(app)
 
     if not app.debug and not app.testing:
         if app.config['LOG_TO_STDOUT']:
@@ -59,4 +76,4 @@ def create_app(debug=False):
 
 app = create_app()
 
-from app import routes, models, errors
+from app import routes, models, errors, cli
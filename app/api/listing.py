@@ -0,0 +1,125 @@
+"""
+Code shared by the api's list endpoints.
+
+Lists only SELECT the columns asked for with ``fields=`` (plus whatever
+they are sorted by), so no model objects are loaded. They are paged with
+the same keyset cursors as the site's feeds, see pagination.py. Exports
+stream every row as a JSON array, fetching them in batches so neither the
+server nor the client holds a whole table at once.
+"""
+import datetime
+import json
+
+from flask import Response, current_app, stream_with_context
+from flask_restplus import reqparse
+from app import db
+from app.api import api
+from app.pagination import keyset_paginate
+
+
+# How many rows each batch of an export fetches.
+EXPORT_BATCH = 1000
+
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('fields', help="Comma separated columns to return, "
+        "all of them by default.")
+list_parser.add_argument('after', help="Cursor of the page to start after.")
+list_parser.add_argument('before', help="Cursor of the page to end before.")
+list_parser.add_argument('limit', type=int, help="How many rows per page.")
+
+export_parser = reqparse.RequestParser()
+export_parser.add_argument('fields', help="Comma separated columns to "
+        "return, all of them by default.")
+
+
+class Listing(object):
+    """How the api lists one of the tables.
+
+    Parameters
+    ----------
+    model : db.Model
+        The model whose table is listed.
+    fields : tuple
+        The columns clients can ask for.
+    sort : tuple
+        The columns pages are sorted by, the last of which is unique.
+    descending : bool
+        Whether pages are sorted in descending order."""
+
+    def __init__(self, model, fields, sort=None, descending=False):
+        self.model = model
+        self.fields = fields
+        self.sort = sort or (model.id,)
+        self.descending = descending
+
+    def field_names(self, requested):
+        """Parses a ``fields=`` parameter, aborting on unknown columns."""
+        if not requested:
+            return list(self.fields)
+
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown or not names:
+            api.abort(400, "Unknown fields: {}. Pick from {}.".format(
+                    ', '.join(unknown), ', '.join(self.fields)))
+        return names
+
+    def query(self, names, sort=None):
+        """Query for just the named columns and the sort columns."""
+        sort = sort or self.sort
+        columns = [getattr(self.model, name) for name in names]
+        columns += [column for column in sort if column.key not in names]
+        return db.session.query(*columns)
+
+    def page(self, args, filters=(), sort=None):
+        """Returns one page, as a dict, of the rows matching ``filters``."""
+        sort = sort or self.sort
+        names = self.field_names(args['fields'])
+        per_page = args['limit'] or current_app.config['POSTS_PER_PAGE']
+        per_page = max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+
+        query = self.query(names, sort).filter(*filters)
+        page = keyset_paginate(query, sort, after=args['after'],
+                before=args['before'], per_page=per_page,
+                descending=self.descending)
+        return {'items': [row_dict(row, names) for row in page.items],
+                'next': page.next_cursor, 'prev': page.prev_cursor}
+
+    def get(self, row_id, args):
+        """Returns a single row as a dict, or aborts with a 404."""
+        names = self.field_names(args['fields'])
+        row = self.query(names).filter(self.model.id == row_id).first()
+        if row == None:
+            api.abort(404, "No {} with id {}.".format(
+                    self.model.__tablename__, row_id))
+        return row_dict(row, names)
+
+    def export(self, args, filters=()):
+        """Streams every row matching ``filters`` as a JSON array."""
+        names = self.field_names(args['fields'])
+        query = self.query(names).filter(*filters).order_by(self.model.id)
+        return stream_json(query, names)
+
+
+def json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def row_dict(row, names):
+    return dict((name, json_value(getattr(row, name))) for name in names)
+
+
+def stream_json(query, names):
+    """Streams the rows of a query as a JSON array, a batch at a time."""
+    def generate():
+        yield '['
+        separator = ''
+        for row in query.yield_per(EXPORT_BATCH):
+            yield separator + json.dumps(row_dict(row, names))
+            separator = ','
+        yield ']'
+
+    return Response(stream_with_context(generate()),
+            mimetype='application/json')
@@ -1,35 +1,91 @@
-from flask import Flask
-from app.models import User, Post, Topic, Comment
-from flask_restplus import Resource, fields, ModelSchema, Namespace
-
-
-# Move this to app\api\models.py and make an app\api\routes.py
-user_model = api.model("user", {
-    "id": fields.Integer(readOnly=True, "The user's id."),
-    "username": fields.String(readOnly=True, description="The user's displayed name."),
-    "email": fields.String(readOnly=True, description="User's email."),
-    "posts": fields.List(description="Posts made by the user."),
-    "upvoted_on": fields.List(description="Name of the user."),
-    "downvoted-on": fields.List(description="Name of the user."),
+"""
+What the api returns for each table: the columns clients can ask for with
+``fields=`` and the restplus models documenting them.
+
+Only public columns are listed, so e-mails and password hashes never leave
+the database through the api.
+"""
+from flask_restplus import fields
+from app.api import api
+from app.votes import UPVOTE, DOWNVOTE
+
+
+POST_FIELDS = ('id', 'title', 'link', 'text', 'is_link', 'timestamp',
+        'user_id', 'event_id', 'upvotes', 'downvotes', 'score', 'importance',
+        'hotness', 'comment_count')
+TOPIC_FIELDS = ('id', 'tag_name')
+EVENT_FIELDS = ('id', 'event_name')
+USER_FIELDS = ('id', 'username', 'scores')
+COMMENT_FIELDS = ('id', 'post_id', 'user_id', 'username', 'text', 'timestamp')
+
+
+post_model = api.model('post', {
+    'id': fields.Integer(readOnly=True, description="The post's id."),
+    'title': fields.String(description="The post's title."),
+    'link': fields.String(description="The url the post links to, if any."),
+    'text': fields.String(description="The post's text."),
+    'is_link': fields.Boolean(description="Whether the post is a link."),
+    'timestamp': fields.DateTime(description="When the post was made."),
+    'user_id': fields.Integer(description="Id of the user who made it."),
+    'event_id': fields.Integer(description="Id of the post's event."),
+    'upvotes': fields.Integer(),
+    'downvotes': fields.Integer(),
+    'score': fields.Integer(description="Upvotes minus downvotes."),
+    'importance': fields.Integer(),
+    'hotness': fields.Float(description="What the hot feed is sorted by."),
+    'comment_count': fields.Integer(description="How many comments it has."),
     })
 
-class UserSchema(ModelSchema):
-    class Meta:
-        model = User
+topic_model = api.model('topic', {
+    'id': fields.Integer(readOnly=True, description="The topic's id."),
+    'tag_name': fields.String(description="The topic's name."),
+    })
 
-users_api = Namespace('users')
-api.add_namespace(users_api)
+event_model = api.model('event', {
+    'id': fields.Integer(readOnly=True, description="The event's id."),
+    'event_name': fields.String(description="The event's name."),
+    })
 
-@users_api.route('/')
-class UsersList(Resource):
+user_model = api.model('user', {
+    'id': fields.Integer(readOnly=True, description="The user's id."),
+    'username': fields.String(description="The user's displayed name."),
+    'scores': fields.Integer(description="The user's karma."),
+    })
+
+comment_model = api.model('comment', {
+    'id': fields.Integer(readOnly=True, description="The comment's id."),
+    'post_id': fields.Integer(description="Id of the post commented on."),
+    'user_id': fields.Integer(description="Id of the user who made it."),
+    'username': fields.String(description="Name of the user who made it."),
+    'text': fields.String(description="The comment itself."),
+    'timestamp': fields.DateTime(description="When the comment was made."),
+    })
+
+
+vote_model = api.model('vote', {
+    'direction': fields.String(required=True, enum=[UPVOTE, DOWNVOTE]),
+    })
+
+vote_state_model = api.model('vote_state', {
+    'id': fields.Integer(readOnly=True, description="The post's id."),
+    'upvotes': fields.Integer(readOnly=True),
+    'downvotes': fields.Integer(readOnly=True),
+    'score': fields.Integer(readOnly=True),
+    'importance': fields.Integer(readOnly=True),
+    'upvoted': fields.Boolean(readOnly=True,
+        description="Whether the user has upvoted the post."),
+    'downvoted': fields.Boolean(readOnly=True,
+        description="Whether the user has downvoted the post."),
+    'given_importance': fields.Boolean(readOnly=True,
+        description="Whether the user has given the post importance."),
+    })
 
-    @users_api.response(UserSchema(many=True))
-    def get(self):
-        return User.query.all()
 
-@users_api.route('/<int:user_id>')
-@users_api.resolve_object('user', lambda kwargs: User.query.get_or_404(kwargs.pop('user.id')))
-class UserById(Resource): 
-    @users_api.response(UserSchema())
-    def get(self, user):
-        return user
+def page_model(model):
+    """Documents a page of ``model`` as returned by the list endpoints."""
+    return api.model(model.name + '_page', {
+        'items': fields.List(fields.Nested(model)),
+        'next': fields.String(description="Pass as after= for the next page."),
+        'prev': fields.String(description="Pass as before= for the previous "
+            "page."),
+        })
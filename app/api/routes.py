@@ -0,0 +1,207 @@
+from flask import request
+from flask_login import current_user
+from flask_restplus import Resource, Namespace
+from app.api import api
+from app.api.listing import Listing, list_parser, export_parser
+from app.api.models import POST_FIELDS, TOPIC_FIELDS, EVENT_FIELDS, \
+        USER_FIELDS, COMMENT_FIELDS, post_model, topic_model, event_model, \
+        user_model, comment_model, page_model, vote_model, vote_state_model
+from app.cache import post_changed
+from app.helpers import check_if_upvoted, check_if_downvoted, \
+        check_if_given_importance
+from app.models import User, Post, Topic, Event, Comment, topics_table, \
+        POST_SORTS
+from app.votebuffer import submit_vote, pending_deltas
+from app.votes import spend_importance, UPVOTE, DOWNVOTE
+
+
+posts_api = Namespace('posts', description="Posts, and voting on them.")
+topics_api = Namespace('topics', description="Topics posts are tagged with.")
+events_api = Namespace('events', description="Events posts are about.")
+users_api = Namespace('users', description="Users' public profiles.")
+comments_api = Namespace('comments', description="Comments on posts.")
+for namespace in [posts_api, topics_api, events_api, users_api, comments_api]:
+    api.add_namespace(namespace)
+
+post_listing = Listing(Post, POST_FIELDS, POST_SORTS['hot'], descending=True)
+topic_listing = Listing(Topic, TOPIC_FIELDS)
+event_listing = Listing(Event, EVENT_FIELDS)
+user_listing = Listing(User, USER_FIELDS)
+comment_listing = Listing(Comment, COMMENT_FIELDS)
+
+post_parser = list_parser.copy()
+post_parser.add_argument('sort', choices=list(POST_SORTS), default='hot',
+        help="hot or new.")
+post_filters = export_parser.copy()
+for parser in [post_parser, post_filters]:
+    parser.add_argument('topic', help="Only posts with this topic.")
+    parser.add_argument('event', help="Only posts about this event.")
+    parser.add_argument('user', help="Only posts made by this user.")
+
+comment_parser = list_parser.copy()
+comment_filters = export_parser.copy()
+for parser in [comment_parser, comment_filters]:
+    parser.add_argument('post', type=int, help="Only comments on this post.")
+
+
+def post_filter_clauses(args):
+    """Turns the topic, event and user arguments into filters on posts."""
+    filters = []
+    if args['topic']:
+        filters.append(Post.id.in_(topic_post_ids(args['topic'])))
+    if args['event']:
+        filters.append(Post.event_id.in_(
+                Event.query.with_entities(Event.id).filter_by(
+                event_name=args['event']).subquery()))
+    if args['user']:
+        filters.append(Post.user_id.in_(
+                User.query.with_entities(User.id).filter_by(
+                username=args['user']).subquery()))
+    return filters
+
+
+def topic_post_ids(tag_name):
+    """Subquery for the ids of the posts with a topic."""
+    return Topic.query.join(topics_table).with_entities(
+            topics_table.c.post_id).filter(Topic.tag_name == tag_name).subquery()
+
+
+def comment_filter_clauses(args):
+    return [Comment.post_id == args['post']] if args['post'] != None else []
+
+
+@posts_api.route('/')
+class PostList(Resource):
+
+    @posts_api.expect(post_parser)
+    @posts_api.response(200, 'Success', page_model(post_model))
+    def get(self):
+        """Lists posts, hottest or newest first, a page at a time."""
+        args = post_parser.parse_args()
+        return post_listing.page(args, post_filter_clauses(args),
+                POST_SORTS[args['sort']])
+
+
+@posts_api.route('/export')
+class PostExport(Resource):
+
+    @posts_api.expect(post_filters)
+    @posts_api.response(200, 'Success', [post_model])
+    def get(self):
+        """Streams every post as one JSON array."""
+        args = post_filters.parse_args()
+        return post_listing.export(args, post_filter_clauses(args))
+
+
+@posts_api.route('/<int:post_id>')
+class PostById(Resource):
+
+    @posts_api.expect(export_parser)
+    @posts_api.response(200, 'Success', post_model)
+    def get(self, post_id):
+        """Returns a single post."""
+        return post_listing.get(post_id, export_parser.parse_args())
+
+
+def add_list_routes(namespace, listing, model, parser=list_parser,
+        filters=export_parser, filter_clauses=lambda args: []):
+    """Adds the list, export and by-id routes for a table to a namespace."""
+    name = listing.model.__name__
+
+    @namespace.route('/')
+    class List(Resource):
+
+        @namespace.expect(parser)
+        @namespace.response(200, 'Success', page_model(model))
+        def get(self):
+            args = parser.parse_args()
+            return listing.page(args, filter_clauses(args))
+
+    @namespace.route('/export')
+    class Export(Resource):
+
+        @namespace.expect(filters)
+        @namespace.response(200, 'Success', [model])
+        def get(self):
+            args = filters.parse_args()
+            return listing.export(args, filter_clauses(args))
+
+    @namespace.route('/<int:row_id>')
+    class ById(Resource):
+
+        @namespace.expect(export_parser)
+        @namespace.response(200, 'Success', model)
+        def get(self, row_id):
+            return listing.get(row_id, export_parser.parse_args())
+
+    List.get.__doc__ = "Lists {}s by id, a page at a time.".format(name.lower())
+    Export.get.__doc__ = "Streams every {} as one JSON array.".format(
+            name.lower())
+    ById.get.__doc__ = "Returns a single {}.".format(name.lower())
+
+
+add_list_routes(topics_api, topic_listing, topic_model)
+add_list_routes(events_api, event_listing, event_model)
+add_list_routes(users_api, user_listing, user_model)
+add_list_routes(comments_api, comment_listing, comment_model, comment_parser,
+        comment_filters, comment_filter_clauses)
+
+
+def get_post_for_user(post_id):
+    """Returns the post being voted on, aborting unless a user is logged in
+       and the post exists.
+
+       Only JSON bodies are accepted, which browsers won't send to another
+       site without asking it first, so the session can't be used to vote
+       from elsewhere."""
+    if not current_user.is_authenticated:
+        posts_api.abort(401, "Log in to vote.")
+    if not request.is_json:
+        posts_api.abort(415, "Send the request as JSON.")
+
+    post = Post.query.get(post_id)
+    if post == None:
+        posts_api.abort(404, "No post with id {}.".format(post_id))
+    return post
+
+
+def vote_state(post, upvoted, downvoted, given_importance):
+    """The post's counts, including votes still in the vote buffer."""
+    upvotes_delta, downvotes_delta = pending_deltas(post)
+    upvotes = (post.upvotes or 0) + upvotes_delta
+    downvotes = (post.downvotes or 0) + downvotes_delta
+    return {'id': post.id, 'upvotes': upvotes, 'downvotes': downvotes,
+            'score': upvotes - downvotes, 'importance': post.importance, 'upvoted': upvoted,
+            'downvoted': downvoted, 'given_importance': given_importance}
+
+
+@posts_api.route('/<int:post_id>/vote')
+class PostVote(Resource):
+
+    @posts_api.expect(vote_model, validate=True)
+    @posts_api.marshal_with(vote_state_model)
+    def post(self, post_id):
+        """Votes a post up or down, taking back an opposite vote."""
+        post = get_post_for_user(post_id)
+        direction = request.get_json()['direction']
+        submit_vote(current_user, post, direction)
+
+        # Voting is idempotent, so the user's votes are known without asking.
+        return vote_state(post, direction == UPVOTE, direction == DOWNVOTE,
+                check_if_given_importance(post, current_user))
+
+
+@posts_api.route('/<int:post_id>/importance')
+class PostImportance(Resource):
+
+    @posts_api.marshal_with(vote_state_model)
+    def post(self, post_id):
+        """Gives a post importance, at the cost of some of the user's
+           points. Can only be done once per post."""
+        post = get_post_for_user(post_id)
+        if spend_importance(current_user, post):
+            post_changed(post.id, post.hotness)
+
+        return vote_state(post, check_if_upvoted(post, current_user),
+                check_if_downvoted(post, current_user),
+                check_if_given_importance(post, current_user))
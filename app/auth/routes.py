@@ -1,7 +1,7 @@
 from flask import render_template, flash, redirect, url_for, request
 from flask_login import logout_user, current_user, login_user, login_required
 from werkzeug.urls import url_parse
-from ..models import User, Post, Comment, find_users_post
+from ..models import User, Post, Comment
 from .. import db
 from . import bp
 from .forms import LoginForm, RegistrationForm
@@ -0,0 +1,238 @@
+"""
+Caches of rendered HTML, held by each process.
+
+The fragment cache keeps rendered posts (_post.html and _post_center.html),
+so a feed only has to stitch together HTML it has already rendered rather
+than running the post templates again for every post on every page.
+
+A fragment is keyed by everything it shows which can change: the post's
+version (bumped whenever its score, importance or existence changes), its
+score counting votes still in the vote buffer, the viewer's votes on it,
+whether the viewer wrote it and how old it looks.
+Stale fragments are never looked up again and just fall off the end of the
+LRU, which is capped by the size of the HTML it holds.
+
+The page cache keeps whole pages as seen by logged out visitors, for
+PAGE_CACHE_TTL seconds or, for pages which never change, for good. Each
+cached page has an ETag and Last-Modified date so browsers can revalidate
+it and get a 304. Anything which changes what the feeds show calls
+invalidate_pages().
+"""
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, render_template
+from flask_login import current_user
+from jinja2 import Markup
+from app.helpers import check_if_upvoted, check_if_downvoted, \
+        displayed_score
+from app.hotfeed import get_hot_feed, get_topic_feeds
+
+
+class FragmentCache(object):
+    """LRU cache of rendered HTML, which evicts the least recently used
+       fragments once they add up to more than max_size characters.
+
+    Parameters
+    ----------
+    max_size : int
+        How many characters of HTML to hold at most.
+    size : int
+        How many characters of HTML are held now.
+    hits, misses : int
+        Counts of lookups, to see how well the cache is doing."""
+
+    def __init__(self, max_size):
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            html = self.fragments.get(key)
+            if html == None:
+                self.misses += 1
+                return None
+
+            self.fragments.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key, html):
+        if len(html) > self.max_size:
+            return
+
+        with self.lock:
+            old = self.fragments.pop(key, None)
+            if old != None:
+                self.size -= len(old)
+
+            self.fragments[key] = html
+            self.size += len(html)
+            while self.size > self.max_size:
+                evicted_key, evicted = self.fragments.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard_post(self, post_id):
+        """Drops every fragment of a post, e.g. once it's deleted."""
+        with self.lock:
+            for key in [key for key in self.fragments if key[1] == post_id]:
+                self.size -= len(self.fragments.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.fragments)
+
+
+def get_fragment_cache():
+    """Returns the fragment cache of the current app, making it the first
+       time it's asked for."""
+    extensions = current_app.extensions
+    if 'nuncio_fragments' not in extensions:
+        extensions['nuncio_fragments'] = FragmentCache(
+                current_app.config['FRAGMENT_CACHE_SIZE'])
+
+    return extensions['nuncio_fragments']
+
+
+def fragment_key(template, post, user=current_user):
+    """The cache key of a post's fragment as seen by a user."""
+    upvoted = downvoted = owner = False
+    if user.is_authenticated:
+        upvoted = check_if_upvoted(post, user)
+        downvoted = check_if_downvoted(post, user)
+        owner = post.user_id == user.id
+
+    return (template, post.id, post.version or 0, upvoted, downvoted, owner,
+            displayed_score(post), post.age, post.time_type)
+
+
+def render_post(template, post):
+    """Renders a post with one of the post templates, from the cache when
+       the same fragment has been rendered before. Used by the feed
+       templates in place of including the post template."""
+    cache = get_fragment_cache()
+    key = fragment_key(template, post)
+    html = cache.get(key)
+    if html == None:
+        html = render_template(template, post=post,
+                check_if_upvoted=check_if_upvoted,
+                check_if_downvoted=check_if_downvoted,
+                displayed_score=displayed_score)
+        cache.set(key, html)
+
+    return Markup(html)
+
+
+class CachedPage(object):
+    """A page held by the PageCache.
+
+    Parameters
+    ----------
+    body : bytes
+        The rendered page.
+    mimetype : str
+        The page's mimetype, normally text/html.
+    etag : str
+        Hash of the body.
+    last_modified : datetime.datetime
+        When the page was rendered, to the second as HTTP dates are.
+    expires : float
+        time.time() after which the page is stale, None if it never is."""
+
+    def __init__(self, body, mimetype, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+        self.expires = expires
+
+
+class PageCache(object):
+    """LRU cache of whole pages by url, holding at most max_pages of them.
+
+    Parameters
+    ----------
+    max_pages : int
+        How many pages to hold at most.
+    pages : OrderedDict
+        CachedPage objects by url, least recently used first."""
+
+    def __init__(self, max_pages):
+        self.lock = threading.Lock()
+        self.pages = OrderedDict()
+        self.max_pages = max_pages
+
+    def get(self, url):
+        with self.lock:
+            page = self.pages.get(url)
+            if page == None:
+                return None
+
+            if page.expires != None and page.expires <= time.time():
+                del self.pages[url]
+                return None
+
+            self.pages.move_to_end(url)
+            return page
+
+    def set(self, url, body, mimetype, ttl=None):
+        """Caches a page for ttl seconds, or for good if ttl is None."""
+        page = CachedPage(body, mimetype,
+                None if ttl == None else time.time() + ttl)
+        with self.lock:
+            self.pages.pop(url, None)
+            self.pages[url] = page
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+        return page
+
+    def invalidate(self):
+        """Drops every page which can go stale, keeping the permanent ones."""
+        with self.lock:
+            for url in [url for url, page in self.pages.items()
+                        if page.expires != None]:
+                del self.pages[url]
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+    def __len__(self):
+        return len(self.pages)
+
+
+def get_page_cache():
+    """Returns the page cache of the current app, making it the first time
+       it's asked for."""
+    extensions = current_app.extensions
+    if 'nuncio_pages' not in extensions:
+        extensions['nuncio_pages'] = PageCache(
+                current_app.config['PAGE_CACHE_PAGES'])
+
+    return extensions['nuncio_pages']
+
+
+def invalidate_pages():
+    """Drops the cached pages of feeds and posts, after anything they show
+       has changed."""
+    get_page_cache().invalidate()
+
+
+def post_changed(post_id, hotness, topic_ids=()):
+    """Moves a post in the hot feeds and drops the cached pages, after its
+       counts or hotness have changed. New posts pass their ``topic_ids``."""
+    get_hot_feed().update(post_id, hotness)
+    get_topic_feeds().update(post_id, hotness, topic_ids)
+    invalidate_pages()
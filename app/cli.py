@@ -0,0 +1,149 @@
+"""
+Commands which can be run with ``flask <command>``.
+"""
+import os
+import time
+
+import click
+from app import app, db
+from app.ranking import recompute_hotness
+from app.karma import roll_up_scores, rebuild_scores, seed_ledger
+from app.events import rebuild_event_stats
+from app.seed import seed
+from app.importer import import_posts
+from app.models import Post, Comment
+from app.search import get_search_index
+
+
+@app.cli.command('rank-posts')
+@click.option('--loop', is_flag=True,
+        help='Keep recomputing every RANKING_INTERVAL seconds.')
+def rank_posts(loop):
+    """Recomputes the hotness of every post and rolls up the score ledger.
+
+       Run with --loop as a separate process instead of the ranking thread,
+       by setting RANKING_WORKER to anything other than 'thread'."""
+    while True:
+        count = recompute_hotness()
+        click.echo('Ranked {} posts.'.format(count))
+        roll_up_scores()
+        db.session.remove()
+        if not loop:
+            break
+
+        time.sleep(app.config['RANKING_INTERVAL'])
+
+
+@app.cli.command('backfill-hotness')
+def backfill_hotness():
+    """Moves existing databases over to the float hotness column used by the
+       log-space formula, then recomputes every post's hotness with it.
+
+       sqlite doesn't enforce column types so only the backfill is needed
+       there, postgres gets its hotness column altered first."""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ALTER TABLE post ALTER COLUMN hotness '
+                'TYPE DOUBLE PRECISION')
+        db.session.commit()
+
+    count = recompute_hotness()
+    click.echo('Backfilled the hotness of {} posts using the {} formula.'
+            .format(count, app.config['HOTNESS_FORMULA']))
+
+
+@app.cli.command('rebuild-karma')
+@click.option('--seed', is_flag=True,
+        help='First replace the ledger with one event per user, worked out '
+             'from their posts. Needed once for databases made before it.')
+def rebuild_karma(seed):
+    """Recomputes every user's score from the score_event ledger."""
+    if seed:
+        click.echo('Seeded the ledger for {} users.'.format(seed_ledger()))
+
+    click.echo('Rebuilt the scores of {} users.'.format(rebuild_scores()))
+
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Rebuilds the full-text search index from every post."""
+    get_search_index().rebuild()
+    click.echo('Rebuilt the search index.')
+
+
+@app.cli.command('count-comments')
+def count_comments():
+    """Recounts every post's comments into Post.comment_count. Only needed
+       once for databases made before the column was, or to repair it."""
+    comment_table = Comment.__table__
+    post_table = Post.__table__
+    count = db.select([db.func.count(comment_table.c.id)]).where(
+            comment_table.c.post_id == post_table.c.id).as_scalar()
+    posts = db.session.execute(post_table.update().values(
+            comment_count=count)).rowcount
+    db.session.commit()
+    click.echo('Counted the comments of {} posts.'.format(posts))
+
+
+@app.cli.command('rebuild-event-stats')
+def rebuild_event_stats_command():
+    """Recomputes every event's stats from its posts. Only needed once for
+       databases made before the event_stats table was, or to repair it."""
+    click.echo('Rebuilt the stats of {} events.'.format(rebuild_event_stats()))
+
+
+@app.cli.command('seed')
+@click.option('--users', default=100, help='How many users to add.')
+@click.option('--posts', default=1000, help='How many posts to add.')
+@click.option('--topics', default=20, help='How many topics to add.')
+@click.option('--events', default=10, help='How many events to add.')
+@click.option('--votes', default=10000, help='How many votes to cast.')
+@click.option('--comments', default=2000, help='How many comments to add.')
+@click.option('--random-seed', type=int,
+        help='Makes the same data every time it is given.')
+def seed_command(users, posts, topics, events, votes, comments, random_seed):
+    """Fills the database with made up data, see app/seed.py. Every user
+       made can log in with the password 'password'."""
+    counts = seed(users=users, posts=posts, topics=topics, events=events,
+            votes=votes, comments=comments, random_seed=random_seed)
+    click.echo('Added {users} users, {topics} topics, {events} events, '
+            '{posts} posts, {votes} votes and {comments} comments.'
+            .format(**counts))
+
+
+@app.cli.command('import-posts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['jsonl', 'csv']),
+        help='Defaults to csv for .csv files and jsonl otherwise.')
+@click.option('--batch-size', default=1000,
+        help='How many rows to insert and commit at a time.')
+@click.option('--checkpoint',
+        help='Where to save progress, defaults to PATH.checkpoint.')
+@click.option('--restart', is_flag=True,
+        help='Ignore the checkpoint and import the whole file again.')
+def import_posts_command(path, file_format, batch_size, checkpoint, restart):
+    """Bulk imports posts from a JSONL or CSV file, see app/importer.py.
+
+       Run it again after an interruption to carry on from the last batch
+       committed. Rows added to the end of the file since are imported too."""
+    if checkpoint == None:
+        checkpoint = path + '.checkpoint'
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    started = time.time()
+
+    def progress(counts):
+        elapsed = time.time() - started
+        click.echo('Read {} rows, imported {} posts ({:.0f} posts/s).'.format(
+                counts['rows'], counts['posts'],
+                counts['posts'] / elapsed if elapsed else 0), err=True)
+
+    def skipped(number, reason):
+        click.echo('Skipped row {}: {}.'.format(number, reason), err=True)
+
+    counts = import_posts(path, file_format, batch_size, checkpoint,
+            progress, skipped)
+    if counts['resumed_at']:
+        click.echo('Resumed after row {}.'.format(counts['resumed_at']))
+    click.echo('Imported {} posts in {:.1f}s, skipped {} rows.'.format(
+            counts['posts'], time.time() - started, counts['skipped']))
@@ -0,0 +1,168 @@
+"""
+How the app connects to its database.
+
+SQLite connections are pooled rather than opened for every request, and
+each one is set up with the SQLITE_* pragmas as it's opened: WAL so readers
+don't wait on writers, synchronous=NORMAL which is safe with WAL, a busy
+timeout instead of failing straight away when the database is locked, and
+a bigger page cache and mmap. Server databases like postgres get the pool
+sizes set by the SQLALCHEMY_POOL_* options.
+
+When a 'replica' bind is configured, with DATABASE_READ_URL, the SELECTs
+of GET and HEAD requests read from it and everything else goes to the
+primary database. Any other statement, flush included, is a write, even
+during a GET. Once a session has written, the rest of its transaction
+stays on the primary so it reads what it wrote. A replica can lag behind,
+so the page shown after a vote may not have it.
+"""
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import SelectBase, TextClause
+
+
+# The bind GET requests read from, see SQLALCHEMY_BINDS in config.py.
+READ_BIND = 'replica'
+
+
+def sqlite_pragmas(config):
+    """The PRAGMA statements run on every new SQLite connection, skipping
+       any setting left empty."""
+    settings = [('journal_mode', config['SQLITE_JOURNAL_MODE']),
+                ('synchronous', config['SQLITE_SYNCHRONOUS']),
+                ('busy_timeout', config['SQLITE_BUSY_TIMEOUT']),
+                ('mmap_size', config['SQLITE_MMAP_SIZE']),
+                ('cache_size', config['SQLITE_CACHE_SIZE'])]
+    return ['PRAGMA {} = {}'.format(name, value) for name, value in settings
+            if value not in (None, '')]
+
+
+def set_pragmas(pragmas):
+    """Makes a connect listener running ``pragmas`` on each connection."""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    return on_connect
+
+
+def reading_request():
+    """Whether the current request only reads, and so can use the replica."""
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def is_read(clause):
+    """Whether a statement only reads: a SELECT, or SQL text starting with
+       one."""
+    if isinstance(clause, SelectBase):
+        return True
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == 'SELECT'
+
+    return False
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the SELECTs of GET requests to the replica, if there
+       is one. Writes, and everything after them until the transaction
+       ends, go to the primary database."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.writing = False
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not is_read(clause):
+            self.writing = True
+
+        binds = self.app.config['SQLALCHEMY_BINDS'] or {}
+        if READ_BIND in binds and not self.writing and reading_request():
+            return self.db.get_engine(self.app, bind=READ_BIND)
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def commit(self):
+        try:
+            super(RoutingSession, self).commit()
+        finally:
+            self.writing = False
+
+    def rollback(self):
+        try:
+            super(RoutingSession, self).rollback()
+        finally:
+            self.writing = False
+
+    def close(self):
+        try:
+            super(RoutingSession, self).close()
+        finally:
+            self.writing = False
+
+
+class Database(SQLAlchemy):
+    """SQLAlchemy tuned for serving from several threads, see the top of
+       this module."""
+
+    def __init__(self, *args, **kwargs):
+        super(Database, self).__init__(*args, **kwargs)
+        self.tuned_engines = set()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        """Pools SQLite file connections, which Flask-SQLAlchemy would
+           otherwise open afresh for every request."""
+        sqlite_file = info.drivername == 'sqlite' and \
+                info.database not in (None, '', ':memory:')
+        if sqlite_file:
+            pool_size = options.pop('pool_size', None)
+            pool_timeout = options.pop('pool_timeout', None)
+            max_overflow = options.pop('max_overflow', None)
+
+        super(Database, self).apply_driver_hacks(app, info, options)
+
+        if sqlite_file:
+            options['poolclass'] = QueuePool
+            options['pool_size'] = pool_size or app.config['SQLITE_POOL_SIZE']
+            options['max_overflow'] = max_overflow or 0
+            if pool_timeout != None:
+                options['pool_timeout'] = pool_timeout
+            options.setdefault('connect_args', {})
+            # Connections move between waitress' threads through the pool.
+            options['connect_args']['check_same_thread'] = False
+
+    def get_engine(self, app=None, bind=None):
+        """Returns an engine as Flask-SQLAlchemy does, setting the pragmas
+           up the first time a SQLite engine is returned."""
+        app = self.get_app(app)
+        engine = super(Database, self).get_engine(app, bind)
+        if engine not in self.tuned_engines:
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect',
+                        set_pragmas(sqlite_pragmas(app.config)))
+            self.tuned_engines.add(engine)
+
+        return engine
+
+
+def sync_id_sequence(session, table):
+    """Moves postgres' id sequence for ``table`` on past its largest id,
+       which bulk inserts giving ids of their own leave behind, so later
+       inserts don't reuse one. Other databases carry on from the largest
+       id by themselves."""
+    bind = session.get_bind(clause=table.insert())
+    if bind.dialect.name != 'postgresql':
+        return
+
+    name = bind.dialect.identifier_preparer.format_table(table)
+    session.execute("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            "MAX(id)) FROM " + name + " HAVING MAX(id) IS NOT NULL",
+            {'table': name})
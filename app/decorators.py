@@ -1,17 +1,61 @@
-from flask import request, url_for
+from flask import request, url_for, session, current_app, make_response
 from flask_login import current_user, AnonymousUserMixin
 from functools import wraps
 from app.models import User, Post, Topic
+from app.karma import roll_up_scores
+from app.cache import get_page_cache
 from app import db
 
 
 def update_user(func):
-    """Function used to update a user every time the user visits a new
-       page."""
+    """Function used to update a user every time the user posts to a
+       page. Only rolls up the user's own pending score events, so it costs
+       nothing when their score hasn't changed. GET requests are left
+       alone so they never write, the worker rolls everyone up anyway."""
     @wraps(func)
     def update_user_decorator(*args, **kwargs):
-        current_user.scores = current_user.sum_post_scores()
-        db.session.commit()
+        if request.method == 'POST':
+            roll_up_scores(current_user.id)
         return func(*args, **kwargs)
 
     return update_user_decorator
+
+
+def cached_page(permanent=False):
+    """Decorator which serves GET requests from logged out visitors out of
+       the page cache (see cache.py), for PAGE_CACHE_TTL seconds or for
+       good if permanent. Responses carry an ETag and Last-Modified date
+       and become a 304 when the visitor already has the page.
+
+       Logged in users, pages with flashed messages and anything but a 200
+       are never cached."""
+    def decorator(func):
+        @wraps(func)
+        def cached_page_decorator(*args, **kwargs):
+            ttl = None if permanent else current_app.config['PAGE_CACHE_TTL']
+            if request.method != 'GET' or current_user.is_authenticated or \
+                    '_flashes' in session or ttl == 0:
+                return func(*args, **kwargs)
+
+            cache = get_page_cache()
+            page = cache.get(request.full_path)
+            if page == None:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+                page = cache.set(request.full_path, response.get_data(),
+                        response.mimetype, ttl)
+
+            response = current_app.response_class(page.body,
+                    mimetype=page.mimetype)
+            response.set_etag(page.etag)
+            response.last_modified = page.last_modified
+            # Always revalidate, so logging in shows up straight away.
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response.make_conditional(request)
+
+        return cached_page_decorator
+
+    return decorator
@@ -0,0 +1,162 @@
+"""
+Code used to keep each event's EventStats up to date.
+
+Making, voting on or deleting a post moves its event's totals with SQL-side
+arithmetic in the same transaction, like votes.py does for posts, so events
+are ranked without reading any of their posts.
+
+Votes are counted in windows of VELOCITY_WINDOW, lined up on the clock
+(every hour on the hour by default). Each event keeps the votes of the
+current window and of the one before it. Votes over the last
+VELOCITY_WINDOW are estimated from both, counting the previous window's
+votes in proportion to how much of it is still within that span. The
+ranking therefore slides smoothly, rather than dropping to nothing when
+a window ends. If the totals ever drift they can be rebuilt with
+`flask rebuild-event-stats`. That can't tell how recent old votes were,
+so it starts every window empty.
+"""
+import datetime
+
+from sqlalchemy import case
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import contains_eager
+from app import db
+from app.models import Event, EventStats, Post
+
+
+VELOCITY_WINDOW = datetime.timedelta(hours=1)
+# Windows are lined up on multiples of VELOCITY_WINDOW since then.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def window_start(now):
+    """When the VELOCITY_WINDOW ``now`` falls in started."""
+    return EPOCH + VELOCITY_WINDOW * ((now - EPOCH) // VELOCITY_WINDOW)
+
+
+def previous_weight(now):
+    """How much of the window before the current one is still within the
+       VELOCITY_WINDOW up to ``now``, from 1 down to 0."""
+    return 1 - (now - window_start(now)).total_seconds() / \
+            VELOCITY_WINDOW.total_seconds()
+
+
+def recent_votes(now):
+    """SQL expression estimating an event's votes over the VELOCITY_WINDOW
+       up to ``now``, from its current and previous windows."""
+    current, weight = window_start(now), previous_weight(now)
+    stats_table = EventStats.__table__
+    previous_votes = db.func.coalesce(stats_table.c.previous_votes, 0)
+    return case([(stats_table.c.recent_since == current,
+                  stats_table.c.recent_votes + previous_votes * weight),
+                 (stats_table.c.recent_since == current - VELOCITY_WINDOW,
+                  stats_table.c.recent_votes * weight)], else_=0)
+
+
+def estimate_recent_votes(stats, now):
+    """The same estimate as recent_votes(), for stats already loaded."""
+    if stats == None or stats.recent_since == None:
+        return 0
+
+    current, weight = window_start(now), previous_weight(now)
+    if stats.recent_since == current:
+        return stats.recent_votes + (stats.previous_votes or 0) * weight
+    if stats.recent_since == current - VELOCITY_WINDOW:
+        return stats.recent_votes * weight
+    return 0
+
+
+def update_event_stats(event_id, posts=0, score=0, votes=0, now=None):
+    """Adds to an event's post count, total score and recent votes, making
+       its stats row the first time. Doesn't commit, so it goes in the same
+       transaction as whatever caused it."""
+    if event_id == None:
+        return
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    stats_table = EventStats.__table__
+    values = {
+        'post_count': db.func.coalesce(stats_table.c.post_count, 0) + posts,
+        'total_score': db.func.coalesce(stats_table.c.total_score, 0) + score,
+    }
+    if votes:
+        # The first vote of a new window moves the current window's votes
+        # into the previous one, unless more than a window has gone by.
+        current = window_start(now)
+        in_current = stats_table.c.recent_since == current
+        in_previous = stats_table.c.recent_since == current - VELOCITY_WINDOW
+        values['recent_votes'] = case([(in_current,
+                stats_table.c.recent_votes + votes)], else_=votes)
+        values['previous_votes'] = case([(in_current,
+                stats_table.c.previous_votes),
+                (in_previous, stats_table.c.recent_votes)], else_=0)
+        values['recent_since'] = current
+    if posts > 0 or votes:
+        values['last_activity'] = now
+
+    update = stats_table.update().where(
+            stats_table.c.event_id == event_id).values(values)
+    if not db.session.execute(update).rowcount:
+        # Two first posts or votes in an event can both get here, so the
+        # empty row is only made if it's still missing, then updated.
+        db.session.execute(insert_missing(stats_table, event_id=event_id,
+                post_count=0, total_score=0, recent_votes=0,
+                previous_votes=0))
+        db.session.execute(update)
+
+
+def insert_missing(table, **values):
+    """An INSERT of ``values`` doing nothing when a row with the same
+       primary key is already there."""
+    dialect = db.session.get_bind(clause=table.insert()).dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).values(values).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().values(values).prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return table.insert().values(values).prefix_with('IGNORE')
+
+    return table.insert().values(values)
+
+
+def trending_events(limit, now=None):
+    """Returns up to ``limit`` events with their stats loaded, those with
+       the most votes over the last VELOCITY_WINDOW first, then the rest by
+       their last activity."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    recent = EventStats.recent_since >= window_start(now) - VELOCITY_WINDOW
+    trending = Event.query.join(EventStats).options(
+            contains_eager(Event.stats)).filter(recent).order_by(
+            recent_votes(now).desc(),
+            EventStats.last_activity.desc()).limit(limit).all()
+    if len(trending) < limit:
+        trending += Event.query.join(EventStats).options(
+                contains_eager(Event.stats)).filter(
+                ~recent | (EventStats.recent_since == None)).order_by(
+                EventStats.last_activity.desc()).limit(
+                limit - len(trending)).all()
+    return trending
+
+
+def rebuild_event_stats():
+    """Replaces every event's stats with totals worked out from its posts,
+       and commits. Returns the number of events with stats."""
+    rows = db.session.query(Post.event_id, db.func.count(Post.id),
+            db.func.sum(db.func.coalesce(Post.score, 0)),
+            db.func.max(Post.timestamp)).filter(
+            Post.event_id != None).group_by(Post.event_id).all()
+
+    db.session.execute(EventStats.__table__.delete())
+    if rows:
+        db.session.execute(EventStats.__table__.insert(), [
+                {'event_id': event_id, 'post_count': count,
+                 'total_score': int(score or 0), 'recent_votes': 0,
+                 'previous_votes': 0,
+                 'recent_since': None, 'last_activity': last_activity}
+                for event_id, count, score, last_activity in rows])
+    db.session.commit()
+    return len(rows)
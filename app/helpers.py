@@ -1,9 +1,12 @@
 """
 This code is used to store any helper functions...
 """
-from flask import request, url_for
-from flask_login import AnonymousUserMixin
-from app.models import Topic, Event
+from flask import request, url_for, has_request_context, current_app
+from flask_login import current_user
+from app import db
+from app.pagination import keyset_paginate
+from app.models import Post, Topic, Event, upvoters_table, downvoters_table, \
+        importance_givers_table, topic_posts
 
 
 def redirect_url():
@@ -19,26 +22,171 @@ def redirect_url():
             url_for('index')
 
 def get_posts_from_topic(topic):
-    """Gets all posts from a topic name"""
+    """Gets the hottest POSTS_PER_PAGE posts of a topic, walking the
+       (topic_id, post_id) index rather than every post with the topic."""
     if topic != None:
-        posts = topic.posts
-        return posts
+        posts = topic_posts(topic).order_by(Post.hotness.desc(),
+                Post.id.desc()).limit(current_app.config['POSTS_PER_PAGE'])
+        return posts.all()
 
     return []
 
+def paginate_feed(query, columns, endpoint, hot_feed=None, **values):
+    """Keyset paginates a feed using the request's ``after`` or ``before``
+       cursor, see pagination.py. Pages are read from ``hot_feed`` (see
+       hotfeed.py) whenever it holds them.
+
+       Returns the page along with the urls of the next and previous pages,
+       which are built for ``endpoint`` with ``values``."""
+    after = request.args.get('after')
+    before = request.args.get('before')
+    per_page = current_app.config['POSTS_PER_PAGE']
+
+    page = None
+    if hot_feed != None:
+        page = hot_feed.paginate(query, after, before, per_page)
+    if page == None:
+        page = keyset_paginate(query, columns, after=after, before=before,
+                per_page=per_page)
+    load_vote_state(page.items)
+
+    next_url = url_for(endpoint, after=page.next_cursor, **values) \
+            if page.has_next else None
+    prev_url = url_for(endpoint, before=page.prev_cursor, **values) \
+            if page.has_prev else None
+    return page, next_url, prev_url
+
+class VoteState(object):
+    """The votes a user has made on a page of posts.
+
+    Loaded with one query per association table for just the posts on the
+    page, so templates can check each post with a set lookup instead of
+    scanning every vote the user has ever made.
+
+    Parameters
+    ----------
+    user : User
+        The user whose votes are being looked up.
+    post_ids : set
+        Ids of every post that has been loaded so far.
+    upvoted : set
+        Ids of the loaded posts the user has upvoted.
+    downvoted : set
+        Ids of the loaded posts the user has downvoted.
+    given_importance : set
+        Ids of the loaded posts the user has given importance to."""
+
+    def __init__(self, user, posts=()):
+        self.user = user
+        self.post_ids = set()
+        self.upvoted = set()
+        self.downvoted = set()
+        self.given_importance = set()
+        self.load(posts)
+
+    def load(self, posts):
+        """Loads the user's votes for any of the posts not loaded yet."""
+        ids = set(post.id for post in posts) - self.post_ids
+        if not ids:
+            return
+
+        self.upvoted |= self._voted_on(upvoters_table,
+                upvoters_table.c.upvoter_id, ids)
+        self.downvoted |= self._voted_on(downvoters_table,
+                downvoters_table.c.downvoter_id, ids)
+        self.given_importance |= self._voted_on(importance_givers_table,
+                importance_givers_table.c.importance_giver_id, ids)
+        self.post_ids |= ids
+
+    def _voted_on(self, table, user_column, ids):
+        rows = db.session.query(table.c.post_id).filter(
+                user_column == self.user.id, table.c.post_id.in_(ids))
+        return set(post_id for post_id, in rows)
+
+
+# The VoteState is kept in the WSGI environ so it only lives for one request.
+VOTE_STATE_KEY = 'nuncio.vote_state'
+
+def load_vote_state(posts, user=current_user):
+    """Loads the user's votes on the posts about to be rendered, so that
+       check_if_upvoted() and friends don't need a query per post.
+       Can be called more than once per request, e.g. for two lists."""
+    if not user.is_authenticated:
+        return None
+
+    state = request.environ.get(VOTE_STATE_KEY)
+    if state is None or state.user.id != user.id:
+        state = request.environ[VOTE_STATE_KEY] = VoteState(user)
+
+    state.load(posts)
+    return state
+
+def _loaded_vote_state(test_post, user):
+    """Returns the request's VoteState if it already covers the post."""
+    if not has_request_context():
+        return None
+
+    state = request.environ.get(VOTE_STATE_KEY)
+    if state is not None and state.user.id == user.id and \
+            test_post.id in state.post_ids:
+        return state
+
+    return None
+
+def _pending_vote(test_post, user):
+    """Returns (upvoted, downvoted) if the user has a vote on the post still
+       waiting in the vote buffer, see votebuffer.py."""
+    buffer = current_app.extensions.get('nuncio_votes')
+    if buffer is None:
+        return None
+
+    return buffer.pending_vote(user.id, test_post.id)
+
+def displayed_score(test_post):
+    """The post's score counting the votes still in the vote buffer, so a
+       voter sees their vote in the score as well as in the arrows."""
+    # votebuffer.py imports this module, so it's imported here instead.
+    from app.votebuffer import pending_deltas
+    upvotes, downvotes = pending_deltas(test_post)
+    return (test_post.score or 0) + upvotes - downvotes
+
+def _has_voted(table, user_column, test_post, user):
+    """Checks a single association row, for posts that weren't preloaded."""
+    return db.session.query(table.c.post_id).filter(
+            user_column == user.id, table.c.post_id == test_post.id
+            ).first() != None
+
 def check_if_upvoted(test_post, user):
     """Checks whether a user has upvoted or not."""
-    if type(user) == AnonymousUserMixin:
+    if not user.is_authenticated:
         return False
-    else:
-        return any(post.id == test_post.id for post in user.upvoted_on)
+
+    pending = _pending_vote(test_post, user)
+    if pending is not None:
+        return pending[0]
+
+    state = _loaded_vote_state(test_post, user)
+    if state is not None:
+        return test_post.id in state.upvoted
+
+    return _has_voted(upvoters_table, upvoters_table.c.upvoter_id,
+            test_post, user)
 
 def check_if_downvoted(test_post, user):
     """Checks whether a user has downvoted or not."""
-    if type(user) == AnonymousUserMixin:
+    if not user.is_authenticated:
         return False
-    else:
-        return any(post.id == test_post.id for post in user.downvoted_on)
+
+    pending = _pending_vote(test_post, user)
+    if pending is not None:
+        return pending[1]
+
+    state = _loaded_vote_state(test_post, user)
+    if state is not None:
+        return test_post.id in state.downvoted
+
+    return _has_voted(downvoters_table, downvoters_table.c.downvoter_id,
+            test_post, user)
 
 
 def check_topic_exists(tag_name):
@@ -57,7 +205,15 @@ def check_event_exists(event_name):
 
 def check_if_given_importance(test_post, user):
     """Checks whether a user has given importance to a post or not."""
-    return any(post.id == test_post.id for post in user.given_importance_to)
+    if not user.is_authenticated:
+        return False
+
+    state = _loaded_vote_state(test_post, user)
+    if state is not None:
+        return test_post.id in state.given_importance
+
+    return _has_voted(importance_givers_table,
+            importance_givers_table.c.importance_giver_id, test_post, user)
 
 def unvote():
     """Used to unvote any posts a user has voted."""
@@ -0,0 +1,260 @@
+"""
+The hot feed: the ids and hotness of the top HOT_FEED_SIZE posts, kept in
+order in each process so that the index page never has to sort the post
+table. It only reads the posts it shows, by primary key.
+
+Views which change a post's hotness update the feed straight away, which
+only takes a bisect. Hotness also decays with time, so the whole feed is
+reloaded from the database by the ranking worker after every recompute, or
+by the next request once it's older than RANKING_INTERVAL.
+
+Every post the feed doesn't hold is colder than every post it does, so
+pages within the feed are exact. Pages running past its end are left to
+keyset_paginate(), see pagination.py.
+
+Topics get feeds of their own, holding their top TOPIC_FEED_SIZE posts.
+Only the TOPIC_FEEDS most recently read topics are kept. They follow new
+posts and posts they already hold, but a post climbing into a topic's top
+posts only shows up there once the feeds are reloaded with the main one.
+"""
+import bisect
+import numbers
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from app import db
+from app.models import Post, topics_table, POST_SORTS
+from app.pagination import KeysetPage, encode_cursor, decode_cursor
+
+
+class HotFeed(object):
+    """The hottest posts, sorted by (hotness, id) descending like the SQL
+       feeds are.
+
+    Parameters
+    ----------
+    size : int
+        How many posts to hold at most.
+    max_age : int
+        How many seconds the feed is trusted for before it's reloaded.
+    keys : list
+        (-hotness, -post id) of every post held, sorted so the hottest
+        comes first.
+    hotness : dict
+        Hotness of every post held, by id.
+    exhaustive : bool
+        Whether the feed holds every post there is.
+    topic_id : int
+        If given, the feed only holds the posts with this topic."""
+
+    def __init__(self, size, max_age, topic_id=None):
+        self.lock = threading.RLock()
+        self.size = size
+        self.max_age = max_age
+        self.topic_id = topic_id
+        self.keys = []
+        self.hotness = {}
+        self.exhaustive = False
+        self.loaded_at = None
+
+    @staticmethod
+    def key(post_id, hotness):
+        return (-hotness, -post_id)
+
+    def rebuild(self):
+        """Reloads the top posts from the database."""
+        query = db.session.query(Post.id, Post.hotness).filter(
+                Post.hotness != None)
+        if self.topic_id != None:
+            query = query.join(topics_table,
+                    topics_table.c.post_id == Post.id).filter(
+                    topics_table.c.topic_id == self.topic_id)
+
+        rows = query.order_by(Post.hotness.desc(),
+                Post.id.desc()).limit(self.size).all()
+
+        with self.lock:
+            self.keys = sorted(self.key(post_id, hotness)
+                               for post_id, hotness in rows)
+            self.hotness = dict(rows)
+            self.exhaustive = len(rows) < self.size
+            self.loaded_at = time.time()
+
+    def reset(self):
+        """Forgets every post, so the feed is reloaded when next read."""
+        with self.lock:
+            self.keys, self.hotness = [], {}
+            self.exhaustive = False
+            self.loaded_at = None
+
+    @property
+    def stale(self):
+        return self.loaded_at == None or \
+                time.time() - self.loaded_at > self.max_age
+
+    def update(self, post_id, hotness):
+        """Moves a post to where its new hotness puts it, adding it if it is
+           now hot enough to be held."""
+        with self.lock:
+            self._discard(post_id)
+            if self.loaded_at == None or hotness == None:
+                return
+
+            key = self.key(post_id, hotness)
+            # Posts colder than everything held may be colder than posts
+            # which aren't held either, so they aren't held.
+            if not self.exhaustive and (not self.keys or key > self.keys[-1]):
+                return
+
+            bisect.insort(self.keys, key)
+            self.hotness[post_id] = hotness
+            if len(self.keys) > self.size:
+                dropped = self.keys.pop()
+                del self.hotness[-dropped[1]]
+                self.exhaustive = False
+
+    def remove(self, post_id):
+        with self.lock:
+            self._discard(post_id)
+
+    def _discard(self, post_id):
+        if post_id in self.hotness:
+            key = self.key(post_id, self.hotness.pop(post_id))
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def paginate(self, query, after=None, before=None, per_page=10):
+        """Returns a KeysetPage of the posts of ``query`` after or before a
+           cursor, just like keyset_paginate() with POST_SORTS['hot']
+           would, or None if the page runs past the end of the feed."""
+        if self.stale:
+            self.rebuild()
+
+        with self.lock:
+            backwards = before != None and after == None
+            values = decode_cursor(before if backwards else after,
+                    POST_SORTS['hot'])
+            if values == None:
+                backwards = False
+            elif not all(isinstance(value, numbers.Real) for value in values):
+                return None
+
+            if values == None:
+                start, end = 0, per_page
+            elif backwards:
+                end = bisect.bisect_left(self.keys, self.key(values[1],
+                        values[0]))
+                start = max(end - per_page, 0)
+            else:
+                start = bisect.bisect_right(self.keys, self.key(values[1],
+                        values[0]))
+                end = start + per_page
+
+            if end >= len(self.keys) and not self.exhaustive:
+                return None
+
+            keys = self.keys[start:end]
+            has_next = end < len(self.keys) or (backwards and values != None)
+            has_prev = start > 0
+
+        ids = [-post_id for hotness, post_id in keys]
+        posts = {}
+        if ids:
+            posts = dict((post.id, post) for post in
+                         query.filter(Post.id.in_(ids)))
+
+        next_cursor = prev_cursor = None
+        if keys and has_next:
+            next_cursor = encode_cursor([-keys[-1][0], -keys[-1][1]])
+        if keys and has_prev:
+            prev_cursor = encode_cursor([-keys[0][0], -keys[0][1]])
+
+        return KeysetPage([posts[post_id] for post_id in ids
+                           if post_id in posts], next_cursor, prev_cursor)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def get_hot_feed():
+    """Returns the hot feed of the current app, making it the first time
+       it's asked for. It's loaded from the database when first read."""
+    extensions = current_app.extensions
+    if 'nuncio_hot_feed' not in extensions:
+        extensions['nuncio_hot_feed'] = HotFeed(
+                current_app.config['HOT_FEED_SIZE'],
+                current_app.config['RANKING_INTERVAL'])
+
+    return extensions['nuncio_hot_feed']
+
+
+class TopicFeeds(object):
+    """HotFeeds of the most recently read topics.
+
+    Parameters
+    ----------
+    max_topics : int
+        How many topics to keep feeds for.
+    size : int
+        How many posts each topic's feed holds.
+    max_age : int
+        How many seconds each feed is trusted for before it's reloaded."""
+
+    def __init__(self, max_topics, size, max_age):
+        self.lock = threading.Lock()
+        self.feeds = OrderedDict()
+        self.max_topics = max_topics
+        self.size = size
+        self.max_age = max_age
+
+    def get(self, topic_id):
+        """Returns a topic's feed, which is loaded when first read."""
+        with self.lock:
+            feed = self.feeds.pop(topic_id, None)
+            if feed == None:
+                feed = HotFeed(self.size, self.max_age, topic_id)
+            self.feeds[topic_id] = feed
+            while len(self.feeds) > self.max_topics:
+                self.feeds.popitem(last=False)
+            return feed
+
+    def rebuild(self):
+        """Reloads the feed of every topic kept."""
+        with self.lock:
+            feeds = list(self.feeds.values())
+        for feed in feeds:
+            feed.rebuild()
+
+    def update(self, post_id, hotness, topic_ids=()):
+        """Moves a post in the feeds already holding it, and in the feeds of
+           ``topic_ids``, which new posts pass."""
+        with self.lock:
+            feeds = [feed for topic_id, feed in self.feeds.items()
+                     if topic_id in topic_ids or post_id in feed.hotness]
+        for feed in feeds:
+            feed.update(post_id, hotness)
+
+    def remove(self, post_id):
+        """Takes a deleted post out of every topic's feed."""
+        with self.lock:
+            feeds = list(self.feeds.values())
+        for feed in feeds:
+            feed.remove(post_id)
+
+    def clear(self):
+        with self.lock:
+            self.feeds.clear()
+
+
+def get_topic_feeds():
+    """Returns the topic feeds of the current app, making them the first
+       time they're asked for."""
+    extensions = current_app.extensions
+    if 'nuncio_topic_feeds' not in extensions:
+        extensions['nuncio_topic_feeds'] = TopicFeeds(
+                current_app.config['TOPIC_FEEDS'],
+                current_app.config['TOPIC_FEED_SIZE'],
+                current_app.config['RANKING_INTERVAL'])
+
+    return extensions['nuncio_topic_feeds']
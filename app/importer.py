@@ -0,0 +1,295 @@
+"""
+Bulk imports posts from JSONL or CSV files, with `flask import-posts`.
+
+Each row is a post with these fields, only the title and author being
+required:
+
+    title, text, link, topics, event, author, timestamp, upvotes, downvotes
+
+``topics`` is a list in JSONL and comma separated in CSV, ``author`` is the
+username of an existing user and ``timestamp`` is ISO 8601 in UTC. Rows
+without a title, without a link or text, with an unknown author, with a
+bad timestamp or with fields of the wrong type are skipped, as are JSONL
+lines which aren't a JSON object.
+
+The file is streamed a batch at a time. For each batch the topics and
+events are looked up, and made if they're missing, with one query per
+table, then the posts, their topics, score events, event stats and search
+documents are all inserted with executemany and committed together. After
+each commit the number of rows read so far is saved to a checkpoint file,
+so an interrupted import picks up where it stopped when run again.
+
+Post ids are handed out from the largest one in the table, and postgres'
+id sequence is moved past them afterwards, so imports shouldn't run while
+the site is taking submissions. If the process dies
+between committing a batch and saving its checkpoint, that batch will be
+imported twice.
+"""
+import csv
+import datetime
+import io
+import json
+import os
+
+from flask import current_app
+from app import db
+from app.database import sync_id_sequence
+from app.models import User, Post, Topic, Event, ScoreEvent, topics_table, \
+        HOTNESS_FORMULAS
+from app.karma import POST_CREATED, roll_up_scores
+from app.events import update_event_stats
+from app.search import get_search_index
+
+
+# How many names go in each lookup, within sqlite's limit on parameters.
+LOOKUP_CHUNK = 500
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+class SkipRow(ValueError):
+    """Raised for a row which can't be imported, saying why."""
+
+
+def read_rows(path, file_format):
+    """Yields every row of a CSV file as a dict, or every line of a JSONL
+       file as it is, None for blank lines so rows are counted the same way
+       every time. JSONL lines are decoded by parse_row(), so a bad line
+       only skips that row."""
+    if file_format == 'csv':
+        with io.open(path, encoding='utf-8', newline='') as source:
+            for row in csv.DictReader(source):
+                yield row
+    else:
+        with io.open(path, encoding='utf-8') as source:
+            for line in source:
+                yield line if line.strip() else None
+
+
+def parse_timestamp(value):
+    if not isinstance(value, str):
+        raise SkipRow('bad timestamp {!r}'.format(value))
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.rstrip('Z'),
+                    timestamp_format)
+        except ValueError:
+            pass
+
+    raise SkipRow('bad timestamp {!r}'.format(value))
+
+
+def text_field(row, name):
+    """A field which has to be a string if it's given, '' if it isn't."""
+    value = row.get(name)
+    if value == None:
+        return ''
+    if not isinstance(value, str):
+        raise SkipRow('{} must be a string'.format(name))
+    return value
+
+
+def parse_row(row, now):
+    """Decodes a JSONL line, then checks the row and fills its optional
+       fields in."""
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError:
+            raise SkipRow('not valid JSON')
+    if not isinstance(row, dict):
+        raise SkipRow('not a JSON object')
+
+    title = text_field(row, 'title').strip()
+    text = text_field(row, 'text')
+    link = text_field(row, 'link')
+    if not title:
+        raise SkipRow('no title')
+    if not text and not link:
+        raise SkipRow('neither a link nor text')
+    author = text_field(row, 'author').strip()
+    if not author:
+        raise SkipRow('no author')
+
+    topics = row.get('topics') or []
+    if isinstance(topics, str):
+        topics = topics.split(',')
+    if not isinstance(topics, list) or \
+            not all(isinstance(topic, str) for topic in topics):
+        raise SkipRow('topics must be a list or comma separated')
+    event = text_field(row, 'event').strip()
+    try:
+        upvotes = int(row.get('upvotes') or 0)
+        downvotes = int(row.get('downvotes') or 0)
+    except (TypeError, ValueError):
+        raise SkipRow('votes must be whole numbers')
+
+    return {'title': title, 'text': text, 'link': link,
+            'topics': sorted(set(topic.strip() for topic in topics
+                                 if topic.strip())),
+            'event': event or None,
+            'author': author,
+            'timestamp': parse_timestamp(row['timestamp'])
+                         if row.get('timestamp') else now,
+            'upvotes': upvotes, 'downvotes': downvotes}
+
+
+def lookup(column, names):
+    """Returns {name: id} of the rows whose ``column`` is one of ``names``,
+       the lowest id winning where names repeat."""
+    ids = {}
+    names = sorted(names)
+    for start in range(0, len(names), LOOKUP_CHUNK):
+        rows = db.session.execute(db.select([column.table.c.id, column])
+                .where(column.in_(names[start:start + LOOKUP_CHUNK]))
+                .order_by(column.table.c.id.desc()))
+        ids.update((name, row_id) for row_id, name in rows)
+    return ids
+
+
+def get_or_create(column, names):
+    """Like lookup(), making a row for each name missing first."""
+    ids = lookup(column, names)
+    missing = [name for name in names if name not in ids]
+    if missing:
+        db.session.execute(column.table.insert(),
+                [{column.name: name} for name in missing])
+        ids.update(lookup(column, missing))
+    return ids
+
+
+def import_batch(rows, now, skipped=None):
+    """Inserts a batch of (row number, parsed row), without committing.
+       Returns how many posts were inserted, calling ``skipped`` for the
+       rows whose author doesn't exist."""
+    user_ids = lookup(User.__table__.c.username,
+            set(row['author'] for number, row in rows))
+    known = []
+    for number, row in rows:
+        if row['author'] in user_ids:
+            known.append(row)
+        elif skipped != None:
+            skipped(number, 'unknown author {!r}'.format(row['author']))
+    rows = known
+
+    topic_ids = get_or_create(Topic.__table__.c.tag_name,
+            set(topic for row in rows for topic in row['topics']))
+    event_ids = get_or_create(Event.__table__.c.event_name,
+            set(row['event'] for row in rows if row['event']))
+
+    formula = HOTNESS_FORMULAS[current_app.config['HOTNESS_FORMULA']]
+    first_id = (db.session.query(db.func.max(Post.id)).scalar() or 0) + 1
+    posts, links, score_events, documents, events = [], [], [], {}, {}
+    for post_id, row in enumerate(rows, first_id):
+        score = row['upvotes'] - row['downvotes']
+        seconds = (now - row['timestamp']).total_seconds() + 1
+        user_id = user_ids[row['author']]
+        event_id = event_ids.get(row['event'])
+        posts.append({'id': post_id, 'title': row['title'],
+                'text': row['text'], 'link': row['link'],
+                'is_link': row['link'] != '', 'user_id': user_id,
+                'event_id': event_id, 'timestamp': row['timestamp'],
+                'upvotes': row['upvotes'], 'downvotes': row['downvotes'],
+                'score': score, 'importance': 10,
+                'hotness': formula(score, 10, seconds), 'version': 0,
+                'comment_count': 0})
+        links += [{'post_id': post_id, 'topic_id': topic_ids[topic]}
+                  for topic in row['topics']]
+        if score != 0:
+            score_events.append({'user_id': user_id, 'post_id': post_id,
+                    'kind': POST_CREATED, 'delta': score, 'rolled_up': False})
+        if event_id != None:
+            count, total = events.get(event_id, (0, 0))
+            events[event_id] = (count + 1, total + score)
+        documents[post_id] = {'title': row['title'], 'text': row['text'],
+                'topics': ' '.join(row['topics']),
+                'event': row['event'] or ''}
+
+    if not posts:
+        return 0
+
+    db.session.execute(Post.__table__.insert(), posts)
+    sync_id_sequence(db.session, Post.__table__)
+    if links:
+        db.session.execute(topics_table.insert(), links)
+    if score_events:
+        db.session.execute(ScoreEvent.__table__.insert(), score_events)
+    for event_id, (count, total) in sorted(events.items()):
+        update_event_stats(event_id, posts=count, score=total, now=now)
+    get_search_index().add_documents(documents)
+    return len(posts)
+
+
+def read_checkpoint(path):
+    """The number of rows already imported, from a checkpoint file."""
+    if path == None or not os.path.exists(path):
+        return 0
+
+    with open(path) as checkpoint:
+        return int(checkpoint.read().strip() or 0)
+
+
+def write_checkpoint(path, rows):
+    """Saves the number of rows imported so far, replacing the file in one
+       go so it's never left half written."""
+    if path == None:
+        return
+
+    with open(path + '.tmp', 'w') as checkpoint:
+        checkpoint.write('{}\n'.format(rows))
+    os.replace(path + '.tmp', path)
+
+
+def import_posts(path, file_format=None, batch_size=1000, checkpoint=None,
+                 progress=None, skipped=None):
+    """Imports the posts of a JSONL or CSV file, see the top of this module,
+       committing every ``batch_size`` rows.
+
+       Rows counted in the ``checkpoint`` file are skipped, and the file is
+       updated after every batch. ``progress`` is called with the counts so
+       far after every batch, and ``skipped`` with the row number and reason
+       of every row skipped. Returns the final counts."""
+    if file_format == None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+    done = read_checkpoint(checkpoint)
+    counts = {'rows': done, 'posts': 0, 'skipped': 0, 'resumed_at': done}
+    now = datetime.datetime.utcnow()
+    batch = []
+
+    def skip(number, reason):
+        counts['skipped'] += 1
+        if skipped != None:
+            skipped(number, reason)
+
+    def flush(rows_read):
+        if batch:
+            counts['posts'] += import_batch(batch, now, skip)
+            db.session.commit()
+            del batch[:]
+        counts['rows'] = rows_read
+        write_checkpoint(checkpoint, rows_read)
+        if progress != None:
+            progress(counts)
+
+    rows_read = done
+    for number, row in enumerate(read_rows(path, file_format), 1):
+        if number <= done:
+            continue
+
+        rows_read = number
+        if row == None:
+            continue
+        try:
+            batch.append((number, parse_row(row, now)))
+        except SkipRow as reason:
+            skip(number, str(reason))
+            continue
+
+        if len(batch) >= batch_size:
+            flush(rows_read)
+
+    flush(rows_read)
+    roll_up_scores()
+    return counts
@@ -0,0 +1,113 @@
+"""
+Code used to keep users' scores (karma) up to date.
+
+Anything that changes a score only appends a ScoreEvent to the ledger, which
+is cheap and never locks the user's row. The events are rolled up into
+User.scores every RANKING_INTERVAL by the ranking worker, so reading a
+user's karma is just reading a column. If User.scores ever drifts it can be
+rebuilt from the ledger with `flask rebuild-karma`.
+"""
+from sqlalchemy import bindparam
+from app import db
+from app.models import User, Post, ScoreEvent
+
+
+POST_CREATED = 'post'
+VOTE_RECEIVED = 'vote'
+IMPORTANCE_SPENT = 'importance'
+POST_DELETED = 'delete'
+BASELINE = 'baseline'
+
+# What giving a post importance costs the giver.
+IMPORTANCE_COST = 5
+
+# How many event ids go in each "mark as rolled up" statement.
+ROLL_UP_CHUNK = 500
+
+
+def record_score_event(user_id, delta, kind, post_id=None):
+    """Appends a change of score to the ledger. Doesn't commit, so it goes
+       in the same transaction as whatever caused it."""
+    if user_id == None or delta == 0:
+        return
+
+    db.session.execute(ScoreEvent.__table__.insert().values(user_id=user_id,
+            post_id=post_id, kind=kind, delta=delta, rolled_up=False))
+
+
+def roll_up_scores(user_id=None):
+    """Adds every event not rolled up yet onto User.scores, for all users or
+       just one, and commits. Returns the number of users updated.
+
+       Only the events actually read get marked as rolled up, so events
+       committed meanwhile are left for the next run."""
+    event_table = ScoreEvent.__table__
+    pending = event_table.c.rolled_up == False
+    if user_id != None:
+        pending = pending & (event_table.c.user_id == user_id)
+
+    events = db.session.query(event_table.c.id, event_table.c.user_id,
+            event_table.c.delta).filter(pending).all()
+    if not events:
+        return 0
+
+    totals = {}
+    for event_id, event_user_id, delta in events:
+        totals[event_user_id] = totals.get(event_user_id, 0) + delta
+
+    # The events are claimed first, so if another roll up got to any of
+    # them in the meantime nothing is added twice.
+    ids = [event[0] for event in events]
+    for start in range(0, len(ids), ROLL_UP_CHUNK):
+        chunk = ids[start:start + ROLL_UP_CHUNK]
+        claimed = db.session.execute(event_table.update().where(
+                event_table.c.id.in_(chunk) &
+                (event_table.c.rolled_up == False)).values(
+                rolled_up=True)).rowcount
+        if claimed != len(chunk):
+            db.session.rollback()
+            return 0
+
+    user_table = User.__table__
+    db.session.execute(user_table.update()
+            .where(user_table.c.id == bindparam('user'))
+            .values(scores=db.func.coalesce(user_table.c.scores, 0) +
+                    bindparam('total')),
+            [{'user': user, 'total': total} for user, total in totals.items()])
+    db.session.commit()
+    return len(totals)
+
+
+def rebuild_scores():
+    """Recomputes every user's score from the whole ledger, to repair any
+       drift between User.scores and the ledger. Returns the number of
+       users."""
+    event_table = ScoreEvent.__table__
+    user_table = User.__table__
+    total = db.select([db.func.coalesce(db.func.sum(event_table.c.delta), 0)]
+            ).where(event_table.c.user_id == user_table.c.id).as_scalar()
+
+    db.session.execute(event_table.update().values(rolled_up=True))
+    count = db.session.execute(user_table.update().values(scores=total)).rowcount
+    db.session.commit()
+    return count
+
+
+def seed_ledger():
+    """Replaces the ledger with one baseline event per user, worked out the
+       old way from their posts' scores and importance debt. Only needed once
+       for databases that existed before the ledger did."""
+    totals = dict(db.session.query(Post.user_id,
+            db.func.sum(db.func.coalesce(Post.score, 0))).group_by(
+            Post.user_id).all())
+    debts = db.session.query(User.id,
+            db.func.coalesce(User.importance_debt, 0)).all()
+
+    db.session.execute(ScoreEvent.__table__.delete())
+    rows = [{'user_id': user_id, 'post_id': None, 'kind': BASELINE,
+             'delta': int(totals.get(user_id) or 0) - debt, 'rolled_up': False}
+            for user_id, debt in debts]
+    if rows:
+        db.session.execute(ScoreEvent.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,361 @@
+"""
+Per-endpoint request and SQL metrics, served in the Prometheus text format
+on /metrics.
+
+Flask's request hooks time every request, and SQLAlchemy's cursor events
+count the statements it runs, the time they take and the commits it
+makes. Everything is kept by endpoint in each process, so with several
+processes each one has to be scraped.
+
+Requests taking longer than SLOW_REQUEST_MS are logged along with every
+statement they ran. The log is off when SLOW_REQUEST_MS is 0.
+
+For development and tests, requests running the same shape of statement
+REPEATED_QUERY_THRESHOLD times or more are logged with the code and
+template the statement came from. That's usually an N+1: a lazy load for
+every post of a feed. query_budget() makes tests fail when a view runs more
+statements than it should.
+"""
+import functools
+import os
+import re
+import threading
+import time
+import traceback
+
+from flask import Response, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds of the request duration histogram's buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class EndpointMetrics(object):
+    """What has been recorded about the requests to a single endpoint."""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.requests = 0
+        self.duration = 0.0
+        self.statuses = {}
+        self.statements = 0
+        self.sql_duration = 0.0
+        self.commits = 0
+
+
+class RequestState(object):
+    """What is being recorded about the request a thread is serving."""
+
+    def __init__(self, capture, repeat_threshold=0):
+        self.started = time.time()
+        self.status = 500
+        self.statements = 0
+        self.sql_duration = 0.0
+        self.commits = 0
+        # (statement, seconds) of every statement, kept for the slow log.
+        self.captured = [] if capture else None
+        self.cursor_started = None
+        # How many times each shape of statement ran, and where the ones
+        # repeated repeat_threshold times came from.
+        self.repeat_threshold = repeat_threshold
+        self.shapes = {}
+        self.repeated = {}
+
+
+class Metrics(object):
+    """The metrics of every endpoint, recorded from the request hooks and
+       the SQL events of the threads serving them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.endpoints = {}
+
+    @property
+    def recording(self):
+        """Whether the current thread is serving a request being recorded."""
+        return getattr(self.local, 'state', None) != None
+
+    def start_request(self, capture=False, repeat_threshold=0):
+        self.local.state = RequestState(capture, repeat_threshold)
+
+    def finish_request(self, status):
+        state = getattr(self.local, 'state', None)
+        if state != None:
+            state.status = status
+
+    def end_request(self, endpoint):
+        """Records the current thread's request, returning its state or None
+           if no request was being recorded."""
+        state = getattr(self.local, 'state', None)
+        if state == None:
+            return None
+
+        self.local.state = None
+        duration = time.time() - state.started
+        with self.lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics == None:
+                metrics = self.endpoints[endpoint] = EndpointMetrics()
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    metrics.buckets[index] += 1
+            metrics.requests += 1
+            metrics.duration += duration
+            metrics.statuses[state.status] = \
+                    metrics.statuses.get(state.status, 0) + 1
+            metrics.statements += state.statements
+            metrics.sql_duration += state.sql_duration
+            metrics.commits += state.commits
+
+        state.duration = duration
+        return state
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        state = getattr(self.local, 'state', None)
+        if state != None:
+            state.cursor_started = time.time()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        for budget in getattr(self.local, 'budgets', ()):
+            budget.statements.append(statement)
+
+        state = getattr(self.local, 'state', None)
+        if state == None or state.cursor_started == None:
+            return
+
+        duration = time.time() - state.cursor_started
+        state.cursor_started = None
+        state.statements += 1
+        state.sql_duration += duration
+        if state.captured != None:
+            state.captured.append((statement, duration))
+        if state.repeat_threshold:
+            shape = statement_shape(statement)
+            count = state.shapes[shape] = state.shapes.get(shape, 0) + 1
+            if count == state.repeat_threshold:
+                state.repeated[shape] = app_location()
+
+    def commit(self, conn):
+        state = getattr(self.local, 'state', None)
+        if state != None:
+            state.commits += 1
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+
+            lines += ['# HELP nuncio_request_duration_seconds Time taken to '
+                      'serve requests.',
+                      '# TYPE nuncio_request_duration_seconds histogram']
+            for endpoint, metrics in endpoints:
+                label = 'endpoint="{}"'.format(escape(endpoint))
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    lines.append('nuncio_request_duration_seconds_bucket'
+                            '{{{},le="{}"}} {}'.format(label, bound, count))
+                lines.append('nuncio_request_duration_seconds_bucket'
+                        '{{{},le="+Inf"}} {}'.format(label, metrics.requests))
+                lines.append('nuncio_request_duration_seconds_sum{{{}}} {}'
+                        .format(label, metrics.duration))
+                lines.append('nuncio_request_duration_seconds_count{{{}}} {}'
+                        .format(label, metrics.requests))
+
+            lines += ['# HELP nuncio_requests_total Requests served, by '
+                      'status code.',
+                      '# TYPE nuncio_requests_total counter']
+            for endpoint, metrics in endpoints:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append('nuncio_requests_total{{endpoint="{}",'
+                            'status="{}"}} {}'.format(escape(endpoint),
+                            status, count))
+
+            for name, attribute, description in COUNTERS:
+                lines += ['# HELP {} {}'.format(name, description),
+                          '# TYPE {} counter'.format(name)]
+                for endpoint, metrics in endpoints:
+                    lines.append('{}{{endpoint="{}"}} {}'.format(name,
+                            escape(endpoint), getattr(metrics, attribute)))
+
+        return '\n'.join(lines) + '\n'
+
+
+# name, EndpointMetrics attribute and help of the plain counters.
+COUNTERS = [
+    ('nuncio_sql_statements_total', 'statements',
+     'SQL statements run while serving requests.'),
+    ('nuncio_sql_duration_seconds_total', 'sql_duration',
+     'Time spent running SQL statements while serving requests.'),
+    ('nuncio_sql_commits_total', 'commits',
+     'Transactions committed while serving requests.'),
+]
+
+
+# A list of bound parameters, like the ones of an IN.
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s)\s*,)+\s*(?:\?|%\(\w+\)s)\s*\)')
+
+
+def statement_shape(statement):
+    """The statement with its whitespace and IN lists collapsed, so the
+       same query for different rows has the same shape."""
+    statement = ' '.join(statement.split())
+    return IN_LIST.sub('(?)', statement)
+
+
+# Frames from these files are part of the app, rather than its libraries.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(APP_DIR)
+
+
+def app_location(limit=4):
+    """Where in the app, innermost first, the current statement was run
+       from. Templates show up as their file, with Jinja's line numbers."""
+    frames = [frame for frame in traceback.extract_stack()[:-1]
+              if frame[0].startswith(APP_DIR) and frame[0] != __file__]
+    return ' < '.join('{}:{}'.format(os.path.relpath(frame[0], ROOT_DIR),
+                                     frame[1])
+                      for frame in reversed(frames[-limit:])) or 'unknown'
+
+
+def escape(value):
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+
+# Shared by every app in the process, as the SQLAlchemy events are.
+metrics = Metrics()
+_listening = False
+
+
+def listen():
+    """Feeds the SQL run by every engine into the metrics, once."""
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute',
+                metrics.before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute',
+                metrics.after_cursor_execute)
+        event.listen(Engine, 'commit', metrics.commit)
+        _listening = True
+
+
+def start_request():
+    config = current_app.config
+    metrics.start_request(capture=config['SLOW_REQUEST_MS'] > 0,
+            repeat_threshold=config['REPEATED_QUERY_THRESHOLD'])
+
+
+def finish_request(response):
+    metrics.finish_request(response.status_code)
+    return response
+
+
+def end_request(error=None):
+    """Records the request, logging it if it was slow."""
+    if not metrics.recording:
+        return
+
+    app = current_app
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    state = metrics.end_request(endpoint)
+    for shape, location in sorted(state.repeated.items()):
+        app.logger.warning('Repeated query: {} ran {} times in {}, first '
+                'repeated at {}'.format(shape, state.shapes[shape], endpoint,
+                location))
+
+    threshold = app.config['SLOW_REQUEST_MS']
+    if not threshold or state.duration * 1000 < threshold:
+        return
+
+    lines = ['Slow request: {} {} took {:.0f}ms, {} statements in {:.0f}ms'
+             .format(request.method, request.full_path.rstrip('?'),
+                     state.duration * 1000, state.statements,
+                     state.sql_duration * 1000)]
+    for statement, duration in state.captured:
+        lines.append('  {:.1f}ms {}'.format(duration * 1000,
+                ' '.join(statement.split())))
+    app.logger.warning('\n'.join(lines))
+
+
+def metrics_view():
+    """Serves the metrics of this process to Prometheus."""
+    return Response(metrics.render(),
+            mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_metrics(app):
+    """Starts recording the requests of ``app`` and serves them on
+       /metrics, unless METRICS_ENABLED is off."""
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    listen()
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when code runs more statements than its query_budget()."""
+
+
+class query_budget(object):
+    """Context manager, or decorator, failing with QueryBudgetExceeded when
+       the code it wraps runs more than ``max_queries`` statements in this
+       thread, which includes the requests of the test client.
+
+    Parameters
+    ----------
+    max_queries : int
+        How many statements the code may run.
+    statements : list
+        Every statement run so far, in order."""
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.statements = []
+
+    def __enter__(self):
+        listen()
+        self.statements = []
+        budgets = getattr(metrics.local, 'budgets', None)
+        if budgets == None:
+            budgets = metrics.local.budgets = []
+        budgets.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        metrics.local.budgets.remove(self)
+        if exc_type == None and len(self.statements) > self.max_queries:
+            raise QueryBudgetExceeded(self.report())
+
+    def report(self):
+        shapes = {}
+        for statement in self.statements:
+            shape = statement_shape(statement)
+            shapes[shape] = shapes.get(shape, 0) + 1
+
+        lines = ['Ran {} statements, over the budget of {}:'.format(
+                len(self.statements), self.max_queries)]
+        for shape, count in sorted(shapes.items(), key=lambda item: -item[1]):
+            lines.append('  {}x {}'.format(count, shape))
+        return '\n'.join(lines)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with query_budget(self.max_queries):
+                return func(*args, **kwargs)
+        return wrapper
@@ -1,13 +1,55 @@
 import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.orm import joinedload, selectinload
 from math import log
 
 
+# Posts with a score below zero can't be ranked in log-space, so they are
+# pushed below every other post instead.
+BURIED_HOTNESS = 1000.0
+
+def power_hotness(score, importance, seconds):
+    """The original hotness formula. Builds huge numbers as importance grows
+       and flips sign for negative scores."""
+    return ((score + 1) ** importance) / seconds
+
+def log_hotness(score, importance, seconds):
+    """The log of power_hotness(), so it gives the same ordering wherever
+       score + 1 is positive, but in constant time and always a small float."""
+    if score + 1 > 0:
+        return importance * log(score + 1) - log(seconds)
+
+    return -BURIED_HOTNESS - log(1 - score) - log(seconds)
+
+HOTNESS_FORMULAS = {'log': log_hotness, 'power': power_hotness}
+
+def get_age(timestamp, now=None):
+    """Works out how old a timestamp is, without touching the database.
+
+       Returns (age, time_type), where time_type determines whether the age
+       is displayed in minutes (0), hours (1) or days (2)."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    minutes = int(round((now - timestamp).total_seconds() / 60))
+    if minutes <= 60:
+        return minutes, 0
+
+    hours = int(round(minutes / 60))
+    if hours <= 24:
+        return hours, 1
+
+    return int(round(hours / 24)), 2
+
+
 topics_table = db.Table('topics_table',
         db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-        db.Column('topic_id', db.Integer, db.ForeignKey('topic.id'), primary_key=True))
+        db.Column('topic_id', db.Integer, db.ForeignKey('topic.id'), primary_key=True),
+        # The primary key finds a post's topics, this finds a topic's posts.
+        db.Index('ix_topics_table_topic_id_post_id', 'topic_id', 'post_id'))
 
 upvoters_table = db.Table('upvoters_table',
         db.Column('upvoter_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -39,6 +81,10 @@ class User(UserMixin, db.Model):
         Contains the hashed password, for security purposes.
     posts : method
         Contains an sql query for all of the user's posts.
+    scores : int
+        The user's karma, rolled up from the score_event ledger.
+    importance_debt : int
+        Points the user has spent giving importance to posts.
     
     Relationships
     -------------
@@ -104,6 +150,8 @@ class Post(db.Model):
         The title of the post.
     comments : method
         Sql query for all of the comments made in the post.
+    comment_count : int
+        How many comments the post has.
 
     score : int
         Upvotes - Downvotes of a post.
@@ -113,11 +161,13 @@ class Post(db.Model):
         The number of times a user has voted the post down.
     importance : int
         The number of times a user has given a post importance.
-    hotness : int
-        Number which posts will be sorted by.
+    hotness : float
+        Number which posts will be sorted by, see HOTNESS_FORMULA.
 
     age : int
-        How old a post is, compared to the epoch time.
+        How old a post is, worked out from the timestamp when read.
+    time_type : int
+        Whether the age is in minutes (0), hours (1) or days (2).
     topics : method
         Sql query which returns a list of all the topics a post has.
 
@@ -133,7 +183,7 @@ class Post(db.Model):
     text = db.Column(db.String(30000))
     link = db.Column(db.String(240))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow())
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     title = db.Column(db.String(250))
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
@@ -141,17 +191,12 @@ class Post(db.Model):
     upvotes = db.Column(db.Integer)
     downvotes = db.Column(db.Integer)
     importance = db.Column(db.Integer)
-    hotness = db.Column(db.Integer)
-
-    age = db.Column(db.Integer)
-    seconds = db.Column(db.Integer)
-    time_type = db.Column(db.Integer)
-
-    # Time-type determines whether the time is displayed in minutes/hours/days.
-    # 0 = display in minutes
-    # 1 = display in hours
-    # 2 = display in days
-    # If the number is < 0 or > 2 then change back to 2.
+    hotness = db.Column(db.Float)
+    # Bumped whenever anything shown about the post changes, so cached
+    # fragments of it are never served stale (see cache.py).
+    version = db.Column(db.Integer, default=0)
+    # Kept up to date as comments come and go, so feeds needn't count them.
+    comment_count = db.Column(db.Integer, default=0)
 
     topics = db.relationship('Topic',
                     secondary=topics_table,
@@ -162,69 +207,50 @@ class Post(db.Model):
     created_on = db.Column(db.DateTime, default=db.func.now())
     is_link = db.Column(db.Boolean, default=True)
 
+    # Keyset pagination walks these, see POST_SORTS and pagination.py.
+    __table_args__ = (
+        db.Index('ix_post_hotness_id', 'hotness', 'id'),
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_event_id_hotness_id', 'event_id', 'hotness', 'id'),
+        db.Index('ix_post_event_id_timestamp_id', 'event_id', 'timestamp',
+                 'id'),
+        db.Index('ix_post_user_id_hotness_id', 'user_id', 'hotness', 'id'),
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp',
+                 'id'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.text)
 
-    def get_seconds(self):
-        self.raw_diff = datetime.datetime.utcnow() - self.timestamp
-        self.seconds = self.raw_diff.total_seconds() + 1
-        db.session.commit()
-        return self.seconds
-
-    def get_minutes(self, input_time=datetime.datetime.utcnow()):
-
-        self.raw_diff = (input_time - self.timestamp)
-        self.minute_diff = int(round(self.raw_diff.total_seconds() / 60))
-        if self.minute_diff > 60:
-            return self.get_hours(self.minute_diff)
-
-        self.time_type = 0
-        db.session.commit()
-        return self.minute_diff
-
-    def get_hours(self, minute_diff):
-        self.hourly_diff = int(round(minute_diff / 60))
-        if self.hourly_diff > 24:
-            return self.get_days(self.hourly_diff)
-
-        self.time_type = 1
-        db.session.commit()
-        return self.hourly_diff
-
-    def get_days(self, hourly_diff):
-        self.daily_diff = int(round(hourly_diff / 24))
-        self.time_type = 2
-        db.session.commit()
-
-        return self.daily_diff
-
-    def check_time_type(self):
-        if self.time_type > 2 or self.time_type < 0:
-            self.time_type = 2
-            db.session.commit()
+    @property
+    def age(self):
+        """How old the post is, in the unit given by time_type."""
+        return get_age(self.timestamp)[0]
 
-    def make_time_positive(self):
-        if self.age < 0:
-            self.age * -1
-            db.session.commit()
-
-    def set_age(self):
-        self.age = self.get_minutes()
-        self.check_time_type()
-        db.session.commit()
+    @property
+    def time_type(self):
+        return get_age(self.timestamp)[1]
 
     def get_score(self):
+        """Works the score out from the votes, without committing, so it
+           can go in the same transaction as whatever changed them."""
         self.score = self.upvotes - self.downvotes
-        db.session.commit()
         return self.score
 
+    def calculate_hotness(self, now=None):
+        """Works out the hotness of the post at the time ``now`` without
+           touching the database, so that it can be used in bulk."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        seconds = (now - self.timestamp).total_seconds() + 1
+        score = (self.upvotes or 0) - (self.downvotes or 0)
+        importance = self.importance if self.importance != None else 10
+        formula = HOTNESS_FORMULAS[current_app.config['HOTNESS_FORMULA']]
+        return formula(score, importance, seconds)
+
     def set_hotness(self):
-        self.get_seconds()
-        self.set_age()
-#        self.raw_diff = (input_time - self.timestamp)
-#        self.total_seconds = self.raw_diff.total_seconds()
-#        self.hotness = round((log(max(abs(self.upvotes - self.downvotes), 1), 10) * (self.age * log(self.importance))))
-        self.hotness = ((self.upvotes - self.downvotes + 1) ** self.importance) / self.seconds
+        self.hotness = self.calculate_hotness()
         db.session.commit()
 
     def make_vote_int(self):
@@ -238,10 +264,20 @@ class Post(db.Model):
         if self.hotness == None:
             self.get_hotness()
 
+    def change_comment_count(self, delta):
+        """Moves the comment count, in SQL so concurrent comments add up,
+           and bumps the version. Doesn't commit."""
+        self.comment_count = db.func.coalesce(Post.comment_count, 0) + delta
+        self.bump_version()
+
+    def bump_version(self):
+        """Marks the post as changed, in SQL so concurrent bumps add up.
+           Doesn't commit."""
+        self.version = db.func.coalesce(Post.version, 0) + 1
+
     def make_importance_int(self):
         if self.importance == None:
             self.importance = 10
-            db.session.commit()
 
 class Comment(db.Model):
     """Model for the comments table
@@ -272,6 +308,12 @@ class Comment(db.Model):
     text = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
 
+    # A post's comments are paged through in COMMENT_SORT order.
+    __table_args__ = (
+        db.Index('ix_comment_post_id_timestamp_id', 'post_id', 'timestamp',
+                 'id'),
+    )
+
     def __repr__(self):
         return '<Comment {}>'.format(self.text)
 
@@ -319,17 +361,115 @@ class Event(db.Model):
     def __repr__(self):
         return self.event_name
 
+class EventStats(db.Model):
+    """Model for the event_stats table
+
+    Running totals for an event, moved as its posts are made, voted on and
+    deleted (see events.py), so events can be ranked without reading their
+    posts.
+
+    Parameters
+    ----------
+    event_id : int
+        The event the totals are for.
+    post_count : int
+        How many posts the event has.
+    total_score : int
+        The sum of its posts' scores.
+    recent_votes : int
+        How many votes its posts have had since recent_since.
+    recent_since : datetime
+        When the window recent_votes counts over started.
+    previous_votes : int
+        How many votes its posts had in the window before that one.
+    last_activity : datetime
+        When a post was last made or voted on in the event."""
+
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'),
+            primary_key=True)
+    post_count = db.Column(db.Integer, default=0)
+    total_score = db.Column(db.Integer, default=0)
+    recent_votes = db.Column(db.Integer, default=0)
+    recent_since = db.Column(db.DateTime, index=True)
+    previous_votes = db.Column(db.Integer, default=0)
+    last_activity = db.Column(db.DateTime, index=True)
+    event = db.relationship('Event',
+            backref=db.backref('stats', uselist=False))
+
+    def __repr__(self):
+        return '<EventStats {}>'.format(self.event_id)
+
+class ScoreEvent(db.Model):
+    """Model for the score_event table
+    
+    An append-only ledger of everything that changes a user's score.
+    Nothing ever updates a row except to mark it as rolled up, which is when
+    its delta has been added onto User.scores, see karma.py.
+    
+    Parameters
+    ----------
+    id : int
+        Unique id, which also gives the order the events happened in.
+    user_id : int
+        The user whose score changes.
+    post_id : int
+        The post the change came from, if any.
+    kind : str
+        What happened, one of the kinds in karma.py.
+    delta : int
+        How much the user's score changes by.
+    timestamp : datetime
+        The time at which it happened.
+    rolled_up : bool
+        Whether delta has already been added onto User.scores."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    post_id = db.Column(db.Integer)
+    kind = db.Column(db.String(20))
+    delta = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    rolled_up = db.Column(db.Boolean, default=False, index=True)
+
+    def __repr__(self):
+        return '<ScoreEvent {} {}>'.format(self.kind, self.delta)
+
 @login.user_loader
 def load_user(id):
     """Gets a user from it's id, definitely deprecated once I get to it."""
     return User.query.get(int(id))
 
-def find_users_post(user):
-    """Fetches the user of a post, will be deprecated some day..."""
-    posts = Post.query.all()
-    user_posts = []
-    for post in posts:
-        if post.author.id == user.id:
-            user_posts.append(post)
-
-    return user_posts
+def feed_query():
+    """Starts a query for a list of posts about to be rendered by _post.html.
+
+       The author and event are joined in and the topics are fetched with one
+       extra query, so a feed costs the same number of queries no matter how
+       many posts are on the page."""
+    return Post.query.options(joinedload(Post.author),
+                              joinedload(Post.event),
+                              selectinload(Post.topics))
+
+def topic_posts(topic):
+    """Query for the posts with a topic."""
+    return feed_query().join(topics_table,
+            topics_table.c.post_id == Post.id).filter(
+            topics_table.c.topic_id == topic.id)
+
+def event_posts(event):
+    """Query for the posts in an event."""
+    return feed_query().filter(Post.event_id == event.id)
+
+def user_posts(user):
+    """Query for the posts made by a user, using the indexes on user_id and
+       each of POST_SORTS so it only ever looks at that user's posts, in
+       order. Sort it with one of POST_SORTS."""
+    return feed_query().filter(Post.user_id == user.id)
+
+# Keyset sort columns for lists of posts, the id breaks any ties.
+POST_SORTS = {
+    'hot': (Post.hotness, Post.id),
+    'new': (Post.timestamp, Post.id),
+}
+
+# A post's comments are shown oldest first.
+COMMENT_SORT = (Comment.timestamp, Comment.id)
@@ -0,0 +1,139 @@
+"""
+Keyset (cursor) pagination, used instead of OFFSET pagination so that a
+deep page costs the same as the first one, and posts moving up or down the
+rankings don't shift every later page.
+
+Rather than a page number, each page hands out opaque cursors holding the
+sort values of its first and last rows. The next page starts right after
+the last row, the previous page ends right before the first.
+"""
+import base64
+import datetime
+import json
+
+from sqlalchemy import and_, or_
+from app import db
+
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+class KeysetPage(object):
+    """A page of results from keyset_paginate().
+
+    Parameters
+    ----------
+    items : list
+        The rows on this page.
+    next_cursor : str
+        Cursor to pass back as ``after`` for the next page, None on the last
+        page.
+    prev_cursor : str
+        Cursor to pass back as ``before`` for the previous page, None on the
+        first page."""
+
+    def __init__(self, items, next_cursor, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor != None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor != None
+
+
+def encode_cursor(values):
+    """Packs a row's sort values into a url safe string."""
+    values = [value.isoformat() if isinstance(value, datetime.datetime)
+              else value for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Unpacks a cursor made by encode_cursor() for the given sort columns,
+       which may also just be names for values that aren't columns.
+       Returns None for anything that isn't a valid cursor, so a mangled
+       url just shows the first page."""
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(
+                padded.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+
+        return [_parse_value(value, column)
+                for value, column in zip(values, columns)]
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def _parse_value(value, column):
+    if value != None and isinstance(getattr(column, 'type', None), db.DateTime):
+        for fmt in DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError('Bad datetime in cursor')
+
+    return value
+
+
+def after_values(columns, values, descending=True):
+    """Builds the WHERE clause for rows which come after ``values`` when
+       sorted by ``columns``, i.e. (a, b) < (x, y) spelled out so that it
+       works on every database."""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        compare = column < value if descending else column > value
+        equal = [prev == prev_value for prev, prev_value
+                 in zip(columns[:i], values[:i])]
+        clauses.append(and_(*(equal + [compare])))
+
+    return or_(*clauses)
+
+
+def keyset_paginate(query, columns, after=None, before=None, per_page=10,
+        descending=True):
+    """Returns a KeysetPage of ``query`` sorted by ``columns``, starting
+       after the ``after`` cursor or ending before the ``before`` cursor.
+       The last column must be unique (normally the id) so that rows with
+       equal sort values are never skipped.
+
+       Pages before a cursor are fetched in reverse order and flipped back,
+       so both directions can use the same index."""
+    backwards = before != None and after == None
+    values = decode_cursor(before if backwards else after, columns)
+    if values == None:
+        backwards = False
+
+    scan_descending = descending != backwards
+    order = [column.desc() if scan_descending else column.asc()
+             for column in columns]
+    query = query.order_by(*order)
+    if values != None:
+        query = query.filter(after_values(columns, values, scan_descending))
+
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    def cursor_of(item):
+        return encode_cursor([getattr(item, column.key) for column in columns])
+
+    # Coming from a cursor means there is always a page on the other side.
+    has_next = (more and not backwards) or (backwards and values != None)
+    has_prev = (more and backwards) or (not backwards and values != None)
+    next_cursor = cursor_of(items[-1]) if items and has_next else None
+    prev_cursor = cursor_of(items[0]) if items and has_prev else None
+    return KeysetPage(items, next_cursor, prev_cursor)
@@ -0,0 +1,114 @@
+"""
+Code used to keep the hotness of posts up to date in the background,
+so that the index page only ever has to read the top posts.
+"""
+import datetime
+
+from flask import current_app
+from sqlalchemy import bindparam
+from app import db
+from app.hotfeed import get_hot_feed, get_topic_feeds
+from app.karma import roll_up_scores
+from app.models import Post, HOTNESS_FORMULAS, BURIED_HOTNESS
+from app.worker import PeriodicWorker, start_worker
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def calculate_hotness(upvotes, downvotes, importance, seconds, formula='log'):
+    """Works out the hotness of many posts at once, each argument being a
+       column of values. Uses numpy when it is installed, otherwise falls
+       back to the same formulas Post.calculate_hotness() uses."""
+    if numpy is None:
+        hotness_formula = HOTNESS_FORMULAS[formula]
+        return [hotness_formula(up - down, imp, secs) for up, down, imp, secs
+                in zip(upvotes, downvotes, importance, seconds)]
+
+    score = (numpy.asarray(upvotes, dtype=numpy.float64) -
+             numpy.asarray(downvotes, dtype=numpy.float64))
+    importance = numpy.asarray(importance, dtype=numpy.float64)
+    seconds = numpy.asarray(seconds, dtype=numpy.float64)
+
+    if formula == 'power':
+        with numpy.errstate(over='ignore'):
+            hotness = numpy.power(score + 1, importance) / seconds
+        return hotness.tolist()
+
+    # Both branches are worked out for every post, the clamping only keeps
+    # the logs of the branch which isn't picked finite.
+    rising = importance * numpy.log(numpy.maximum(score + 1, 1))
+    buried = -BURIED_HOTNESS - numpy.log(numpy.maximum(1 - score, 1))
+    hotness = numpy.where(score + 1 > 0, rising, buried) - numpy.log(seconds)
+    return hotness.tolist()
+
+
+def seconds_since(timestamps, now):
+    """Returns how many seconds (plus one) have passed since each timestamp."""
+    if numpy is not None and timestamps:
+        diff = (numpy.datetime64(now, 'us') -
+                numpy.array(timestamps, dtype='datetime64[us]'))
+        return (diff / numpy.timedelta64(1, 's') + 1).tolist()
+
+    return [(now - timestamp).total_seconds() + 1 for timestamp in timestamps]
+
+
+def recompute_hotness(now=None, post_ids=None):
+    """Recomputes the hotness of every post, or just of ``post_ids``, and
+       writes it back with a single executemany UPDATE, without loading any
+       Post objects. Commits.
+
+       Returns the number of posts that were ranked."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    query = db.session.query(Post.id,
+            db.func.coalesce(Post.upvotes, 0),
+            db.func.coalesce(Post.downvotes, 0),
+            db.func.coalesce(Post.importance, 10),
+            Post.timestamp)
+    if post_ids != None:
+        query = query.filter(Post.id.in_(post_ids))
+
+    rows = query.all()
+    if not rows:
+        return 0
+
+    ids, upvotes, downvotes, importance, timestamps = zip(*rows)
+    hotness = calculate_hotness(upvotes, downvotes, importance,
+            seconds_since(timestamps, now),
+            current_app.config['HOTNESS_FORMULA'])
+
+    post_table = Post.__table__
+    db.session.execute(post_table.update()
+            .where(post_table.c.id == bindparam('post_id'))
+            .values(hotness=bindparam('new_hotness')),
+            [{'post_id': post_id, 'new_hotness': value}
+             for post_id, value in zip(ids, hotness)])
+    db.session.commit()
+    return len(rows)
+
+
+class RankingWorker(PeriodicWorker):
+    """Thread which recomputes the hotness of all posts every
+       RANKING_INTERVAL seconds, reloads the hot feeds and rolls up the
+       score ledger while it's at it."""
+
+    thread_name = 'ranking-worker'
+    failure_message = 'Failed to recompute hotness'
+
+    def work(self):
+        recompute_hotness()
+        get_hot_feed().rebuild()
+        get_topic_feeds().rebuild()
+        roll_up_scores()
+
+
+def start_ranking_worker():
+    """Starts the ranking thread for the current app, only once per process.
+       Never started while testing, the tests call recompute_hotness()
+       themselves."""
+    return start_worker(RankingWorker,
+            current_app.config['RANKING_INTERVAL'])
@@ -1,9 +1,19 @@
 from flask import render_template, flash, redirect, url_for, request
 from flask_login import logout_user, current_user, login_user, login_required
 from werkzeug.urls import url_parse
-from app.helpers import redirect_url, get_posts_from_topic, check_if_upvoted, check_if_downvoted, check_topic_exists, check_if_given_importance, check_event_exists
-from app.decorators import update_user
-from app.models import User, Post, Comment, Topic, Event, find_users_post
+from sqlalchemy.orm import joinedload
+from app.helpers import redirect_url, get_posts_from_topic, check_if_upvoted, check_if_downvoted, check_topic_exists, check_if_given_importance, check_event_exists, load_vote_state, paginate_feed
+from app.decorators import update_user, cached_page
+from app.models import User, Post, Comment, Topic, Event, feed_query, topic_posts, event_posts, user_posts, POST_SORTS, COMMENT_SORT
+from app.pagination import keyset_paginate
+from app.votes import spend_importance, UPVOTE, DOWNVOTE
+from app.votebuffer import submit_vote
+from app.cache import get_fragment_cache, invalidate_pages, post_changed
+from app.hotfeed import get_hot_feed, get_topic_feeds
+from app.search import search_posts, index_post, unindex_post
+from app.karma import record_score_event, POST_CREATED, POST_DELETED
+from app.events import update_event_stats, trending_events, \
+        estimate_recent_votes
 from app.forms import CommentForm, SubmitForm, SearchForm
 from app import app, db
 import datetime
@@ -12,24 +22,14 @@ import datetime
 
 @app.route('/')
 @app.route('/index')
+@cached_page()
 def index():
     """View function for the index site, basically the main site.
        Sorts posts by hotness"""
-    page = request.args.get('page', 1, type=int)
-
-    posts = Post.query.order_by(Post.hotness.desc())
-    for post in posts:
-        post.set_age()
-        post.set_hotness()
-        db.session.commit()
-
-    posts = Post.query.order_by(Post.hotness.desc()).paginate(
-            page, app.config['POSTS_PER_PAGE'], False)
-
-    next_url = url_for('index', page=posts.next_num) \
-            if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) \
-            if posts.has_prev else None
+    # Hotness is kept up to date by the ranking worker, see ranking.py, and
+    # the hottest posts are kept in order by the hot feed, see hotfeed.py.
+    posts, next_url, prev_url = paginate_feed(feed_query(), POST_SORTS['hot'],
+            'index', hot_feed=get_hot_feed())
 
     return render_template('index.html', title='Fair news, chosen by you.',
             posts=posts.items, check_if_upvoted=check_if_upvoted,
@@ -80,8 +80,16 @@ def submit():
         post.importance = 10
         post.timestamp = datetime.datetime.utcnow()
         post.score = post.get_score()
+        post.hotness = post.calculate_hotness()
         db.session.add(post)
+        db.session.flush()
+        record_score_event(current_user.id, post.score, POST_CREATED, post.id)
+        update_event_stats(post.event_id, posts=1, score=post.score)
+        index_post(post)
+        hotness = post.hotness
+        topic_ids = [topic.id for topic in post.topics]
         db.session.commit()
+        post_changed(post.id, hotness, topic_ids)
     
         flash('You have now made a post!')
         return redirect(url_for('index'))
@@ -89,39 +97,53 @@ def submit():
 
 @app.route('/user/<username>')
 def user(username):
-    """View function for the user profile page. May become deprecated
-       as there isn't much use for it, except for listing specific posts."""
+    """View function for the user profile page, listing the user's posts
+       either hottest or newest first, a page at a time."""
     user = User.query.filter_by(username=username).first_or_404()
-    posts = find_users_post(user)
+    sort = request.args.get('sort', 'new')
+    if sort not in POST_SORTS:
+        sort = 'new'
 
-    for post in posts:
-        post.set_age()
+    posts, next_url, prev_url = paginate_feed(user_posts(user),
+            POST_SORTS[sort], 'user', username=username, sort=sort)
 
-    return render_template('user.html', user=user, posts=posts, check_if_upvoted=check_if_upvoted,
+    return render_template('user.html', user=user, posts=posts.items, sort=sort,
+            next_url=next_url, prev_url=prev_url, check_if_upvoted=check_if_upvoted,
             check_if_downvoted=check_if_downvoted)
 
 @app.route('/item/<post_id>', methods=['GET', 'POST'])
+@cached_page()
 def item(post_id):
     """Shows a specific item, which is specified by it's unique id.
-       Also contains a basic form for submitting comments, which are
-       yet to be sorted by popularity."""
+       Also contains a basic form for logged in users to submit comments,
+       which are shown oldest first, a page at a time."""
 
     post = Post.query.filter_by(id=post_id).first_or_404()
 
-    post.set_age()
-
     form = CommentForm()
-    if form.validate_on_submit():
+    if current_user.is_authenticated and form.validate_on_submit():
         comment = Comment(text=form.comment.data, post_id=post.id,
                 user_id=current_user.id, username=current_user.username)
         db.session.add(comment)
+        post.change_comment_count(1)
         db.session.commit()
+        invalidate_pages()
         return redirect(url_for('item', post_id=post_id))
 
-    comments = Comment.query.filter_by(post_id=post.id)
+    comments = keyset_paginate(Comment.query.filter_by(post_id=post.id),
+            COMMENT_SORT, after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=app.config['COMMENTS_PER_PAGE'], descending=False)
+    next_url = url_for('item', post_id=post_id,
+            after=comments.next_cursor) if comments.has_next else None
+    prev_url = url_for('item', post_id=post_id,
+            before=comments.prev_cursor) if comments.has_prev else None
+
     user = post.author
+    load_vote_state([post])
     return render_template('item.html', user=user, post=post,
-            comments=comments, form=form, check_if_upvoted=check_if_upvoted,
+            comments=comments.items, form=form, next_url=next_url,
+            prev_url=prev_url, check_if_upvoted=check_if_upvoted,
             check_if_downvoted=check_if_downvoted)
 
 
@@ -131,8 +153,12 @@ def delete_comment(post_id, comment_id):
        for obvious reasons."""
     comment = Comment.query.filter_by(id=comment_id).first()
     if comment != None:
+        post = comment.post
         db.session.delete(comment)
+        if post != None:
+            post.change_comment_count(-1)
         db.session.commit()
+        invalidate_pages()
 
     return redirect(url_for('item', post_id=post_id))
 
@@ -142,8 +168,16 @@ def delete_post(post_id):
     """View function which deletes a post."""
     post = Post.query.filter_by(id=post_id).first()
     if post != None:
+        record_score_event(post.user_id, -(post.score or 0), POST_DELETED,
+                post.id)
+        update_event_stats(post.event_id, posts=-1, score=-(post.score or 0))
+        unindex_post(post.id)
         db.session.delete(post)
         db.session.commit()
+        get_fragment_cache().discard_post(int(post_id))
+        get_hot_feed().remove(int(post_id))
+        get_topic_feeds().remove(int(post_id))
+        invalidate_pages()
 
     return redirect(url_for('index'))
 
@@ -154,41 +188,15 @@ def vote(post_id):
        Voting is allowed anywhere as long as there is a post to vote on,
        as would be expected.
        
+       The vote itself is applied by submit_vote() in votebuffer.py.
        Uses another redirect_url() function which can be found in helpers.py"""
     post = Post.query.filter_by(id=post_id).first()
     if post != None:
-        if post.upvotes == None:
-            post.make_vote_int()
-            post.author.sum_post_scores()
-            db.session.commit()
-
-        if "upvote" in request.form and not check_if_upvoted(post, current_user):
-
-            post.upvotes = post.upvotes + 1
- 
-            current_user.upvoted_on.append(post)
-
-            if check_if_downvoted(post, current_user):
-                post.downvotes = post.downvotes - 1
-                current_user.downvoted_on.remove(post)
-
-            post.get_score()
-            post.set_hotness()
-            post.author.sum_post_scores()
-            db.session.commit()
-
-        if "downvote" in request.form and not check_if_downvoted(post, current_user):
-            post.downvotes = post.downvotes + 1
-            current_user.downvoted_on.append(post)
+        if "upvote" in request.form:
+            submit_vote(current_user, post, UPVOTE)
 
-            if check_if_upvoted(post, current_user):
-                post.upvotes = post.upvotes - 1
-                current_user.upvoted_on.remove(post)
-
-            post.get_score()
-            post.set_hotness()
-            post.author.sum_post_scores()
-            db.session.commit()
+        elif "downvote" in request.form:
+            submit_vote(current_user, post, DOWNVOTE)
 
     return redirect(redirect_url()) # Look at snippet 62
 
@@ -199,20 +207,12 @@ def give_importance(post_id):
        How this works is simple. A user would give a post importance,
        thus increasing the amount of time a post is visible/popular.
        
-       The catch is that the user then loses 5 of his/her own points."""
+       The catch is that the user then loses 5 of his/her own points,
+       which is recorded in the score ledger (see spend_importance() in
+       votes.py)."""
     post = Post.query.filter_by(id=post_id).first()
-    if post != None and not check_if_given_importance(post, current_user):
-
-        if post.importance == None:
-            post.make_importance_int()
-
-        post.importance = post.importance + 1
-
-        current_user.importance_debt = current_user.importance_debt + 5
-
-        current_user.given_importance_to.append(post)
-        current_user.scores = current_user.sum_post_scores()
-        db.session.commit()
+    if post != None and spend_importance(current_user, post):
+        post_changed(post.id, post.hotness)
 
     return redirect(redirect_url())
 
@@ -230,66 +230,122 @@ def search():
 
 @app.route('/search_result/<search_str>', methods=['GET'])
 def search_result(search_str):
-    """Makes a post_query and a topic_query which contains any posts with
-       similar names."""
-    post_query = Post.query.filter_by(title=search_str).all()
+    """Full-text searches the posts, best match first and a page at a time,
+       and also shows the topic and user with exactly that name."""
+    posts_page = search_posts(search_str, cursor=request.args.get('after'),
+            per_page=app.config['POSTS_PER_PAGE'])
+    post_query = posts_page.items
     topic_query = Topic.query.filter_by(tag_name=search_str).first()
     user_query = User.query.filter_by(username=search_str).first()
 
     post_with_topic = get_posts_from_topic(topic_query)
+    load_vote_state(post_query + list(post_with_topic))
 
-    for post in post_query:
-        post.set_age()
-
-    for post in post_with_topic:
-        post.set_age()
+    next_url = url_for('search_result', search_str=search_str,
+            after=posts_page.next_cursor) if posts_page.has_next else None
 
     return render_template('search_result.html', post_query=post_query,
-            posts=post_with_topic, user=user_query, check_if_upvoted=check_if_upvoted, check_if_downvoted=check_if_downvoted)
+            posts=post_with_topic, user=user_query, next_url=next_url,
+            check_if_upvoted=check_if_upvoted, check_if_downvoted=check_if_downvoted)
 
 @app.route('/search_topic/<topic_query>', methods=['GET'])
+@cached_page()
 def search_topic(topic_query):
-    """Shows a list of posts under the specific tag being queried."""
+    """Shows a list of posts under the specific tag being queried, hottest
+       first or, with ?sort=new, newest first.
+
+       Hot pages come from the topic's feed in hotfeed.py when it holds
+       them."""
     topic = Topic.query.filter_by(tag_name=topic_query).first()
-    return render_template('topic.html', topic=topic, check_if_upvoted=check_if_upvoted,
-            check_if_downvoted=check_if_downvoted)
+    sort = request.args.get('sort')
+    if sort not in POST_SORTS:
+        sort = 'hot'
+
+    posts, next_url, prev_url = [], None, None
+    if topic != None:
+        hot_feed = get_topic_feeds().get(topic.id) if sort == 'hot' else None
+        values = {'sort': sort} if sort != 'hot' else {}
+        page, next_url, prev_url = paginate_feed(topic_posts(topic),
+                POST_SORTS[sort], 'search_topic', hot_feed=hot_feed,
+                topic_query=topic_query, **values)
+        posts = page.items
+    return render_template('topic.html', topic=topic, posts=posts, check_if_upvoted=check_if_upvoted,
+            check_if_downvoted=check_if_downvoted, next_url=next_url, prev_url=prev_url, sort=sort)
 
 @app.route('/event/<event_query>', methods=['GET'])
+@cached_page()
 def search_event(event_query):
-    """Shows a list of events under the specific event being queried."""
-    event = Event.query.filter_by(event_name=event_query).first()
-    return render_template('event.html', event=event, check_if_upvoted=check_if_upvoted,
-            check_if_downvoted=check_if_downvoted)
+    """Shows a list of posts under the specific event being queried, hottest
+       first or, with ?sort=new, newest first, along with the event's
+       stats."""
+    event = Event.query.options(joinedload(Event.stats)).filter_by(
+            event_name=event_query).first()
+    sort = request.args.get('sort')
+    if sort not in POST_SORTS:
+        sort = 'hot'
+
+    posts, next_url, prev_url = [], None, None
+    if event != None:
+        values = {'sort': sort} if sort != 'hot' else {}
+        page, next_url, prev_url = paginate_feed(event_posts(event),
+                POST_SORTS[sort], 'search_event', event_query=event_query,
+                **values)
+        posts = page.items
+    return render_template('event.html', event=event, posts=posts, check_if_upvoted=check_if_upvoted,
+            check_if_downvoted=check_if_downvoted, next_url=next_url, prev_url=prev_url, sort=sort)
+
+@app.route('/events', methods=['GET'])
+@cached_page()
+def events():
+    """Shows the events voted on the most over the last hour, read from
+       their stats rather than their posts, see events.py."""
+    now = datetime.datetime.utcnow()
+    return render_template('events.html',
+            events=trending_events(app.config['TRENDING_EVENTS'], now),
+            now=now, estimate_recent_votes=estimate_recent_votes)
 
 @app.route('/faq', methods=['GET'])
+@cached_page(permanent=True)
 def faq():
     """Returns the faq html file."""
     return render_template('faq.html')
 
 @app.route('/contact', methods=['GET'])
+@cached_page(permanent=True)
 def contact():
     """Returns the contact html file."""
     return render_template('contact.html')
 
 @app.route('/rules', methods=['GET'])
+@cached_page(permanent=True)
 def rules():
     """Returns the rules html file."""
     # Should "be substantial" be a rule/motto?
     return render_template('rules.html')
 
 @app.route('/about', methods=['GET'])
+@cached_page(permanent=True)
 def about():
     """Returns the about html file."""
     return render_template('about.html')
 
 @app.route('/contributing', methods=['GET'])
+@cached_page(permanent=True)
 def contributing():
     """Returns the contributing html file."""
     return render_template('contributing.html')
 
 @app.route('/feature-request', methods=['GET'])
 def feature_request():
-    """Returns the feature_request html file."""
+    """Returns the feature_request html file, with the hottest posts of the
+       feature-request topic a page at a time."""
     topic = Topic.query.filter_by(tag_name="feature-request").first()
-
-    return render_template('feature-request.html', topic=topic, check_if_downvoted=check_if_downvoted, check_if_upvoted=check_if_upvoted)
+    posts, next_url, prev_url = [], None, None
+    if topic != None:
+        page, next_url, prev_url = paginate_feed(topic_posts(topic),
+                POST_SORTS['hot'], 'feature_request',
+                hot_feed=get_topic_feeds().get(topic.id))
+        posts = page.items
+
+    return render_template('feature-request.html', topic=topic, posts=posts, check_if_downvoted=check_if_downvoted, check_if_upvoted=check_if_upvoted,
+            next_url=next_url, prev_url=prev_url)
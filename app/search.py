@@ -0,0 +1,337 @@
+"""
+Full-text search over posts' titles, text, topics and event names.
+
+Two backends are available, picked by SEARCH_BACKEND:
+
+* fts5, an sqlite FTS5 virtual table kept next to the post table, ranked
+  with its built in bm25().
+* memory, an inverted index held by each process and built from the
+  database the first time it's searched. Used for databases without FTS5.
+
+Both match every word of the query as a prefix, rank matches with BM25
+(titles count the most) and page through results with a keyset cursor on
+(rank, post id). Posts are added and removed as they are submitted and
+deleted.
+"""
+import bisect
+import math
+import numbers
+import re
+import threading
+
+from flask import current_app
+from sqlalchemy import event, DDL
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload, selectinload
+from app import db
+from app.models import Post, feed_query
+from app.pagination import KeysetPage, encode_cursor, decode_cursor
+
+
+FIELDS = ('title', 'text', 'topics', 'event')
+# How much a match in each field counts for, titles being the most telling.
+FIELD_WEIGHTS = {'title': 10.0, 'text': 1.0, 'topics': 5.0, 'event': 5.0}
+CURSOR_COLUMNS = ('rank', 'id')
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Splits text into lower case words."""
+    return WORD_RE.findall((text or '').lower())
+
+
+def post_document(post):
+    """The searchable text of a post, one string per field."""
+    return {'title': post.title or '',
+            'text': post.text or '',
+            'topics': ' '.join(topic.tag_name for topic in post.topics),
+            'event': post.event.event_name if post.event else ''}
+
+
+def fts5_available(bind):
+    """Checks whether a connection or engine is sqlite with FTS5 built in."""
+    if bind.dialect.name != 'sqlite':
+        return False
+
+    # Temporary tables only exist on the connection which made them.
+    connection = bind.connect()
+    try:
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS '
+                'temp.fts5_probe USING fts5(x)')
+        connection.execute('DROP TABLE IF EXISTS temp.fts5_probe')
+    except OperationalError:
+        return False
+    finally:
+        connection.close()
+
+    return True
+
+
+CREATE_FTS_TABLE = ('CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING '
+        'fts5(title, text, topics, event)')
+
+# The FTS5 table and the shadow tables sqlite keeps its index in.
+FTS_TABLES = frozenset(['post_search'] + ['post_search_' + name for name in
+        ('data', 'idx', 'content', 'docsize', 'config')])
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keeps alembic's autogenerate from dropping the FTS5 tables, which
+       aren't models but are made by get_search_index()."""
+    return not (type_ == 'table' and name in FTS_TABLES)
+
+
+# Let db.create_all() and db.drop_all() look after the FTS5 table as well.
+event.listen(db.metadata, 'after_create', DDL(CREATE_FTS_TABLE).execute_if(
+        callable_=lambda ddl, target, bind, **kw: fts5_available(bind)))
+event.listen(db.metadata, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS post_search').execute_if(dialect='sqlite'))
+
+
+class FTS5Index(object):
+    """Search backend using an sqlite FTS5 table, whose rowids are post ids.
+       Changes go through db.session, so they commit along with the post."""
+
+    def add(self, post):
+        document = post_document(post)
+        self.remove(post.id)
+        db.session.execute('INSERT INTO post_search (rowid, title, text, '
+                'topics, event) VALUES (:id, :title, :text, :topics, :event)',
+                dict(document, id=post.id))
+
+    def remove(self, post_id):
+        db.session.execute('DELETE FROM post_search WHERE rowid = :id',
+                {'id': post_id})
+
+    def add_documents(self, documents):
+        """Adds many posts at once from {post id: post_document()}."""
+        if not documents:
+            return
+        db.session.execute('DELETE FROM post_search WHERE rowid = :id',
+                [{'id': post_id} for post_id in documents])
+        db.session.execute('INSERT INTO post_search (rowid, title, text, '
+                'topics, event) VALUES (:id, :title, :text, :topics, :event)',
+                [dict(document, id=post_id)
+                 for post_id, document in documents.items()])
+
+    def rebuild(self):
+        db.session.execute(CREATE_FTS_TABLE)
+        db.session.execute('DELETE FROM post_search')
+        for post in _all_posts():
+            self.add(post)
+        db.session.commit()
+
+    def search(self, query, cursor=None, per_page=10):
+        words = tokenize(query)
+        if not words:
+            return KeysetPage([], None)
+
+        # Every word is quoted so nothing typed can break the MATCH syntax.
+        match = ' '.join('"{}"*'.format(word) for word in words)
+        params = {'match': match, 'limit': per_page + 1}
+        params.update(('w_' + field, FIELD_WEIGHTS[field]) for field in FIELDS)
+
+        after = ''
+        values = decode_search_cursor(cursor)
+        if values != None:
+            after = 'WHERE rank > :rank OR (rank = :rank AND id > :id)'
+            params['rank'], params['id'] = values
+
+        rows = db.session.execute('SELECT id, rank FROM (SELECT rowid AS id, '
+                'bm25(post_search, :w_title, :w_text, :w_topics, :w_event) '
+                'AS rank FROM post_search WHERE post_search MATCH :match) '
+                + after + ' ORDER BY rank, id LIMIT :limit', params).fetchall()
+        return _page(rows, per_page)
+
+
+class MemoryIndex(object):
+    """Search backend keeping an inverted index in this process.
+
+    Parameters
+    ----------
+    postings : dict
+        For every term, the weighted number of times it's in each post.
+    terms : list
+        Every term, sorted so that prefixes can be found with bisect.
+    lengths : dict
+        The weighted number of words in each post.
+    loaded : bool
+        Whether the index has been built from the database yet."""
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = {}
+        self.terms = []
+        self.documents = {}
+        self.lengths = {}
+        self.loaded = False
+
+    def add(self, post):
+        with self.lock:
+            self._add(post.id, post_document(post))
+
+    def add_documents(self, documents):
+        with self.lock:
+            for post_id, document in documents.items():
+                self._add(post_id, document)
+
+    def _add(self, post_id, document):
+        self._remove(post_id)
+        counts = {}
+        for field in FIELDS:
+            for word in tokenize(document[field]):
+                counts[word] = counts.get(word, 0) + FIELD_WEIGHTS[field]
+
+        for term, count in counts.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                bisect.insort(self.terms, term)
+            self.postings[term][post_id] = count
+
+        self.documents[post_id] = counts
+        self.lengths[post_id] = sum(counts.values())
+
+    def remove(self, post_id):
+        with self.lock:
+            self._remove(post_id)
+
+    def _remove(self, post_id):
+        for term in self.documents.pop(post_id, {}):
+            postings = self.postings[term]
+            del postings[post_id]
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+        self.lengths.pop(post_id, None)
+
+    def rebuild(self):
+        with self.lock:
+            self.postings, self.terms = {}, []
+            self.documents, self.lengths = {}, {}
+            for post in _all_posts():
+                self._add(post.id, post_document(post))
+            self.loaded = True
+
+    def _prefixed(self, word):
+        start = bisect.bisect_left(self.terms, word)
+        for term in self.terms[start:]:
+            if not term.startswith(word):
+                break
+            yield term
+
+    def search(self, query, cursor=None, per_page=10):
+        words = tokenize(query)
+        if not words:
+            return KeysetPage([], None)
+
+        if not self.loaded:
+            self.rebuild()
+
+        with self.lock:
+            count = len(self.lengths)
+            average = float(sum(self.lengths.values())) / (count or 1)
+            scores = None
+            for word in words:
+                word_scores = {}
+                for term in self._prefixed(word):
+                    postings = self.postings[term]
+                    idf = math.log(1 + (count - len(postings) + 0.5) /
+                                   (len(postings) + 0.5))
+                    for post_id, tf in postings.items():
+                        norm = self.k1 * (1 - self.b + self.b *
+                                          self.lengths[post_id] / average)
+                        word_scores[post_id] = word_scores.get(post_id, 0) + \
+                                idf * tf * (self.k1 + 1) / (tf + norm)
+
+                # Every word has to match.
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = dict((post_id, score + word_scores[post_id])
+                                  for post_id, score in scores.items()
+                                  if post_id in word_scores)
+
+        # Same order as FTS5, where a lower rank is a better match.
+        rows = sorted((-score, post_id) for post_id, score in scores.items())
+        values = decode_search_cursor(cursor)
+        if values != None:
+            start = bisect.bisect_right(rows, tuple(values))
+            rows = rows[start:]
+
+        return _page([(post_id, rank) for rank, post_id in rows[:per_page + 1]],
+                per_page)
+
+
+def decode_search_cursor(cursor):
+    """Unpacks a (rank, post id) cursor, treating one which doesn't hold
+       numbers like no cursor at all, so a mangled url shows the first
+       page rather than failing."""
+    values = decode_cursor(cursor, CURSOR_COLUMNS)
+    if values == None:
+        return None
+
+    rank, post_id = values
+    if not isinstance(rank, numbers.Real) or isinstance(rank, bool) or \
+            not isinstance(post_id, int) or isinstance(post_id, bool):
+        return None
+    return values
+
+
+def _page(rows, per_page):
+    """Makes a KeysetPage of (post id, rank) rows, fetched one extra."""
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor([rows[-1][1], rows[-1][0]])
+
+    return KeysetPage([post_id for post_id, rank in rows], next_cursor)
+
+
+def _all_posts():
+    return Post.query.options(joinedload(Post.event),
+            selectinload(Post.topics)).yield_per(1000)
+
+
+def get_search_index():
+    """Returns the search backend for the current app, picking one the first
+       time it's asked for."""
+    extensions = current_app.extensions
+    if 'nuncio_search' not in extensions:
+        backend = current_app.config['SEARCH_BACKEND']
+        if backend == 'auto':
+            backend = 'fts5' if fts5_available(db.engine) else 'memory'
+        if backend == 'fts5':
+            # Databases made by `flask db upgrade` don't have the table yet.
+            db.engine.execute(CREATE_FTS_TABLE)
+            extensions['nuncio_search'] = FTS5Index()
+        else:
+            extensions['nuncio_search'] = MemoryIndex()
+
+    return extensions['nuncio_search']
+
+
+def index_post(post):
+    """Adds or updates a post in the search index."""
+    get_search_index().add(post)
+
+
+def unindex_post(post_id):
+    """Removes a post from the search index."""
+    get_search_index().remove(post_id)
+
+
+def search_posts(query, cursor=None, per_page=10):
+    """Searches the posts, returning a KeysetPage of Post objects, best
+       match first."""
+    page = get_search_index().search(query, cursor, per_page)
+    posts = {}
+    if page.items:
+        posts = dict((post.id, post) for post in
+                     feed_query().filter(Post.id.in_(page.items)))
+
+    page.items = [posts[post_id] for post_id in page.items if post_id in posts]
+    return page
@@ -0,0 +1,196 @@
+"""
+Fills a database with made up users, topics, events, posts, votes and
+comments, for benchmarks and trying the site out with realistic amounts of
+data. Run with `flask seed`, or see bench/bench_routes.py.
+
+Everything is written with Core bulk inserts, a chunk at a time, and the
+derived columns (vote counts, scores, comment counts, hotness, karma, event
+stats and the search index) are filled in afterwards for the seeded posts
+only, so seeding an existing database leaves its own rows alone.
+"""
+import datetime
+import random
+
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.security import generate_password_hash
+from app import db
+from app.database import sync_id_sequence
+from app.models import User, Post, Comment, Topic, Event, ScoreEvent, \
+        topics_table, upvoters_table, downvoters_table
+from app.ranking import recompute_hotness
+from app.karma import roll_up_scores, VOTE_RECEIVED
+from app.events import update_event_stats
+from app.search import get_search_index, post_document
+
+
+# How many post ids each hotness update and search index update covers,
+# within sqlite's limit on parameters.
+ID_CHUNK = 500
+
+# Every seeded user can log in with this password.
+SEED_PASSWORD = 'password'
+
+WORDS = ('election', 'budget', 'storm', 'football', 'vaccine', 'court',
+         'market', 'climate', 'strike', 'summit', 'satellite', 'festival',
+         'protest', 'merger', 'drought', 'verdict', 'launch', 'treaty')
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def insert_chunks(table, rows, chunk_size):
+    """Bulk inserts rows from an iterable, ``chunk_size`` at a time."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def seed(users=100, posts=1000, topics=20, events=10, votes=10000,
+         comments=2000, chunk_size=5000, random_seed=None):
+    """Adds made up rows on top of whatever the database already has, and
+       commits. Returns how many of each were added.
+
+       ``random_seed`` makes the same data every time it's given."""
+    rng = random.Random(random_seed)
+    if not users:
+        posts = 0
+    now = datetime.datetime.utcnow()
+    first_user, first_topic = next_id(User), next_id(Topic)
+    first_event, first_post = next_id(Event), next_id(Post)
+
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    insert_chunks(User.__table__, ({'id': first_user + i,
+            'username': 'user{}'.format(first_user + i),
+            'email': 'user{}@example.com'.format(first_user + i),
+            'password_hash': password_hash, 'scores': 0, 'importance_debt': 0}
+            for i in range(users)), chunk_size)
+    insert_chunks(Topic.__table__, ({'id': first_topic + i,
+            'tag_name': '{}-{}'.format(rng.choice(WORDS), first_topic + i)}
+            for i in range(topics)), chunk_size)
+    insert_chunks(Event.__table__, ({'id': first_event + i,
+            'event_name': '{} {}'.format(sentence(rng, 2), first_event + i)}
+            for i in range(events)), chunk_size)
+
+    user_ids = range(first_user, first_user + users)
+    post_ids = range(first_post, first_post + posts)
+    timestamps = {}
+
+    def post_rows():
+        for post_id in post_ids:
+            is_link = rng.random() < 0.5
+            timestamps[post_id] = now - datetime.timedelta(
+                    seconds=rng.randint(60, 30 * 24 * 3600))
+            yield {'id': post_id, 'title': sentence(rng, rng.randint(3, 8)),
+                   'text': sentence(rng, rng.randint(10, 60)),
+                   'link': 'https://example.com/{}'.format(post_id)
+                           if is_link else '',
+                   'is_link': is_link, 'user_id': rng.choice(user_ids),
+                   'event_id': first_event + rng.randrange(events)
+                               if events else None,
+                   'timestamp': timestamps[post_id],
+                   'upvotes': 0, 'downvotes': 0, 'score': 0,
+                   'importance': 10, 'version': 0, 'comment_count': 0}
+
+    insert_chunks(Post.__table__, post_rows(), chunk_size)
+    if topics:
+        insert_chunks(topics_table, ({'post_id': post_id,
+                'topic_id': first_topic + rng.randrange(topics)}
+                for post_id in post_ids), chunk_size)
+
+    # Each user votes on each post at most once, three quarters of them up.
+    cast = set()
+    upvotes, downvotes = [], []
+    for _ in range(min(votes, users * posts)):
+        while True:
+            key = (rng.choice(user_ids), rng.choice(post_ids))
+            if key not in cast:
+                break
+        cast.add(key)
+        if rng.random() < 0.75:
+            upvotes.append({'upvoter_id': key[0], 'post_id': key[1]})
+        else:
+            downvotes.append({'downvoter_id': key[0], 'post_id': key[1]})
+    insert_chunks(upvoters_table, upvotes, chunk_size)
+    insert_chunks(downvoters_table, downvotes, chunk_size)
+
+    def comment_rows():
+        for _ in range(comments):
+            user_id, post_id = rng.choice(user_ids), rng.choice(post_ids)
+            yield {'user_id': user_id, 'post_id': post_id,
+                   'username': 'user{}'.format(user_id),
+                   'text': sentence(rng, rng.randint(3, 20)),
+                   'timestamp': timestamps[post_id] + datetime.timedelta(
+                       seconds=rng.randint(1, 3600))}
+
+    if posts:
+        insert_chunks(Comment.__table__, comment_rows(), chunk_size)
+    for model in (User, Topic, Event, Post):
+        sync_id_sequence(db.session, model.__table__)
+
+    if posts:
+        fill_derived_columns(first_post, first_post + posts - 1)
+    return {'users': users, 'topics': topics, 'events': events,
+            'posts': posts, 'votes': len(cast),
+            'comments': comments if posts else 0}
+
+
+def fill_derived_columns(first_post, last_post):
+    """Works the counts, score and hotness of the posts with ids from
+       ``first_post`` to ``last_post`` out from their votes and comments,
+       then adds them to their authors' karma, their events' stats and the
+       search index, and commits. Rows which were already there are left
+       as they are."""
+    post_table = Post.__table__
+    comment_table = Comment.__table__
+    seeded = post_table.c.id.between(first_post, last_post)
+
+    def count(table):
+        return db.select([db.func.count(table.c.post_id)]).where(
+                table.c.post_id == post_table.c.id).as_scalar()
+
+    upvotes, downvotes = count(upvoters_table), count(downvoters_table)
+    db.session.execute(post_table.update().where(seeded).values(
+            upvotes=upvotes, downvotes=downvotes, score=upvotes - downvotes,
+            comment_count=count(comment_table)))
+    db.session.commit()
+
+    post_ids = list(range(first_post, last_post + 1))
+    for start in range(0, len(post_ids), ID_CHUNK):
+        recompute_hotness(post_ids=post_ids[start:start + ID_CHUNK])
+
+    totals, events = {}, {}
+    for user_id, event_id, score in db.session.query(Post.user_id,
+            Post.event_id, Post.score).filter(seeded):
+        totals[user_id] = totals.get(user_id, 0) + score
+        if event_id != None:
+            event_posts, event_score = events.get(event_id, (0, 0))
+            events[event_id] = (event_posts + 1, event_score + score)
+
+    score_events = [{'user_id': user_id, 'post_id': None,
+            'kind': VOTE_RECEIVED, 'delta': total, 'rolled_up': False}
+            for user_id, total in sorted(totals.items()) if total]
+    if score_events:
+        db.session.execute(ScoreEvent.__table__.insert(), score_events)
+    for event_id, (event_posts, event_score) in sorted(events.items()):
+        update_event_stats(event_id, posts=event_posts, score=event_score)
+    db.session.commit()
+    roll_up_scores()
+
+    index = get_search_index()
+    posts = Post.query.options(joinedload(Post.event),
+            selectinload(Post.topics)).filter(seeded).order_by(Post.id)
+    for start in range(first_post, last_post + 1, ID_CHUNK):
+        index.add_documents(dict((post.id, post_document(post)) for post in
+                posts.filter(Post.id < start + ID_CHUNK, Post.id >= start)))
+    db.session.commit()
+
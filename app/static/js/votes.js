@@ -0,0 +1,75 @@
+/*
+ * Votes and gives importance through the json api, so voting doesn't
+ * reload the whole page. The forms still work without javascript, and are
+ * submitted as usual whenever the api can't be used (e.g. logged out).
+ */
+(function () {
+    var ACTIVE = '-40px', INACTIVE = '0px';
+
+    function post(url, body, done, fail) {
+        var request = new XMLHttpRequest();
+        request.open('POST', url);
+        request.setRequestHeader('Content-Type', 'application/json');
+        request.onload = function () {
+            if (request.status === 200) {
+                done(JSON.parse(request.responseText));
+            } else {
+                fail();
+            }
+        };
+        request.onerror = fail;
+        request.send(JSON.stringify(body));
+    }
+
+    function submitForm(form, button) {
+        // form.submit() leaves out the clicked button, so add it back.
+        var input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = button.name;
+        form.appendChild(input);
+        form.submit();
+    }
+
+    function showState(container, state) {
+        var upvote = container.querySelector('input[name=upvote]');
+        var downvote = container.querySelector('input[name=downvote]');
+        var score = container.querySelector('.post-score');
+        if (upvote) {
+            upvote.style.backgroundPosition = state.upvoted ? ACTIVE : INACTIVE;
+        }
+        if (downvote) {
+            downvote.style.backgroundPosition = state.downvoted ? ACTIVE : INACTIVE;
+        }
+        if (score) {
+            score.textContent = state.score;
+        }
+    }
+
+    document.addEventListener('click', function (event) {
+        var button = event.target;
+        var form = button.form;
+        if (!form || !form.getAttribute('data-post-id')) {
+            return;
+        }
+
+        var postId = form.getAttribute('data-post-id');
+        var container = form.closest('[data-post]');
+        var url, body;
+        if (form.className === 'vote-form') {
+            url = '/api/posts/' + postId + '/vote';
+            body = {direction: button.name};
+        } else if (form.className === 'importance-form') {
+            url = '/api/posts/' + postId + '/importance';
+            body = {};
+        } else {
+            return;
+        }
+
+        event.preventDefault();
+        post(url, body, function (state) {
+            showState(container, state);
+        }, function () {
+            submitForm(form, button);
+        });
+    });
+})();
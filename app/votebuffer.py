@@ -0,0 +1,412 @@
+"""
+Write-behind buffering of votes, used when VOTE_DURABILITY is 'buffered'.
+
+Rather than every vote committing its own transaction on the post's row,
+votes are queued in memory and written every VOTE_FLUSH_INTERVAL
+milliseconds. Each flush is a single transaction with the net change for
+every post. Until then the votes are kept in an overlay, which
+check_if_upvoted() and friends read from, so voters see their own votes
+straight away. Other users see them after the flush.
+
+The queue holds at most VOTE_QUEUE_SIZE votes. A vote arriving at a full
+queue flushes it first, on a session of its own. The queue is also flushed
+when the process exits cleanly or is sent SIGTERM, which is how Heroku
+restarts it and which waitress doesn't handle itself. Votes still queued
+are lost if it's killed outright, which is the price of 'buffered' over
+the default 'strict'.
+"""
+import atexit
+import signal
+import sys
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.cache import post_changed, invalidate_pages
+from app.helpers import check_if_upvoted, check_if_downvoted
+from app.events import update_event_stats
+from app.hotfeed import get_hot_feed, get_topic_feeds
+from app.karma import record_score_event, VOTE_RECEIVED
+from app.models import User, Post
+from app.ranking import recompute_hotness
+from app.votes import cast_vote, UPVOTE, DOWNVOTE, VOTE_TABLES
+from app.worker import PeriodicWorker, start_worker
+
+
+class VoteBuffer(object):
+    """Votes waiting to be written, and how they change each post's counts.
+
+    Parameters
+    ----------
+    max_size : int
+        How many votes can be queued before a vote has to flush the queue.
+    votes : OrderedDict
+        The direction of every queued vote by (user id, post id). Only the
+        last vote of a user on a post is kept.
+    deltas : dict
+        For every post with queued votes, the [upvotes, downvotes] they add.
+    writing : dict
+        The votes taken out of the queue by the flush running now, by (user
+        id, post id), so voters still see them until they're committed.
+    written : dict
+        For every post in the latest flush, [version, upvotes, downvotes]:
+        what the flush adds, and the version the post's row has once the
+        flush is committed (None until it's known). A reader whose copy of
+        the post is older than that still counts the flushed votes from
+        here, so each vote is counted exactly once."""
+
+    def __init__(self, max_size):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.max_size = max_size
+        self.votes = OrderedDict()
+        self.deltas = {}
+        self.writing = {}
+        self.written = {}
+
+    def pending_vote(self, user_id, post_id):
+        """Returns (upvoted, downvoted) for a user's queued vote on a post,
+           or None if they have none queued."""
+        with self.lock:
+            direction = self.votes.get((user_id, post_id))
+            if direction == None:
+                direction = self.writing.get((user_id, post_id))
+        if direction == None:
+            return None
+
+        return direction == UPVOTE, direction == DOWNVOTE
+
+    def pending_deltas(self, post_id, version=None):
+        """Returns the (upvotes, downvotes) the queued votes add to a post
+           whose row is at ``version``. Without a version only the votes
+           which haven't been committed yet are counted."""
+        with self.lock:
+            upvotes, downvotes = self.deltas.get(post_id, (0, 0))
+            written = self.written.get(post_id)
+            if written != None and (written[0] == None or
+                    (version != None and version < written[0])):
+                upvotes += written[1]
+                downvotes += written[2]
+        return upvotes, downvotes
+
+    def add(self, user, post, direction):
+        """Queues a vote. Returns the change in the post's score it makes,
+           0 if the user had already voted that way.
+
+           A vote which would take the queue past max_size flushes it
+           first, from a thread of its own so the flush commits its own
+           session rather than the request's. If the queue is still full
+           after that the vote is written straight away."""
+        for attempt in range(2):
+            # Reads the overlay first, then the database.
+            upvoted = check_if_upvoted(post, user)
+            downvoted = check_if_downvoted(post, user)
+
+            with self.lock:
+                # Another request of the same user may have queued a vote on
+                # the post since the check, and the overlay is read again so
+                # it isn't counted twice.
+                pending = self.votes.get((user.id, post.id))
+                if pending != None or len(self.votes) < self.max_size:
+                    if pending != None:
+                        upvoted = pending == UPVOTE
+                        downvoted = pending == DOWNVOTE
+                    return self._queue(user.id, post.id, direction,
+                            upvoted, downvoted)
+
+            flush_votes(current_app._get_current_object(), thread=True)
+
+        delta = cast_vote(user, post, direction)
+        post_changed(post.id, post.hotness)
+        return delta
+
+    def _queue(self, user_id, post_id, direction, upvoted, downvoted):
+        """Queues a vote given the user's current vote on the post, with
+           the lock held."""
+        if direction == UPVOTE:
+            if upvoted:
+                return 0
+            upvotes_delta, downvotes_delta = 1, -int(downvoted)
+        else:
+            if downvoted:
+                return 0
+            upvotes_delta, downvotes_delta = -int(upvoted), 1
+
+        self.votes[(user_id, post_id)] = direction
+        deltas = self.deltas.setdefault(post_id, [0, 0])
+        deltas[0] += upvotes_delta
+        deltas[1] += downvotes_delta
+        return upvotes_delta - downvotes_delta
+
+    def flush(self):
+        """Writes every queued vote in one transaction. Returns the number
+           of votes written.
+
+           The votes move out of the queue into ``writing`` and
+           ``written`` first, and the posts' new versions are noted just
+           before the commit, so readers count each vote once whether they
+           read the post before or after the commit."""
+        with self.flush_lock:
+            with self.lock:
+                votes = list(self.votes.items())
+                self.writing = dict(self.votes)
+                self.written = dict((post_id, [None] + post_deltas)
+                        for post_id, post_deltas in self.deltas.items())
+                self.votes, self.deltas = OrderedDict(), {}
+            if not votes:
+                return 0
+
+            try:
+                post_ids = apply_votes([(user_id, post_id, direction)
+                        for (user_id, post_id), direction in votes],
+                        self.committing)
+            except IntegrityError:
+                # Someone voted through another process meanwhile, so go
+                # through the votes one at a time instead.
+                db.session.rollback()
+                post_ids = set(post_id for (user_id, post_id), _ in votes)
+                apply_votes_one_by_one(votes)
+                self.committing(dict(db.session.query(Post.id, Post.version)
+                        .filter(Post.id.in_(post_ids))))
+            except Exception:
+                self.requeue()
+                raise
+            finally:
+                with self.lock:
+                    self.writing = {}
+
+        if post_ids:
+            hot_feed, topic_feeds = get_hot_feed(), get_topic_feeds()
+            for post_id, hotness in db.session.query(Post.id,
+                    Post.hotness).filter(Post.id.in_(post_ids)):
+                hot_feed.update(post_id, hotness)
+                topic_feeds.update(post_id, hotness)
+            invalidate_pages()
+        return len(votes)
+
+    def committing(self, versions):
+        """Notes the {post id: version} the flushed posts will have once
+           committed. Posts left out weren't changed by the flush, so their
+           flushed votes stop counting straight away."""
+        with self.lock:
+            for post_id, written in self.written.items():
+                written[0] = versions.get(post_id, 0) or 0
+
+    def requeue(self):
+        """Puts the votes of a flush which failed back in the queue, behind
+           any the same users have made on the same posts since."""
+        with self.lock:
+            for key, direction in self.writing.items():
+                if key not in self.votes:
+                    self.votes[key] = direction
+            for post_id, (version, upvotes, downvotes) in self.written.items():
+                deltas = self.deltas.setdefault(post_id, [0, 0])
+                deltas[0] += upvotes
+                deltas[1] += downvotes
+            self.written = {}
+
+    def __len__(self):
+        return len(self.votes)
+
+
+def apply_votes(votes, committing=None):
+    """Writes a batch of (user id, post id, direction) votes in a single
+       transaction: the vote rows, each post's counters moved by its net
+       change, the authors' score events, the events' stats and the posts'
+       new hotness. ``committing`` is called with the {post id: version}
+       of the changed posts just before the commit.
+
+       Returns the ids of the posts which changed."""
+    post_ids = set(post_id for user_id, post_id, direction in votes)
+    user_ids = set(user_id for user_id, post_id, direction in votes)
+    authors, events = {}, {}
+    for post_id, user_id, event_id in db.session.query(Post.id, Post.user_id,
+            Post.event_id).filter(Post.id.in_(post_ids)):
+        authors[post_id] = user_id
+        events[post_id] = event_id
+
+    existing = {}
+    for direction, (table, user_column, opposite, opposite_user_column) \
+            in VOTE_TABLES.items():
+        existing[direction] = set(db.session.query(user_column,
+                table.c.post_id).filter(user_column.in_(user_ids),
+                table.c.post_id.in_(post_ids)))
+
+    inserts = {UPVOTE: [], DOWNVOTE: []}
+    deletes = {UPVOTE: [], DOWNVOTE: []}
+    post_deltas = {}
+    event_votes = {}
+    for user_id, post_id, direction in votes:
+        opposite = DOWNVOTE if direction == UPVOTE else UPVOTE
+        # Votes on posts deleted meanwhile, or already made, are dropped.
+        if post_id not in authors or (user_id, post_id) in existing[direction]:
+            continue
+
+        row = {'voter': user_id, 'voted_post': post_id}
+        inserts[direction].append(row)
+        event_votes[events[post_id]] = event_votes.get(events[post_id], 0) + 1
+        deltas = post_deltas.setdefault(post_id, {UPVOTE: 0, DOWNVOTE: 0})
+        deltas[direction] += 1
+        if (user_id, post_id) in existing[opposite]:
+            deletes[opposite].append(row)
+            deltas[opposite] -= 1
+
+    for direction, (table, user_column, opposite, opposite_user_column) \
+            in VOTE_TABLES.items():
+        if inserts[direction]:
+            db.session.execute(table.insert().values({
+                    user_column.name: bindparam('voter'),
+                    'post_id': bindparam('voted_post')}), inserts[direction])
+        if deletes[direction]:
+            db.session.execute(table.delete().where(
+                    (user_column == bindparam('voter')) &
+                    (table.c.post_id == bindparam('voted_post'))),
+                    deletes[direction])
+
+    if not post_deltas:
+        if committing != None:
+            committing({})
+        db.session.commit()
+        return set()
+
+    post_table = Post.__table__
+    upvotes = db.func.coalesce(post_table.c.upvotes, 0) + bindparam('up')
+    downvotes = db.func.coalesce(post_table.c.downvotes, 0) + bindparam('down')
+    db.session.execute(post_table.update()
+            .where(post_table.c.id == bindparam('changed_post'))
+            .values(upvotes=upvotes, downvotes=downvotes,
+                    score=upvotes - downvotes,
+                    version=db.func.coalesce(post_table.c.version, 0) + 1),
+            [{'changed_post': post_id, 'up': deltas[UPVOTE],
+              'down': deltas[DOWNVOTE]}
+             for post_id, deltas in post_deltas.items()])
+
+    event_scores = {}
+    for post_id, deltas in post_deltas.items():
+        delta = deltas[UPVOTE] - deltas[DOWNVOTE]
+        record_score_event(authors[post_id], delta, VOTE_RECEIVED, post_id)
+        event_scores[events[post_id]] = \
+                event_scores.get(events[post_id], 0) + delta
+
+    for event_id, count in event_votes.items():
+        update_event_stats(event_id, score=event_scores.get(event_id, 0),
+                votes=count)
+
+    if committing != None:
+        committing(dict(db.session.query(Post.id, Post.version)
+                .filter(Post.id.in_(list(post_deltas)))))
+
+    # Writing the new hotness commits the whole batch.
+    recompute_hotness(post_ids=list(post_deltas))
+    return set(post_deltas)
+
+
+def apply_votes_one_by_one(votes):
+    """Writes queued votes with cast_vote(), each in its own transaction."""
+    for (user_id, post_id), direction in votes:
+        user = User.query.get(user_id)
+        post = Post.query.get(post_id)
+        if user != None and post != None:
+            cast_vote(user, post, direction)
+
+
+def get_vote_buffer():
+    """Returns the vote buffer of the current app, making it the first time
+       it's asked for."""
+    extensions = current_app.extensions
+    if 'nuncio_votes' not in extensions:
+        extensions['nuncio_votes'] = VoteBuffer(
+                current_app.config['VOTE_QUEUE_SIZE'])
+
+    return extensions['nuncio_votes']
+
+
+def pending_deltas(post):
+    """Returns the (upvotes, downvotes) still queued for a post, which its
+       row as loaded doesn't count yet."""
+    buffer = current_app.extensions.get('nuncio_votes')
+    if buffer == None:
+        return (0, 0)
+
+    return buffer.pending_deltas(post.id, post.version or 0)
+
+
+def flush_votes(app, thread=False):
+    """Flushes the app's vote buffer, if it has one, logging rather than
+       raising errors. With ``thread`` the flush runs in a thread of its
+       own, waited for, so it has a session of its own too."""
+    if thread:
+        flusher = threading.Thread(target=flush_votes, args=(app,),
+                name='vote-flush')
+        flusher.start()
+        flusher.join()
+        return
+
+    with app.app_context():
+        buffer = app.extensions.get('nuncio_votes')
+        try:
+            if buffer != None:
+                buffer.flush()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Failed to flush votes')
+        finally:
+            db.session.remove()
+
+
+def flush_on_sigterm(app):
+    """Makes SIGTERM flush the vote buffer before the process exits, since
+       by default it exits straight away without running atexit. Signal
+       handlers can only be set from the main thread, so this is called
+       when the app is made."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def flush_and_exit(signum, frame):
+        flush_votes(app)
+        if callable(previous):
+            previous(signum, frame)
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, flush_and_exit)
+
+
+def submit_vote(user, post, direction):
+    """Votes a post up or down for a user, either straight away or through
+       the vote buffer depending on VOTE_DURABILITY.
+
+       Returns the change in the post's score, 0 if nothing changed."""
+    if current_app.config['VOTE_DURABILITY'] == 'buffered':
+        return get_vote_buffer().add(user, post, direction)
+
+    delta = cast_vote(user, post, direction)
+    post_changed(post.id, post.hotness)
+    return delta
+
+
+class VoteFlusher(PeriodicWorker):
+    """Thread which flushes the vote buffer every VOTE_FLUSH_INTERVAL
+       milliseconds, and once more when the process exits."""
+
+    thread_name = 'vote-flusher'
+    failure_message = 'Failed to flush votes'
+
+    def work(self):
+        get_vote_buffer().flush()
+
+    def start(self):
+        super(VoteFlusher, self).start()
+        atexit.register(self.run_once)
+
+
+def start_vote_flusher():
+    """Starts the flushing thread for the current app, only once per
+       process. Never started while testing, the tests flush the buffer
+       themselves."""
+    return start_worker(VoteFlusher,
+            current_app.config['VOTE_FLUSH_INTERVAL'] / 1000.0)
@@ -0,0 +1,126 @@
+"""
+Code used to apply votes and importance on posts, shared by the form views
+in routes.py and the JSON api.
+
+Every change is made with SQL-side arithmetic (upvotes = upvotes + 1) in a
+single transaction, so concurrent votes on the same post can't overwrite
+each other, and the author's score is moved by the vote's delta (through
+the ledger in karma.py) rather than summed up again from all of their posts. The
+post's event gets the vote too, see events.py.
+"""
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.events import update_event_stats
+from app.helpers import check_if_given_importance
+from app.karma import record_score_event, VOTE_RECEIVED, IMPORTANCE_SPENT, \
+        IMPORTANCE_COST
+from app.models import User, Post, upvoters_table, downvoters_table
+
+
+UPVOTE = 'upvote'
+DOWNVOTE = 'downvote'
+
+# For each direction: the table the vote goes in, its user column, the table
+# of the opposite vote and its user column.
+VOTE_TABLES = {
+    UPVOTE: (upvoters_table, upvoters_table.c.upvoter_id,
+             downvoters_table, downvoters_table.c.downvoter_id),
+    DOWNVOTE: (downvoters_table, downvoters_table.c.downvoter_id,
+               upvoters_table, upvoters_table.c.upvoter_id),
+}
+
+
+def cast_vote(user, post, direction):
+    """Votes a post up or down for a user, taking back their opposite vote
+       if they had one. Voting the same way twice does nothing.
+
+       Returns the change in the post's score, 0 if nothing changed."""
+    table, user_column, opposite, opposite_user_column = VOTE_TABLES[direction]
+    post_id = post.id
+    author_id = post.user_id
+    event_id = post.event_id
+
+    try:
+        db.session.execute(table.insert().values(
+                {user_column.name: user.id, 'post_id': post_id}))
+    except IntegrityError:
+        # Already voted this way, possibly from another thread just now.
+        db.session.rollback()
+        return 0
+
+    flipped = db.session.execute(opposite.delete().where(
+            (opposite_user_column == user.id) &
+            (opposite.c.post_id == post_id))).rowcount
+
+    if direction == UPVOTE:
+        upvotes_delta, downvotes_delta = 1, -flipped
+    else:
+        upvotes_delta, downvotes_delta = -flipped, 1
+    delta = upvotes_delta - downvotes_delta
+
+    apply_post_deltas(post_id, upvotes_delta, downvotes_delta)
+    record_score_event(author_id, delta, VOTE_RECEIVED, post_id)
+    update_event_stats(event_id, score=delta, votes=1)
+
+    db.session.commit()
+    return delta
+
+
+def apply_post_deltas(post_id, upvotes_delta, downvotes_delta):
+    """Moves a post's vote counters in SQL and bumps its version, then
+       rewrites its hotness from the new counts. Doesn't commit."""
+    post_table = Post.__table__
+    upvotes = db.func.coalesce(post_table.c.upvotes, 0)
+    downvotes = db.func.coalesce(post_table.c.downvotes, 0)
+    db.session.execute(post_table.update()
+            .where(post_table.c.id == post_id)
+            .values(upvotes=upvotes + upvotes_delta,
+                    downvotes=downvotes + downvotes_delta,
+                    score=(upvotes + upvotes_delta) -
+                          (downvotes + downvotes_delta),
+                    version=db.func.coalesce(post_table.c.version, 0) + 1))
+
+    rewrite_hotness(post_id)
+
+
+def rewrite_hotness(post_id):
+    """Writes a post's hotness from the counts just written to its row.
+       Doesn't commit.
+
+       Hotness needs log(), which not every database has, so it is worked
+       out here, still inside the same transaction."""
+    post_table = Post.__table__
+    post = db.session.query(Post).populate_existing().get(post_id)
+    db.session.execute(post_table.update()
+            .where(post_table.c.id == post_id)
+            .values(hotness=post.calculate_hotness()))
+
+
+
+def spend_importance(user, post):
+    """Gives a post importance on behalf of a user, which makes the post
+       stay hot for longer and costs the user IMPORTANCE_COST points.
+       Each user can only do this once per post.
+
+       Returns whether importance was given."""
+    if check_if_given_importance(post, user):
+        return False
+
+    post_table = Post.__table__
+    importance = db.func.coalesce(post_table.c.importance, 10)
+    db.session.execute(post_table.update()
+            .where(post_table.c.id == post.id)
+            .values(importance=importance + 1,
+                    version=db.func.coalesce(post_table.c.version, 0) + 1))
+    rewrite_hotness(post.id)
+
+    user_table = User.__table__
+    db.session.execute(user_table.update()
+            .where(user_table.c.id == user.id)
+            .values(importance_debt=db.func.coalesce(
+                    user_table.c.importance_debt, 0) + IMPORTANCE_COST))
+    user.given_importance_to.append(post)
+    record_score_event(user.id, -IMPORTANCE_COST, IMPORTANCE_SPENT, post.id)
+
+    db.session.commit()
+    return True
@@ -0,0 +1,68 @@
+"""
+Background threads doing some work every few seconds, like ranking posts
+(see ranking.py) and flushing buffered votes (see votebuffer.py).
+"""
+import threading
+
+from flask import current_app
+from app import db
+
+
+class PeriodicWorker(threading.Thread):
+    """Thread which calls work() every ``interval`` seconds inside an app
+    context. Subclasses set thread_name and failure_message and do the work.
+
+    Parameters
+    ----------
+    app : Flask
+        The application, needed to push an app context inside the thread.
+    interval : float
+        The number of seconds to wait between each run."""
+
+    thread_name = 'worker'
+    failure_message = 'Background work failed'
+
+    def __init__(self, app, interval):
+        super(PeriodicWorker, self).__init__(name=self.thread_name)
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.run_once()
+            self.stopped.wait(self.interval)
+
+    def run_once(self):
+        """Does the work once, logging rather than dying on errors."""
+        with self.app.app_context():
+            try:
+                self.work()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(self.failure_message)
+            finally:
+                db.session.remove()
+
+    def work(self):
+        raise NotImplementedError
+
+    def stop(self):
+        self.stopped.set()
+
+
+_workers = {}
+
+def start_worker(worker_class, interval):
+    """Starts a worker_class thread for the current app, only once per
+       process. Never started while testing, the tests do the work
+       themselves. Returns the running worker, or None while testing."""
+    app = current_app._get_current_object()
+    worker = _workers.get(worker_class)
+    if app.testing or (worker != None and worker.is_alive()):
+        return worker
+
+    worker = _workers[worker_class] = worker_class(app, interval)
+    worker.start()
+    return worker
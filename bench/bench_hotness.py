@@ -0,0 +1,101 @@
+"""
+Benchmarks the bulk hotness engine in app/ranking.py against the path it
+replaced: the index view's loop, which set each Post's hotness with the
+power formula and committed once per post. Both use the power formula.
+
+Run from the nuncio directory:
+
+    $ python bench/bench_hotness.py --sizes 10000 100000
+
+The old path commits once per post, so it takes minutes past 100k posts.
+
+A throwaway sqlite database is used, so app.db is never touched.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['RANKING_WORKER'] = 'off'
+
+from app import app, db
+from app.models import Post, power_hotness
+from app import ranking
+
+
+def seed_posts(count, chunk_size=50000):
+    """Bulk inserts ``count`` posts with random votes and ages."""
+    now = datetime.datetime.utcnow()
+    post_table = Post.__table__
+    for start in range(0, count, chunk_size):
+        rows = []
+        for _ in range(start, min(start + chunk_size, count)):
+            rows.append({'title': 'Title', 'text': 'Text',
+                    'upvotes': random.randint(0, 50),
+                    'downvotes': random.randint(0, 10),
+                    'importance': random.randint(10, 15),
+                    'timestamp': now - datetime.timedelta(
+                        seconds=random.randint(60, 30 * 24 * 3600))})
+        db.session.execute(post_table.insert(), rows)
+    db.session.commit()
+
+
+def per_object(now):
+    """The old path: one Post object at a time, committed one by one, each
+       commit expiring every post so the next one is loaded again."""
+    for post in Post.query.order_by(Post.hotness.desc()).all():
+        seconds = (now - post.timestamp).total_seconds()
+        post.hotness = power_hotness(post.upvotes - post.downvotes,
+                post.importance, seconds)
+        db.session.commit()
+
+
+def bulk(now):
+    ranking.recompute_hotness(now)
+
+
+def timed(func, now):
+    db.session.remove()
+    start = time.time()
+    func(now)
+    elapsed = time.time() - start
+    db.session.remove()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+            default=[10000, 100000])
+    args = parser.parse_args()
+    app.config['HOTNESS_FORMULA'] = 'power'
+
+    print('numpy: {}'.format('yes' if ranking.numpy is not None else 'no'))
+    print('{:>10} {:>12} {:>12} {:>8}'.format('posts', 'per-object', 'bulk',
+            'speedup'))
+
+    for size in args.sizes:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        try:
+            with app.app_context():
+                db.create_all()
+                seed_posts(size)
+                now = datetime.datetime.utcnow()
+                slow = timed(per_object, now)
+                fast = timed(bulk, now)
+                db.get_engine().dispose()
+        finally:
+            os.remove(path)
+
+        print('{:>10} {:>11.2f}s {:>11.2f}s {:>7.1f}x'.format(size, slow,
+                fast, slow / fast))
+
+
+if __name__ == '__main__':
+    main()
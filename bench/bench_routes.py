@@ -0,0 +1,371 @@
+"""
+Benchmarks the main routes on a seeded database, first through the Flask
+test client and then over HTTP against waitress, with several threads.
+
+Run from the nuncio directory:
+
+    $ python bench/bench_routes.py --posts 10000 --output after.json
+    $ python bench/bench_routes.py --posts 10000 --compare after.json
+
+For every route it reports p50/p95/p99 latency, throughput and the number of
+SQL statements each request ran, and saves them as JSON so runs can be
+compared. Reads are made logged out, votes and submissions logged in.
+A throwaway sqlite database is used, so app.db is never touched.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, \
+        HTTPRedirectHandler
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ['RANKING_WORKER'] = 'off'
+
+from flask import request
+from sqlalchemy import event
+from waitress import create_server
+
+from app import app, db
+from app.seed import seed, WORDS, SEED_PASSWORD
+
+
+# name: (method, logged in)
+ROUTES = [
+    ('index', 'GET', False),
+    ('item', 'GET', False),
+    ('vote', 'POST', True),
+    ('search_result', 'GET', False),
+    ('user', 'GET', False),
+    ('submit', 'POST', True),
+]
+
+
+class Workload(object):
+    """Makes the path and form of each request, for a seeded database."""
+
+    def __init__(self, counts, rng):
+        self.counts = counts
+        self.rng = rng
+
+    def request(self, route):
+        """Returns (path, form data or None) for a request to ``route``."""
+        rng = self.rng
+        post_id = rng.randint(1, self.counts['posts'])
+        if route == 'index':
+            return '/index', None
+        if route == 'item':
+            return '/item/{}'.format(post_id), None
+        if route == 'vote':
+            return '/vote/{}'.format(post_id), \
+                    {rng.choice(['upvote', 'downvote']): ''}
+        if route == 'search_result':
+            return '/search_result/{}'.format(rng.choice(WORDS)), None
+        if route == 'user':
+            return '/user/user{}'.format(rng.randint(1, self.counts['users'])), None
+        if route == 'submit':
+            return '/submit', {'title': 'Benchmark post', 'text': 'Text',
+                    'link': '', 'topics': 'bench', 'event': 'Bench'}
+        raise ValueError(route)
+
+
+class StatementCounter(object):
+    """Counts the SQL statements run by each request on the server side,
+       by the url rule it matched."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def install(self, app, engine):
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def on_execute(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def before_request(self):
+        self.local.count = 0
+
+    def after_request(self, response):
+        rule = request.url_rule.endpoint if request.url_rule else None
+        with self.lock:
+            self.counts.setdefault(rule, []).append(
+                    getattr(self.local, 'count', 0))
+        return response
+
+    def take(self, route):
+        """Returns and forgets the counts recorded for a route."""
+        with self.lock:
+            return self.counts.pop(route, [])
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of already sorted values."""
+    if not values:
+        return None
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarise(latencies, errors, elapsed, statements):
+    latencies = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000, 3) \
+            if value != None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': milliseconds(percentile(latencies, 50)),
+        'p95_ms': milliseconds(percentile(latencies, 95)),
+        'p99_ms': milliseconds(percentile(latencies, 99)),
+        'mean_ms': milliseconds(sum(latencies) / len(latencies))
+                   if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 2)
+                          if elapsed else None,
+        'sql_per_request': round(float(sum(statements)) / len(statements), 2)
+                           if statements else None,
+        'sql_max': max(statements) if statements else None,
+    }
+
+
+def run_test_client(workload, counter, requests):
+    """Runs every route ``requests`` times in a row through the test client."""
+    anonymous, logged_in = app.test_client(), app.test_client()
+    logged_in.post('/auth/login', data={'username': 'user1',
+            'password': SEED_PASSWORD})
+    counter.take('auth.login')
+
+    results = {}
+    for route, method, needs_login in ROUTES:
+        client = logged_in if needs_login else anonymous
+        latencies, errors = [], 0
+        started = time.time()
+        for _ in range(requests):
+            path, data = workload.request(route)
+            start = time.time()
+            if method == 'GET':
+                response = client.get(path)
+            else:
+                response = client.post(path, data=data)
+            latencies.append(time.time() - start)
+            if response.status_code >= 400:
+                errors += 1
+        results[route] = summarise(latencies, errors, time.time() - started,
+                counter.take(route))
+    return results
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Stops urllib following redirects, so only the request itself is
+       timed."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def open_session(base_url, login):
+    opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect())
+    if login:
+        fetch(opener, base_url + '/auth/login', {'username': login,
+                'password': SEED_PASSWORD})
+    return opener
+
+
+def fetch(opener, url, data=None):
+    """Makes one request, returning whether it succeeded. Redirects are
+       counted as successes."""
+    body = urlencode(data).encode('utf-8') if data != None else None
+    try:
+        response = opener.open(url, body)
+        response.read()
+        response.close()
+        return True
+    except HTTPError as error:
+        error.close()
+        return error.code < 400
+
+
+def run_http(workload, counter, requests, threads):
+    """Runs every route ``requests`` times over HTTP, from ``threads``
+       client threads at once, against waitress with as many threads."""
+    # Every request queued behind a busy thread would be logged otherwise.
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+    server_thread = threading.Thread(target=server.run, name='waitress')
+    server_thread.daemon = True
+    server_thread.start()
+    base_url = 'http://127.0.0.1:{}'.format(server.effective_port)
+
+    sessions = [(open_session(base_url, None),
+                 open_session(base_url, 'user{}'.format(
+                     i % workload.counts['users'] + 1)))
+                for i in range(threads)]
+    counter.take('auth.login')
+
+    results = {}
+    try:
+        for route, method, needs_login in ROUTES:
+            latencies, errors = [], [0]
+            lock = threading.Lock()
+            share = [requests // threads + (1 if i < requests % threads else 0)
+                     for i in range(threads)]
+            # Each thread gets its own workload so they don't share a
+            # random number generator.
+            workloads = [Workload(workload.counts, random.Random(
+                    workload.rng.random())) for _ in range(threads)]
+
+            def worker(index):
+                opener = sessions[index][1 if needs_login else 0]
+                for _ in range(share[index]):
+                    path, data = workloads[index].request(route)
+                    start = time.time()
+                    ok = fetch(opener, base_url + path,
+                            data if method == 'POST' else None)
+                    elapsed = time.time() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        if not ok:
+                            errors[0] += 1
+
+            workers = [threading.Thread(target=worker, args=(i,))
+                       for i in range(threads)]
+            started = time.time()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            results[route] = summarise(latencies, errors[0],
+                    time.time() - started, counter.take(route))
+    finally:
+        server.task_dispatcher.shutdown()
+        server.close()
+
+    return results
+
+
+def compare(old, new):
+    """Prints how p95 latency and throughput moved since an older report."""
+    print('\nChange since the compared report:')
+    print('{:<12} {:<14} {:>12} {:>12}'.format('mode', 'route', 'p95',
+            'throughput'))
+    for mode, routes in sorted(new['modes'].items()):
+        for route, stats in sorted(routes.items()):
+            before = old.get('modes', {}).get(mode, {}).get(route)
+            if not before or not before['p95_ms'] or \
+                    not before['throughput_rps']:
+                continue
+            print('{:<12} {:<14} {:>+11.1f}% {:>+11.1f}%'.format(mode, route,
+                    100.0 * (stats['p95_ms'] - before['p95_ms']) /
+                    before['p95_ms'],
+                    100.0 * (stats['throughput_rps'] -
+                             before['throughput_rps']) /
+                    before['throughput_rps']))
+
+
+def print_results(mode, results):
+    print('\n{}'.format(mode))
+    print('{:<14} {:>9} {:>9} {:>9} {:>10} {:>8} {:>7}'.format('route',
+            'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql', 'errors'))
+    for route, method, needs_login in ROUTES:
+        stats = results[route]
+        print('{:<14} {:>9} {:>9} {:>9} {:>10} {:>8} {:>7}'.format(route,
+                stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                stats['throughput_rps'], stats['sql_per_request'],
+                stats['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--votes', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200,
+            help='Requests per route, in each mode.')
+    parser.add_argument('--threads', type=int, default=8,
+            help='Client and waitress threads in the HTTP mode.')
+    parser.add_argument('--modes', nargs='+', default=['test_client', 'http'],
+            choices=['test_client', 'http'])
+    parser.add_argument('--page-cache-ttl', type=int,
+            help='Overrides PAGE_CACHE_TTL, 0 renders every page.')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='Where to save the JSON report.')
+    parser.add_argument('--compare', help='An older JSON report to compare '
+            'this run with.')
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['WTF_CSRF_ENABLED'] = False
+    if args.page_cache_ttl != None:
+        app.config['PAGE_CACHE_TTL'] = args.page_cache_ttl
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'settings': {'requests': args.requests, 'threads': args.threads,
+                     'page_cache_ttl': app.config['PAGE_CACHE_TTL'],
+                     'vote_durability': app.config['VOTE_DURABILITY']},
+        'modes': {},
+    }
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.time()
+            counts = seed(users=args.users, posts=args.posts,
+                    topics=args.topics, events=args.events, votes=args.votes,
+                    comments=args.comments, random_seed=args.random_seed)
+            db.session.remove()
+            print('Seeded {} in {:.1f}s.'.format(', '.join('{} {}'.format(
+                    value, name) for name, value in sorted(counts.items())),
+                    time.time() - start))
+            report['seed'] = counts
+
+            counter = StatementCounter()
+            counter.install(app, db.engine)
+            workload = Workload(counts, random.Random(args.random_seed))
+            for mode in args.modes:
+                if mode == 'test_client':
+                    results = run_test_client(workload, counter, args.requests)
+                else:
+                    results = run_http(workload, counter, args.requests,
+                            args.threads)
+                report['modes'][mode] = results
+                print_results(mode, results)
+
+            db.session.remove()
+            db.get_engine().dispose()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print('\nSaved the report to {}.'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as old:
+            compare(json.load(old), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,5 +8,74 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
             'sqlite:///' + os.path.join(base_dir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # GET requests read from DATABASE_READ_URL when it's set, see
+    # app/database.py.
+    SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_READ_URL']} \
+            if os.environ.get('DATABASE_READ_URL') else None
+    # Pool sizes for server databases like postgres, their defaults if unset.
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 0) \
+            or None
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW')
+            or 0) or None
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT')
+            or 0) or None
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE')
+            or 0) or None
+    # How each SQLite connection is set up, leave one empty to skip it.
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 8)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+    # In milliseconds.
+    SQLITE_BUSY_TIMEOUT = os.environ.get('SQLITE_BUSY_TIMEOUT', '5000')
+    # In bytes, 256MB.
+    SQLITE_MMAP_SIZE = os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))
+    # Negative sizes are in KB, so 64MB.
+    SQLITE_CACHE_SIZE = os.environ.get('SQLITE_CACHE_SIZE', '-65536')
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
     POSTS_PER_PAGE = 10
+    COMMENTS_PER_PAGE = 50
+
+    # 'thread' recomputes hotness inside the web process, anything else
+    # expects `flask rank-posts --loop` to be run as a separate process.
+    RANKING_WORKER = os.environ.get('RANKING_WORKER') or 'thread'
+    RANKING_INTERVAL = int(os.environ.get('RANKING_INTERVAL') or 60)
+    # 'log' ranks in log-space, 'power' is the original formula.
+    HOTNESS_FORMULA = os.environ.get('HOTNESS_FORMULA') or 'log'
+    # 'fts5', 'memory' or 'auto' to use fts5 whenever sqlite has it.
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    # How many characters of rendered post HTML to cache, see app/cache.py.
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or
+            8 * 1024 * 1024)
+    # How long logged out visitors are shown the same page for, in seconds.
+    # Set to 0 to render every page afresh.
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 30)
+    PAGE_CACHE_PAGES = int(os.environ.get('PAGE_CACHE_PAGES') or 1000)
+    # How many of the hottest posts each process keeps in order, see
+    # app/hotfeed.py.
+    HOT_FEED_SIZE = int(os.environ.get('HOT_FEED_SIZE') or 1000)
+    # The same for the TOPIC_FEEDS most read topics, TOPIC_FEED_SIZE each.
+    TOPIC_FEEDS = int(os.environ.get('TOPIC_FEEDS') or 100)
+    TOPIC_FEED_SIZE = int(os.environ.get('TOPIC_FEED_SIZE') or 100)
+    # How many events the trending events page lists.
+    TRENDING_EVENTS = int(os.environ.get('TRENDING_EVENTS') or 20)
+    # 'strict' commits every vote as it's made. 'buffered' queues votes in
+    # memory and writes them in batches every VOTE_FLUSH_INTERVAL
+    # milliseconds, losing the queued votes if the process dies.
+    VOTE_DURABILITY = os.environ.get('VOTE_DURABILITY') or 'strict'
+    VOTE_FLUSH_INTERVAL = int(os.environ.get('VOTE_FLUSH_INTERVAL') or 200)
+    VOTE_QUEUE_SIZE = int(os.environ.get('VOTE_QUEUE_SIZE') or 10000)
+    # The most rows an api list endpoint returns per page.
+    API_MAX_PER_PAGE = int(os.environ.get('API_MAX_PER_PAGE') or 100)
+    # Serves per-endpoint request and SQL metrics on /metrics, and logs
+    # requests slower than SLOW_REQUEST_MS with their statements, see
+    # app/metrics.py. 0 turns the log off.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') not in \
+            ('0', 'false')
+    SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS') or 0)
+    # Logs statements of the same shape run this many times by one request,
+    # like a lazy load for every post of a feed. Meant for development, 0
+    # turns it off.
+    REPEATED_QUERY_THRESHOLD = int(os.environ.get('REPEATED_QUERY_THRESHOLD')
+            or 0)
+    # Keeps restplus from listing every route in 404 messages.
+    ERROR_404_HELP = False
@@ -1,5 +1,8 @@
 from test_users import UserTestCase
 from test_posts import PostTestCase
+from test_routes import RoutesTestCase
+from test_api import ApiTestCase
+from test_database import DatabaseTestCase, ReplicaRoutesTestCase
 import unittest
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+import unittest
+import sys
+import os
+import json
+from datetime import datetime
+
+from flask_testing import TestCase
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import create_app, db
+from app.models import Post, Topic, Event, Comment, User
+from app.metrics import metrics
+
+
+class ApiTestCase(TestCase):
+    def create_app(self):
+        """Creates an app object for testing purposes."""
+        app = create_app()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unittest.db'
+        return app
+
+    def setUp(self):
+        """Sets up a test database with a user, 12 of their posts and a
+           comment."""
+        db.create_all()
+        self.user = User(username="John", email="example@example.com")
+        self.user.set_password("password")
+        db.session.add(self.user)
+        db.session.commit()
+
+        topic, event = Topic(tag_name="topic1"), Event(event_name="Test")
+        for i in range(12):
+            post = Post(title="Title {}".format(i), text="Text",
+                    user_id=self.user.id, topics=[topic] if i % 2 else [],
+                    event=event, timestamp=datetime(2018, 6, 29, 10, i))
+            post.hotness = i % 5
+            db.session.add(post)
+        db.session.add(Comment(text="Comment", post_id=1, user_id=self.user.id,
+                username="John"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Removes all objects from the database."""
+        db.session.remove()
+        db.drop_all()
+
+    def test_posts_are_paginated(self):
+        """Tests whether posts page by hotness with cursors, each post
+           exactly once."""
+        items, url = [], '/api/posts/?limit=5&fields=id,hotness'
+        while True:
+            page = self.client.get(url).json
+            items += page['items']
+            if page['next'] == None:
+                break
+            url = '/api/posts/?limit=5&fields=id,hotness&after=' + page['next']
+
+        self.assertEqual(len(items), 12)
+        self.assertEqual(len(set(item['id'] for item in items)), 12)
+        self.assertEqual(sorted(items, key=lambda item: (item['hotness'],
+                item['id']), reverse=True), items)
+        self.assertEqual(set(items[0]), set(['id', 'hotness']))
+
+        back = self.client.get('/api/posts/?limit=5&fields=id,hotness&before='
+                + page['prev']).json
+        self.assertEqual(back['items'], items[5:10])
+
+    def test_fields_only_select_those_columns(self):
+        """Tests whether fields= limits the columns in the SELECT, and
+           rejects columns which aren't public."""
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            response = self.client.get('/api/posts/?fields=title&sort=new')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(response.json['items'][0], {'title': 'Title 11'})
+        select = statements[-1].split('FROM')[0]
+        self.assertNotIn('text', select)
+        self.assertIn('timestamp', select)
+
+        self.assert400(self.client.get('/api/users/?fields=email'))
+        self.assertEqual(self.client.get('/api/users/1').json,
+                {'id': 1, 'username': 'John', 'scores': None})
+
+    def test_filters(self):
+        """Tests whether posts and comments can be filtered."""
+        page = self.client.get('/api/posts/?topic=topic1&limit=20').json
+        self.assertEqual(len(page['items']), 6)
+        page = self.client.get('/api/posts/?user=Nobody').json
+        self.assertEqual(page['items'], [])
+        page = self.client.get('/api/comments/?post=1').json
+        self.assertEqual([item['text'] for item in page['items']], ['Comment'])
+        self.assert404(self.client.get('/api/topics/5'))
+
+    def test_export_streams(self):
+        """Tests whether exports stream every row as one JSON array."""
+        response = self.client.get('/api/posts/export?fields=id&event=Test')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                [{'id': i} for i in range(1, 13)])
+
+    def test_metrics(self):
+        """Tests whether requests and their SQL are counted by endpoint, and
+           slow requests are logged with their statements."""
+        metrics.reset()
+        self.client.get('/api/posts/')
+        self.client.get('/api/posts/')
+        self.client.get('/api/nowhere')
+
+        lines = self.client.get('/metrics').get_data(as_text=True).split('\n')
+        self.assertIn('nuncio_request_duration_seconds_count'
+                '{endpoint="api.posts_post_list"} 2', lines)
+        self.assertIn('nuncio_requests_total{endpoint="unmatched",'
+                'status="404"} 1', lines)
+        statements = [line for line in lines if line.startswith(
+                'nuncio_sql_statements_total{endpoint="api.posts_post_list"}')]
+        self.assertGreater(int(statements[0].split()[-1]), 0)
+
+        self.app.config['SLOW_REQUEST_MS'] = 0.001
+        try:
+            with self.assertLogs(self.app.logger, 'WARNING') as logs:
+                self.client.get('/api/posts/1')
+        finally:
+            self.app.config['SLOW_REQUEST_MS'] = 0
+        self.assertIn('GET /api/posts/1 took', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import sys
+import os
+
+from flask_testing import TestCase
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import app, create_app, db
+from app.models import Post, User, ScoreEvent
+from app.karma import roll_up_scores
+
+
+def remove_sqlite_file(engine):
+    """Deletes the file of a SQLite engine's database, with its WAL files."""
+    engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        path = engine.url.database + suffix
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class DatabaseTestCase(TestCase):
+    def create_app(self):
+        """Creates an app object reading GET requests from a replica."""
+        app = create_app()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unittest.db'
+        app.config['SQLALCHEMY_BINDS'] = {
+                'replica': 'sqlite:///unittest_replica.db'}
+        return app
+
+    def setUp(self):
+        """Sets up the primary database and an empty replica."""
+        db.create_all()
+        self.replica = db.get_engine(self.app, bind='replica')
+        db.Model.metadata.create_all(bind=self.replica)
+
+    def tearDown(self):
+        """Removes both databases."""
+        db.session.remove()
+        db.drop_all()
+        db.Model.metadata.drop_all(bind=self.replica)
+        remove_sqlite_file(self.replica)
+
+    def test_sqlite_pragmas(self):
+        """Tests whether new SQLite connections are set up for threads."""
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(),
+                'wal')
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(),
+                5000)
+        self.assertEqual(db.session.execute('PRAGMA cache_size').scalar(),
+                -65536)
+
+    def test_get_requests_read_the_replica(self):
+        """Tests whether GET requests read from the replica, while writes
+           go to the primary database."""
+        db.session.add(Post(title="Primary", text="Text"))
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(self.client.get('/api/posts/').json['items'], [])
+        # The test itself runs in a GET request context too.
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(db.get_engine(self.app).execute(
+                'SELECT COUNT(*) FROM post').scalar(), 1)
+
+        with self.replica.connect() as connection:
+            connection.execute(Post.__table__.insert().values(id=1,
+                    title="Replica", text="Text"))
+        db.session.remove()
+        items = self.client.get('/api/posts/?fields=title').json['items']
+        self.assertEqual(items, [{'title': 'Replica'}])
+
+
+class ReplicaRoutesTestCase(TestCase):
+    def create_app(self):
+        """Uses the real app object, which has the views, with a replica."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unittest.db'
+        self.binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = {
+                'replica': 'sqlite:///unittest_replica.db'}
+        return app
+
+    def setUp(self):
+        """Sets up the primary database and an empty replica."""
+        db.create_all()
+        self.replica = db.get_engine(self.app, bind='replica')
+        db.Model.metadata.create_all(bind=self.replica)
+
+    def tearDown(self):
+        """Removes both databases and the replica from the config."""
+        db.session.remove()
+        db.drop_all()
+        db.Model.metadata.drop_all(bind=self.replica)
+        remove_sqlite_file(self.replica)
+        app.config['SQLALCHEMY_BINDS'] = self.binds
+
+    def test_writes_during_get_requests_go_to_the_primary(self):
+        """Tests whether a GET request leaves the user's karma alone, and
+           whether rolling it up during a GET writes to the primary
+           database, leaving the replica alone."""
+        user = User(username="John", email="john@example.com", scores=0,
+                importance_debt=0)
+        user.set_password("password")
+        rows = [(User.__table__, {'id': 1, 'username': user.username,
+                 'email': user.email, 'password_hash': user.password_hash,
+                 'scores': 0, 'importance_debt': 0}),
+                (ScoreEvent.__table__, {'id': 1, 'user_id': 1, 'kind': 'vote',
+                 'delta': 5, 'rolled_up': False})]
+        # The replica has caught up with the primary.
+        for bind in (db.get_engine(self.app), self.replica):
+            with bind.connect() as connection:
+                for table, row in rows:
+                    connection.execute(table.insert().values(row))
+
+        self.client.post('/auth/login', data={'username': 'John',
+                'password': 'password'})
+        self.assert200(self.client.get('/submit'))
+        for bind in (db.get_engine(self.app), self.replica):
+            self.assertEqual(bind.execute('SELECT scores FROM user').scalar(),
+                    0)
+
+        # The test itself runs in a GET request context.
+        db.session.remove()
+        roll_up_scores(1)
+        for bind, scores, rolled_up in [(db.get_engine(self.app), 5, 1),
+                                        (self.replica, 0, 0)]:
+            self.assertEqual(bind.execute('SELECT scores FROM user').scalar(),
+                    scores)
+            self.assertEqual(bind.execute('SELECT rolled_up FROM score_event')
+                    .scalar(), rolled_up)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,27 @@
 import unittest
 import sys
 import os
+import json
+import tempfile
 from datetime import datetime
 
 from flask_testing import TestCase
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app, db
-from app.models import Post, Topic, Event, Comment
+from app.models import Post, Topic, Event, Comment, User, ScoreEvent
 from app.helpers import check_event_exists, check_topic_exists
+from app.ranking import recompute_hotness, calculate_hotness
+from app.models import log_hotness, power_hotness, get_age
+from app.votes import cast_vote, spend_importance, UPVOTE, DOWNVOTE
+from app.karma import roll_up_scores, record_score_event, VOTE_RECEIVED, \
+        IMPORTANCE_COST
+from app.events import update_event_stats
+from app.search import MemoryIndex, FTS5Index, fts5_available
+from app.pagination import encode_cursor
+from app.seed import seed, SEED_PASSWORD
+from app.importer import import_posts
+from app.search import get_search_index
 
 
 class PostTestCase(TestCase):
@@ -136,29 +149,291 @@ class PostTestCase(TestCase):
             self.assertEqual(i.text, self.comment.text)
 
     def test_time_type_setting(self):
-        """Tests whether the time type can be set correctly."""
-        self.post = Post(title="Title", text="Text", user_id=1,
-                topics=[Topic(tag_name="topic1"), Topic(tag_name="topic2")], id=1)
+        """Tests whether the time type is worked out correctly."""
+        self.timestamp = datetime(2018, 6, 29, 10, 00, 00)
         # Difference between the two timestamps is in minutes.
         # So timetype should equal 0.
-        self.post.timestamp = datetime(2018, 6, 29, 10, 00, 00)
         self.test_timestamp = datetime(2018, 6, 29, 10, 2, 00)
-        self.post.get_minutes(input_time=self.test_timestamp)
-        self.assertEqual(0, self.post.time_type)
-        self.assertFalse(1 == self.post.time_type)
+        self.assertEqual((2, 0), get_age(self.timestamp, self.test_timestamp))
 
         # Difference between the two timestamps is in hours.
         # So timetype should equal 1.
-        self.post.timestamp = datetime(2018, 6, 29, 10, 00, 00)
         self.test_timestamp = datetime(2018, 6, 29, 11, 2, 00)
-        self.post.get_minutes(input_time=self.test_timestamp)
-        self.assertEqual(1, self.post.time_type)
-        self.assertFalse(2 == self.post.time_type)
+        self.assertEqual((1, 1), get_age(self.timestamp, self.test_timestamp))
 
-        # Difference between the two timestamps is in hours.
-        # So timetype should equal 1.
-        self.post.timestamp = datetime(2018, 6, 29, 10, 00, 00)
+        # Difference between the two timestamps is in days.
+        # So timetype should equal 2.
         self.test_timestamp = datetime(2018, 6, 30, 11, 2, 00)
-        self.post.get_minutes(input_time=self.test_timestamp)
-        self.assertEqual(2, self.post.time_type)
-        self.assertFalse(1 == self.post.time_type)
+        self.assertEqual((1, 2), get_age(self.timestamp, self.test_timestamp))
+
+        # A post's age is always worked out against the current time.
+        self.post = Post(title="Title", text="Text", user_id=1,
+                timestamp=datetime.utcnow())
+        self.assertEqual(0, self.post.time_type)
+        self.assertEqual(0, self.post.age)
+
+    def test_recompute_hotness(self):
+        """Tests whether the ranking worker's recompute orders posts by
+           score and age."""
+        now = datetime(2018, 6, 29, 12, 00, 00)
+        old = Post(title="Old", text="Text", upvotes=5, downvotes=0,
+                importance=10, timestamp=datetime(2018, 6, 28, 12, 00, 00))
+        new = Post(title="New", text="Text", upvotes=5, downvotes=0,
+                importance=10, timestamp=datetime(2018, 6, 29, 11, 00, 00))
+        downvoted = Post(title="Downvoted", text="Text", upvotes=1,
+                downvotes=3, importance=10,
+                timestamp=datetime(2018, 6, 29, 11, 00, 00))
+        db.session.add_all([old, new, downvoted])
+        db.session.commit()
+
+        self.assertEqual(recompute_hotness(now=now), 3)
+
+        ranked = Post.query.order_by(Post.hotness.desc()).all()
+        self.assertEqual([post.title for post in ranked][:2], ["New", "Old"])
+
+    def test_log_hotness_keeps_ordering(self):
+        """Tests whether log-space hotness orders posts the same way as the
+           original formula, and buries posts with negative scores."""
+        posts = [(0, 10, 60), (3, 10, 60), (3, 12, 60), (3, 10, 3600),
+                (40, 11, 86400), (1, 10, 5)]
+        by_power = sorted(posts, key=lambda p: power_hotness(*p))
+        by_log = sorted(posts, key=lambda p: log_hotness(*p))
+        self.assertEqual(by_power, by_log)
+
+        self.assertLess(log_hotness(-1, 10, 5), log_hotness(0, 10, 10 ** 9))
+        self.assertLess(log_hotness(-5, 10, 5), log_hotness(-1, 10, 5))
+
+        bulk = calculate_hotness([1, 0], [0, 4], [10, 10], [60, 60])
+        self.assertAlmostEqual(bulk[0], log_hotness(1, 10, 60))
+        self.assertAlmostEqual(bulk[1], log_hotness(-4, 10, 60))
+
+    def test_cast_vote(self):
+        """Tests whether votes move the counters and the author's score by
+           the right amount, flipping any opposite vote."""
+        author = User(username="John", email="john@example.com", scores=1)
+        voter = User(username="Jane", email="jane@example.com")
+        db.session.add_all([author, voter])
+        db.session.commit()
+        post = Post(title="Title", text="Text", user_id=author.id, upvotes=1,
+                downvotes=0, importance=10, score=1,
+                timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+
+        self.assertEqual(cast_vote(voter, post, UPVOTE), 1)
+        self.assertEqual((post.upvotes, post.downvotes, post.score), (2, 0, 2))
+        roll_up_scores()
+        self.assertEqual(author.scores, 2)
+        self.assertIn(post, voter.upvoted_on)
+        upvoted_hotness = post.hotness
+
+        # Voting the same way twice does nothing.
+        self.assertEqual(cast_vote(voter, post, UPVOTE), 0)
+        self.assertEqual(post.upvotes, 2)
+
+        # Downvoting takes the upvote back as well.
+        self.assertEqual(cast_vote(voter, post, DOWNVOTE), -2)
+        self.assertEqual((post.upvotes, post.downvotes, post.score), (1, 1, 0))
+        roll_up_scores()
+        self.assertEqual(author.scores, 0)
+        self.assertNotIn(post, voter.upvoted_on)
+        self.assertIn(post, voter.downvoted_on)
+        self.assertLess(post.hotness, upvoted_hotness)
+
+    def test_spend_importance(self):
+        """Tests whether importance is added in SQL, so a copy of the post
+           loaded before another change doesn't lose it."""
+        author = User(username="John", email="john@example.com")
+        giver = User(username="Jane", email="jane@example.com",
+                importance_debt=0)
+        db.session.add_all([author, giver])
+        db.session.commit()
+        post = Post(title="Title", text="Text", user_id=author.id, upvotes=1,
+                downvotes=0, importance=None, score=1,
+                timestamp=datetime.utcnow())
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.id
+
+        # Someone else gives importance meanwhile.
+        db.session.execute(Post.__table__.update().values(importance=12))
+        self.assertTrue(spend_importance(giver, post))
+        self.assertFalse(spend_importance(giver, post))
+
+        db.session.remove()
+        post = Post.query.get(post_id)
+        self.assertEqual((post.importance, post.version), (13, 1))
+        self.assertEqual(User.query.filter_by(username="Jane").first()
+                .importance_debt, IMPORTANCE_COST)
+
+    def test_memory_search_index(self):
+        """Tests whether the in-process search index ranks, pages and
+           forgets deleted posts."""
+        posts = [Post(title="Rust compiler news", text="Text", id=1,
+                    topics=[Topic(tag_name="programming")]),
+                 Post(title="Compilers", text="Rust rust rust", id=2,
+                    event=Event(event_name="RustConf")),
+                 Post(title="Gardening", text="Rusty tools", id=3),
+                 Post(title="Snake news", text="Python", id=4),
+                 Post(title="Python news", text="Snake", id=5)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        index = MemoryIndex()
+        index.rebuild()
+        self.assertEqual(sorted(index.search("rust compil").items), [1, 2])
+        # A match in the text counts for less than one in the title.
+        self.assertEqual(index.search("python").items, [5, 4])
+
+        page = index.search("rust", per_page=2)
+        self.assertEqual(len(page.items), 2)
+        rest = index.search("rust", cursor=page.next_cursor, per_page=2)
+        self.assertEqual(sorted(page.items + rest.items), [1, 2, 3])
+        self.assertFalse(rest.has_next)
+
+        index.remove(1)
+        self.assertEqual(index.search("compil").items, [2])
+        self.assertEqual(index.search("").items, [])
+
+    def test_search_ignores_bad_cursors(self):
+        """Tests whether both search backends show the first page for a
+           cursor which doesn't hold a rank and a post id."""
+        db.session.add_all([Post(title="Rust news {}".format(i), text="Text",
+                                 id=i) for i in range(1, 4)])
+        db.session.commit()
+
+        indexes = [MemoryIndex()]
+        if fts5_available(db.engine):
+            indexes.append(FTS5Index())
+        for index in indexes:
+            index.rebuild()
+            first = index.search("rust", per_page=2).items
+            for values in (["a", "b"], [None, None], [{}, []], [-1.5, True]):
+                page = index.search("rust", cursor=encode_cursor(values),
+                        per_page=2)
+                self.assertEqual(page.items, first,
+                        (type(index).__name__, values))
+
+    def test_seed(self):
+        """Tests whether seeded data is consistent with itself."""
+        counts = seed(users=5, posts=20, topics=3, events=2, votes=50,
+                comments=30, chunk_size=7, random_seed=1)
+        self.assertEqual(counts['votes'], 50)
+        self.assertEqual(Post.query.count(), 20)
+        self.assertEqual(sum(post.upvotes + post.downvotes
+                             for post in Post.query), 50)
+        self.assertEqual(sum(post.comment_count for post in Post.query), 30)
+        self.assertEqual(sum(user.scores for user in User.query),
+                sum(post.score for post in Post.query))
+        self.assertTrue(all(post.hotness != None for post in Post.query))
+        self.assertTrue(User.query.first().check_password(SEED_PASSWORD))
+
+    def test_seed_keeps_existing_rows(self):
+        """Tests whether seeding a database leaves its own karma ledger and
+           event stats alone."""
+        user = User(username="Existing", email="existing@example.com",
+                scores=0, importance_debt=0)
+        event = Event(event_name="Existing")
+        db.session.add_all([user, event])
+        db.session.commit()
+        user_id, event_id = user.id, event.id
+        record_score_event(user_id, 3, VOTE_RECEIVED)
+        update_event_stats(event_id, posts=1, score=2, votes=4)
+        db.session.commit()
+        roll_up_scores()
+
+        seed(users=5, posts=20, topics=3, events=2, votes=50, comments=30,
+                random_seed=1)
+        self.assertEqual(User.query.get(user_id).scores, 3)
+        self.assertEqual(ScoreEvent.query.filter_by(user_id=user_id).count(),
+                1)
+        stats = Event.query.get(event_id).stats
+        self.assertEqual((stats.post_count, stats.total_score,
+                stats.recent_votes), (1, 2, 4))
+
+    def test_import_posts(self):
+        """Tests whether posts are imported in batches, reusing topics and
+           events, and whether an import carries on from its checkpoint."""
+        user = User(username="Author", email="author@example.com", scores=0,
+                importance_debt=0)
+        db.session.add_all([user, Topic(tag_name="rust")])
+        db.session.commit()
+
+        rows = [{'title': 'Post {}'.format(i), 'text': 'About rust',
+                 'author': 'Author', 'topics': ['rust', 'topic{}'.format(i % 2)],
+                 'event': 'Launch', 'upvotes': 2,
+                 'timestamp': '2020-01-01T00:00:00'} for i in range(5)]
+        rows.insert(2, {'title': 'No text', 'author': 'Author'})
+        rows.insert(4, {'title': 'Stranger', 'text': 'Text',
+                        'author': 'Nobody'})
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'posts.jsonl')
+        checkpoint = path + '.checkpoint'
+        with open(path, 'w') as source:
+            for row in rows[:4]:
+                source.write(json.dumps(row) + '\n')
+
+        skipped = []
+        counts = import_posts(path, batch_size=2, checkpoint=checkpoint,
+                skipped=lambda number, reason: skipped.append(number))
+        self.assertEqual((counts['rows'], counts['posts']), (4, 3))
+        self.assertEqual(skipped, [3])
+
+        with open(path, 'a') as source:
+            for row in rows[4:]:
+                source.write(json.dumps(row) + '\n')
+        counts = import_posts(path, batch_size=2, checkpoint=checkpoint,
+                skipped=lambda number, reason: skipped.append(number))
+        self.assertEqual(counts['resumed_at'], 4)
+        self.assertEqual((counts['rows'], counts['posts']), (7, 2))
+        self.assertEqual(skipped, [3, 5])
+
+        self.assertEqual(Post.query.count(), 5)
+        self.assertEqual(Topic.query.count(), 3)
+        self.assertEqual(Event.query.count(), 1)
+        event = Event.query.first()
+        self.assertEqual((event.stats.post_count, event.stats.total_score),
+                (5, 10))
+        self.assertEqual(User.query.first().scores, 10)
+        self.assertEqual(len(Topic.query.filter_by(tag_name="rust")
+                .first().posts), 5)
+        self.assertEqual(len(get_search_index().search("rust").items), 5)
+
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def test_import_posts_skips_malformed_rows(self):
+        """Tests whether lines which aren't JSON objects, or have fields of
+           the wrong type, are skipped without losing the rest of their
+           batch."""
+        user = User(username="Author", email="author@example.com", scores=0,
+                importance_debt=0)
+        db.session.add(user)
+        db.session.commit()
+
+        row = {'title': 'Fine', 'text': 'Text', 'author': 'Author'}
+        lines = [json.dumps(row), '{"title": "Cut off', '[1, 2]',
+                 json.dumps(dict(row, topics=5)),
+                 json.dumps(dict(row, title=['Not', 'a', 'title'])),
+                 json.dumps(dict(row, title='Also fine'))]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'posts.jsonl')
+        checkpoint = path + '.checkpoint'
+        with open(path, 'w') as source:
+            source.write('\n'.join(lines) + '\n')
+
+        skipped = []
+        counts = import_posts(path, batch_size=10, checkpoint=checkpoint,
+                skipped=lambda number, reason: skipped.append(number))
+        self.assertEqual((counts['rows'], counts['posts']), (6, 2))
+        self.assertEqual(skipped, [2, 3, 4, 5])
+        self.assertEqual(sorted(post.title for post in Post.query),
+                ['Also fine', 'Fine'])
+
+        counts = import_posts(path, batch_size=10, checkpoint=checkpoint)
+        self.assertEqual((counts['resumed_at'], counts['posts']), (6, 0))
+
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
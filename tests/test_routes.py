@@ -0,0 +1,823 @@
+import unittest
+import sys
+import os
+import re
+import json
+import signal
+from datetime import datetime
+
+from flask_login import AnonymousUserMixin
+from flask_testing import TestCase
+from sqlalchemy import event, inspect
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import app, db
+from app.models import Post, Topic, Event, EventStats, User, Comment
+from app.karma import roll_up_scores
+from app.metrics import metrics, query_budget, QueryBudgetExceeded
+from app.events import rebuild_event_stats, update_event_stats, \
+        trending_events, estimate_recent_votes, insert_missing
+from app.search import index_post
+from app.hotfeed import HotFeed, TopicFeeds, get_hot_feed, get_topic_feeds
+from app import votebuffer, routes
+from app.votebuffer import get_vote_buffer, submit_vote, flush_on_sigterm
+from app.cache import FragmentCache, get_fragment_cache, get_page_cache
+from app.helpers import load_vote_state, check_if_upvoted, check_if_downvoted, \
+        check_if_given_importance
+
+
+class RoutesTestCase(TestCase):
+    def create_app(self):
+        """Uses the real app object, as the view functions are registered
+           on it rather than on the app made by create_app()."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unittest.db'
+        # Most tests count the queries behind a page, so render every time.
+        app.config['PAGE_CACHE_TTL'] = 0
+        # Logs any query a view runs for every post it shows.
+        app.config['REPEATED_QUERY_THRESHOLD'] = 5
+        return app
+
+    def setUp(self):
+        """Sets up a test database with a user and one of their posts."""
+        db.create_all()
+        # Post ids start again with each test's fresh database.
+        get_fragment_cache().clear()
+        get_page_cache().clear()
+        get_hot_feed().reset()
+        get_topic_feeds().clear()
+        self.user = User(username="John", email="example@example.com")
+        self.user.set_password("password")
+        self.user.importance_debt = 0
+        db.session.add(self.user)
+        db.session.commit()
+
+        self.post = self.make_post("Title")
+        db.session.commit()
+
+    def tearDown(self):
+        """Removes all objects from the database."""
+        db.session.remove()
+        db.drop_all()
+
+    def make_post(self, title, topic="topic1", event_name="Test"):
+        """Adds a post made by self.user, like the submit view would."""
+        post = Post(title=title, text="Text", user_id=self.user.id,
+                topics=[Topic.query.filter_by(tag_name=topic).first() or
+                    Topic(tag_name=topic)],
+                event=Event.query.filter_by(event_name=event_name).first() or
+                    Event(event_name=event_name))
+        post.upvotes = 1
+        post.downvotes = 0
+        post.importance = 10
+        post.is_link = False
+        post.timestamp = datetime.utcnow()
+        post.score = 1
+        post.hotness = post.calculate_hotness()
+        db.session.add(post)
+        db.session.flush()
+        index_post(post)
+        return post
+
+    def capture_statements(self, url=None, func=None):
+        """GETs a url (or calls func), returning the result and every SQL
+           statement that was run meanwhile."""
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.engine
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            result = self.client.get(url) if func is None else func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        return result, statements
+
+    def test_get_requests_never_write(self):
+        """Tests whether rendering pages issues no INSERT or UPDATE."""
+        for url in ['/index', '/item/{}'.format(self.post.id), '/user/John']:
+            response, statements = self.capture_statements(url)
+            self.assert200(response)
+            writes = [statement for statement in statements
+                      if statement.lstrip().upper().startswith(
+                          ('INSERT', 'UPDATE', 'DELETE'))]
+            self.assertEqual(writes, [], url)
+
+    def test_vote_state_is_batched(self):
+        """Tests whether a page's vote state is loaded up front, so that
+           checking each post doesn't run any more queries."""
+        posts = [self.post] + [self.make_post("Title {}".format(i))
+                               for i in range(5)]
+        self.user.upvoted_on.append(posts[0])
+        self.user.downvoted_on.append(posts[1])
+        self.user.given_importance_to.append(posts[2])
+        db.session.commit()
+        # Refresh the expired objects so only the vote queries are counted.
+        db.session.refresh(self.user)
+        for post in posts:
+            db.session.refresh(post)
+
+        with app.test_request_context('/index'):
+            state, statements = self.capture_statements(
+                    func=lambda: load_vote_state(posts, self.user))
+            self.assertEqual(len(statements), 3)
+
+            def check_all():
+                return [(check_if_upvoted(post, self.user),
+                         check_if_downvoted(post, self.user),
+                         check_if_given_importance(post, self.user))
+                        for post in posts]
+
+            checks, statements = self.capture_statements(func=check_all)
+            self.assertEqual(statements, [])
+            self.assertEqual(checks[0], (True, False, False))
+            self.assertEqual(checks[1], (False, True, False))
+            self.assertEqual(checks[2], (False, False, True))
+            self.assertEqual(checks[3], (False, False, False))
+
+        # Without a preloaded state the helpers still work, one query each.
+        self.assertTrue(check_if_upvoted(posts[0], self.user))
+        self.assertFalse(check_if_downvoted(posts[0], self.user))
+
+    def test_feed_query_count_is_constant(self):
+        """Tests whether list views run the same number of queries no matter
+           how many posts they render."""
+        urls = ['/index', '/search_topic/topic1', '/event/Test', '/user/John',
+                '/search_result/topic1']
+        # Once to set up anything done lazily, like picking a search backend.
+        for url in urls:
+            self.client.get(url)
+
+        counts = {}
+        for url in urls:
+            response, statements = self.capture_statements(url)
+            self.assert200(response)
+            counts[url] = len(statements)
+
+        for i in range(7):
+            self.make_post("Title {}".format(i))
+        db.session.commit()
+        db.session.remove()
+        # The hot feeds were loaded with every post there was, so they're
+        # reloaded with the new ones, then warmed up again.
+        get_hot_feed().reset()
+        get_topic_feeds().clear()
+        for url in urls:
+            self.client.get(url)
+
+        for url in urls:
+            response, statements = self.capture_statements(url)
+            self.assertEqual(len(set(re.findall(r'data-post="(\d+)"',
+                    response.get_data(as_text=True)))), 8, url)
+            self.assertEqual(len(statements), counts[url], url)
+
+    def test_query_budgets(self):
+        """Tests whether feeds stay within their query budget, and whether
+           a query for every post is caught."""
+        for i in range(12):
+            self.make_post("Title {}".format(i))
+        db.session.commit()
+        # Once to set up anything done lazily, like the hot feed.
+        self.client.get('/index')
+        self.client.get('/search_result/topic1')
+        db.session.remove()
+
+        with query_budget(2):
+            self.client.get('/index')
+        with query_budget(7):
+            self.client.get('/search_result/topic1')
+
+        posts = Post.query.all()
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            with query_budget(5):
+                for post in posts:
+                    check_if_upvoted(post, self.user)
+        self.assertIn('13x SELECT', str(raised.exception))
+
+        metrics.start_request(repeat_threshold=3)
+        for post in posts:
+            check_if_upvoted(post, self.user)
+        state = metrics.end_request('test')
+        (shape, location), = state.repeated.items()
+        self.assertIn('upvoters_table', shape)
+        self.assertEqual(state.shapes[shape], 13)
+        self.assertTrue(location.startswith('app/helpers.py:'))
+
+    def page_titles(self, response):
+        """Titles of the posts rendered on a page."""
+        return re.findall(r'<a href="/item/\d+">([^<]+)</a>',
+                response.get_data(as_text=True))
+
+    def next_link(self, response):
+        """The url of the page's Next link, if it has one."""
+        match = re.search(r'<a href="([^"]+)">Next</a>',
+                response.get_data(as_text=True))
+        return match.group(1).replace('&amp;', '&') if match else None
+
+    def back_link(self, response):
+        """The url of the page's Back link, if it has one."""
+        match = re.search(r'<a href="([^"]+)">Back</a>',
+                response.get_data(as_text=True))
+        return match.group(1).replace('&amp;', '&') if match else None
+
+    def test_hot_feed_is_paginated(self):
+        """Tests whether the hot feed pages forwards and back with cursors,
+           showing posts with equal hotness exactly once."""
+        for i in range(24):
+            post = self.make_post("Title {}".format(i))
+            post.hotness = i % 4
+        db.session.commit()
+
+        pages = [self.client.get('/index')]
+        self.assertIsNone(self.back_link(pages[0]))
+        while self.next_link(pages[-1]) != None:
+            pages.append(self.client.get(self.next_link(pages[-1])))
+
+        titles = [self.page_titles(page) for page in pages]
+        self.assertEqual([len(page) for page in titles], [10, 10, 5])
+        self.assertEqual(len(set(sum(titles, []))), 25)
+
+        # Going back lands on exactly the same pages.
+        back = self.client.get(self.back_link(pages[2]))
+        self.assertEqual(self.page_titles(back), titles[1])
+        back = self.client.get(self.back_link(back))
+        self.assertEqual(self.page_titles(back), titles[0])
+        self.assertIsNone(self.back_link(back))
+
+        # Topic and event feeds page the same way.
+        response = self.client.get('/search_topic/topic1')
+        self.assertEqual(self.page_titles(response), titles[0])
+        response = self.client.get(self.next_link(response))
+        self.assertEqual(self.page_titles(response), titles[1])
+
+    def test_topic_feeds(self):
+        """Tests whether topic pages page by hotness from the topic's feed,
+           or newest first, and keep up with new posts."""
+        for i in range(12):
+            post = self.make_post("Title {}".format(i),
+                    topic="feature-request" if i % 2 else "topic1")
+            post.timestamp = datetime(2018, 6, 29, 10, i, 00)
+            post.hotness = i % 3
+        db.session.commit()
+
+        response = self.client.get('/feature-request')
+        self.assertEqual(self.page_titles(response), ["Title 11", "Title 5",
+                "Title 7", "Title 1", "Title 9", "Title 3"])
+        feed = get_topic_feeds().get(Topic.query.filter_by(
+                tag_name="feature-request").first().id)
+        self.assertEqual(len(feed), 6)
+        self.assertTrue(feed.exhaustive)
+
+        response = self.client.get('/search_topic/feature-request?sort=new')
+        self.assertEqual(self.page_titles(response), ["Title 11", "Title 9",
+                "Title 7", "Title 5", "Title 3", "Title 1"])
+        self.assertIn('?sort=new">New', self.client.get(
+                '/search_topic/topic1').get_data(as_text=True))
+
+        self.login()
+        self.client.post('/submit', data={'title': 'New', 'text': 'Text',
+                'link': '', 'topics': 'feature-request', 'event': 'Test'})
+        self.assertIn('New', self.page_titles(self.client.get(
+                '/search_topic/feature-request')))
+        self.assertEqual(len(feed), 7)
+
+        feeds = TopicFeeds(2, 10, 60)
+        for topic_id in [1, 2, 1, 3]:
+            feeds.get(topic_id)
+        self.assertEqual(list(feeds.feeds), [1, 3])
+
+    def test_submit_is_one_transaction(self):
+        """Tests whether a post whose score event can't be recorded isn't
+           left behind without its ledger row, stats or search entry."""
+        self.login()
+        record = routes.record_score_event
+
+        def failing_record(*args, **kwargs):
+            raise RuntimeError("ledger unavailable")
+
+        routes.record_score_event = failing_record
+        try:
+            with self.assertRaises(RuntimeError):
+                self.client.post('/submit', data={'title': 'Broken',
+                        'text': 'Text', 'link': '', 'topics': 'broken-topic',
+                        'event': 'Broken'})
+        finally:
+            routes.record_score_event = record
+
+        db.session.remove()
+        self.assertEqual(Post.query.filter_by(title='Broken').count(), 0)
+        self.assertEqual(Topic.query.filter_by(tag_name='broken-topic')
+                .count(), 0)
+        self.assertEqual(Event.query.filter_by(event_name='Broken').count(), 0)
+
+    def test_event_stats(self):
+        """Tests whether event stats follow posts and votes, and rank the
+           trending events page."""
+        self.login()
+        for title, event_name in [("Quiet", "Quiet"), ("Busy", "Busy")]:
+            self.client.post('/submit', data={'title': title, 'text': 'Text',
+                    'link': '', 'topics': 'topic1', 'event': event_name})
+        busy = Event.query.filter_by(event_name="Busy").first()
+        stats = busy.stats
+        self.assertEqual((stats.post_count, stats.total_score,
+                stats.recent_votes), (1, 1, 0))
+
+        other = User(username="Jane", email="jane@example.com")
+        db.session.add(other)
+        db.session.commit()
+        post = Post.query.filter_by(title="Busy").first()
+        submit_vote(other, post, 'downvote')
+        submit_vote(self.user, post, 'downvote')
+        db.session.expire_all()
+        self.assertEqual((busy.stats.post_count, busy.stats.total_score,
+                busy.stats.recent_votes), (1, -1, 2))
+
+        response = self.client.get('/events').get_data(as_text=True)
+        self.assertLess(response.index('>Busy<'), response.index('>Quiet<'))
+        # The setUp post was made without going through submit.
+        self.assertNotIn('>Test<', response)
+
+        response = self.client.get('/event/Busy?sort=new')
+        self.assertEqual(self.page_titles(response), ["Busy"])
+        self.assertIn('1 posts', response.get_data(as_text=True))
+
+        self.client.post('/delete_post/{}'.format(post.id))
+        db.session.expire_all()
+        self.assertEqual((busy.stats.post_count, busy.stats.total_score),
+                (0, 0))
+
+        self.assertEqual(rebuild_event_stats(), 2)
+        self.assertEqual(EventStats.query.get(
+                Event.query.filter_by(event_name="Test").first().id)
+                .post_count, 1)
+
+    def test_event_votes_slide_over_the_window(self):
+        """Tests whether an event's recent votes fade out over the hour
+           after its window ends, rather than dropping all at once."""
+        busy, quiet = Event(event_name="Busy"), Event(event_name="Quiet")
+        db.session.add_all([busy, quiet])
+        db.session.commit()
+        update_event_stats(busy.id, votes=500, now=datetime(2020, 1, 1, 10, 30))
+        update_event_stats(quiet.id, votes=10,
+                now=datetime(2020, 1, 1, 11, 0, 30))
+        db.session.commit()
+
+        def ranked(hour, minute):
+            now = datetime(2020, 1, 1, hour, minute)
+            return [(event.event_name, round(estimate_recent_votes(
+                    event.stats, now), 1)) for event in trending_events(2, now)]
+
+        self.assertEqual(ranked(10, 59), [("Busy", 500), ("Quiet", 0)])
+        self.assertEqual(ranked(11, 1), [("Busy", 491.7), ("Quiet", 10)])
+        update_event_stats(busy.id, votes=1, now=datetime(2020, 1, 1, 11, 1))
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(ranked(11, 30), [("Busy", 251), ("Quiet", 10)])
+        self.assertEqual(ranked(12, 30), [("Quiet", 5), ("Busy", 0.5)])
+        self.assertEqual(ranked(13, 0), [("Busy", 0), ("Quiet", 0)])
+
+    def test_event_stats_row_made_once(self):
+        """Tests whether making an event's stats row when another request
+           has just made it leaves that row alone instead of failing."""
+        event_id = self.post.event_id
+        update_event_stats(event_id, posts=1, score=3)
+        stats_table = EventStats.__table__
+        db.session.execute(insert_missing(stats_table, event_id=event_id,
+                post_count=0, total_score=0, recent_votes=0,
+                previous_votes=0))
+        db.session.commit()
+        self.assertEqual(db.session.query(stats_table.c.post_count,
+                stats_table.c.total_score).all(), [(1, 3)])
+
+    def test_user_page_is_paginated(self):
+        """Tests whether the user page pages through every post once,
+           newest first by default."""
+        for i in range(12):
+            post = self.make_post("Title {}".format(i))
+            post.timestamp = datetime(2018, 6, 29, 10, i, 00)
+            post.hotness = i % 3
+        db.session.commit()
+
+        for sort in ['new', 'hot']:
+            response = self.client.get('/user/John?sort=' + sort)
+            first = self.page_titles(response)
+            self.assertEqual(len(first), 10)
+
+            response = self.client.get(self.next_link(response))
+            second = self.page_titles(response)
+            self.assertEqual(len(second), 3)
+            self.assertIsNone(self.next_link(response))
+            self.assertEqual(len(set(first + second)), 13)
+
+        response = self.client.get('/user/John')
+        self.assertEqual(self.page_titles(response)[:2], ["Title", "Title 11"])
+
+    def login(self):
+        return self.client.post('/auth/login', data={'username': 'John',
+                'password': 'password'})
+
+    def test_vote_route(self):
+        """Tests whether voting through the form moves the post's score."""
+        other = self.make_post("Other")
+        db.session.commit()
+        other_id, post_id = other.id, self.post.id
+        self.login()
+
+        self.client.post('/vote/{}'.format(other_id), data={'downvote': ''})
+        self.client.post('/vote/{}'.format(other_id), data={'downvote': ''})
+        self.client.post('/vote/{}'.format(post_id), data={'upvote': ''})
+
+        roll_up_scores()
+        db.session.remove()
+        self.assertEqual(Post.query.get(other_id).score, 0)
+        self.assertEqual(Post.query.get(post_id).score, 2)
+        self.assertEqual(User.query.filter_by(username="John").first().scores, 0)
+
+    def test_fragment_cache_lru(self):
+        """Tests whether the fragment cache evicts the least recently used
+           fragments once over its size."""
+        cache = FragmentCache(10)
+        cache.set(('a', 1), 'xxxx')
+        cache.set(('a', 2), 'xxxx')
+        self.assertEqual(cache.get(('a', 1)), 'xxxx')
+        cache.set(('a', 3), 'xxxx')
+        self.assertIsNone(cache.get(('a', 2)))
+        self.assertEqual(cache.get(('a', 1)), 'xxxx')
+        self.assertEqual(cache.size, 8)
+
+        cache.set(('a', 4), 'x' * 11)
+        self.assertIsNone(cache.get(('a', 4)))
+        cache.discard_post(1)
+        self.assertEqual(len(cache), 1)
+
+    def test_fragments_follow_votes(self):
+        """Tests whether cached post fragments are reused, yet never shown
+           after the post or the viewer's vote on it has changed."""
+        post_id = self.post.id
+        cache = get_fragment_cache()
+        self.login()
+
+        self.assertIn('post-score">1',
+                self.client.get('/index').get_data(as_text=True))
+        self.assertEqual(len(cache), 1)
+        misses = cache.misses
+        self.client.get('/index')
+        self.assertEqual(cache.misses, misses)
+
+        self.client.post('/vote/{}'.format(post_id), data={'downvote': ''})
+        page = self.client.get('/index').get_data(as_text=True)
+        self.assertIn('post-score">0', page)
+        self.assertIn('name="downvote" value="" style="background-position: -40px;"',
+                page)
+
+        db.session.remove()
+        version = Post.query.get(post_id).version
+        self.client.post('/give_importance/{}'.format(post_id))
+        db.session.remove()
+        self.assertEqual(Post.query.get(post_id).version, version + 1)
+
+        self.client.post('/delete_post/{}'.format(post_id))
+        self.assertEqual(len(cache), 0)
+
+    def test_hot_feed(self):
+        """Tests whether the hot feed keeps only posts hotter than any it
+           doesn't hold, and leaves pages past its end to SQL."""
+        ids = [self.post.id]
+        self.post.hotness = 0
+        for i in range(1, 5):
+            post = self.make_post("Title {}".format(i))
+            post.hotness = i
+            ids.append(post.id)
+        db.session.commit()
+
+        feed = HotFeed(3, 60)
+        feed.rebuild()
+        self.assertEqual([-key[1] for key in feed.keys], ids[:1:-1])
+        self.assertFalse(feed.exhaustive)
+
+        feed.update(ids[4], -1)
+        self.assertNotIn(ids[4], feed.hotness)
+        feed.update(ids[0], 10)
+        self.assertEqual([-key[1] for key in feed.keys], [ids[0], ids[3], ids[2]])
+        feed.update(ids[1], 0.5)
+        self.assertEqual(len(feed), 3)
+
+        page = feed.paginate(Post.query, per_page=2)
+        self.assertEqual([post.id for post in page.items], [ids[0], ids[3]])
+        self.assertIsNone(feed.paginate(Post.query, after=page.next_cursor,
+                per_page=2))
+
+    def test_hot_feed_follows_votes(self):
+        """Tests whether voting and deleting move posts in the hot feed."""
+        post_id = self.post.id
+        self.client.get('/index')
+        feed = get_hot_feed()
+        self.assertEqual(list(feed.hotness), [post_id])
+
+        self.login()
+        self.client.post('/vote/{}'.format(post_id), data={'upvote': ''})
+        db.session.remove()
+        self.assertEqual(feed.hotness[post_id], Post.query.get(post_id).hotness)
+
+        self.client.post('/delete_post/{}'.format(post_id))
+        self.assertEqual(len(feed), 0)
+        self.assertEqual(self.page_titles(self.client.get('/index')), [])
+
+    def test_page_cache(self):
+        """Tests whether logged out visitors are served cached pages with
+           working conditional GETs, until something on them changes."""
+        app.config['PAGE_CACHE_TTL'] = 30
+        try:
+            first = self.client.get('/index')
+            etag = first.headers['ETag']
+            self.assertIsNotNone(first.last_modified)
+
+            response, statements = self.capture_statements('/index')
+            self.assertEqual(statements, [])
+            self.assertEqual(response.get_data(), first.get_data())
+
+            response = self.client.get('/index',
+                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get('/index', headers={
+                    'If-Modified-Since': first.headers['Last-Modified']})
+            self.assertEqual(response.status_code, 304)
+
+            self.client.get('/faq')
+            self.login()
+            # Logged in users always get a fresh page.
+            response, statements = self.capture_statements('/index')
+            self.assertNotEqual(statements, [])
+            self.client.post('/vote/{}'.format(self.post.id),
+                    data={'upvote': ''})
+            self.client.get('/auth/logout')
+
+            response = self.client.get('/index',
+                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            # Static pages stay cached for good.
+            self.assertEqual(list(get_page_cache().pages), ['/faq?', '/index?'])
+        finally:
+            app.config['PAGE_CACHE_TTL'] = 0
+
+    def test_cached_item_page_has_no_comment_form(self):
+        """Tests whether the item page only has a comment form, and so a
+           CSRF token, for logged in users, who are never page cached."""
+        url = '/item/{}'.format(self.post.id)
+        app.config['PAGE_CACHE_TTL'] = 30
+        try:
+            response = self.client.get(url)
+            self.assertNotIn('name="comment"', response.get_data(as_text=True))
+            self.assertIn(url + '?', get_page_cache().pages)
+
+            self.login()
+            response = self.client.get(url)
+            self.assertIn('name="comment"', response.get_data(as_text=True))
+        finally:
+            app.config['PAGE_CACHE_TTL'] = 0
+
+    def test_vote_api(self):
+        """Tests whether voting and giving importance through the api
+           returns the post's new counts and the user's vote state."""
+        post_id = self.post.id
+        url = '/api/posts/{}/vote'.format(post_id)
+        response = self.client.post(url, data=json.dumps({'direction': 'upvote'}),
+                content_type='application/json')
+        self.assert401(response)
+
+        self.login()
+        response = self.client.post(url, data={'direction': 'upvote'})
+        self.assert400(response)
+        response = self.client.post(url, data=json.dumps({'direction': 'sideways'}),
+                content_type='application/json')
+        self.assert400(response)
+
+        response = self.client.post(url, data=json.dumps({'direction': 'downvote'}),
+                content_type='application/json')
+        self.assert200(response)
+        self.assertEqual(response.json, {'id': post_id, 'upvotes': 1,
+                'downvotes': 1, 'score': 0, 'importance': 10, 'upvoted': False,
+                'downvoted': True, 'given_importance': False})
+
+        response = self.client.post(url, data=json.dumps({'direction': 'upvote'}),
+                content_type='application/json')
+        self.assertEqual((response.json['score'], response.json['upvoted'],
+                response.json['downvoted']), (2, True, False))
+
+        response = self.client.post('/api/posts/{}/importance'.format(post_id),
+                data='{}', content_type='application/json')
+        self.assertEqual((response.json['importance'],
+                response.json['given_importance'], response.json['upvoted']),
+                (11, True, True))
+        # Asking again gives nothing more, and still says it was given.
+        response = self.client.post('/api/posts/{}/importance'.format(post_id),
+                data='{}', content_type='application/json')
+        self.assertEqual((response.json['importance'],
+                response.json['given_importance']), (11, True))
+        self.assertFalse(check_if_given_importance(Post.query.get(post_id),
+                AnonymousUserMixin()))
+
+        response = self.client.post('/api/posts/0/vote',
+                data=json.dumps({'direction': 'upvote'}),
+                content_type='application/json')
+        self.assert404(response)
+
+    def test_vote_buffer(self):
+        """Tests whether buffered votes show up for the voter at once and
+           are written in one go by a flush, net of changed minds."""
+        other = User(username="Jane", email="jane@example.com")
+        other.set_password("password")
+        db.session.add(other)
+        second = self.make_post("Second")
+        db.session.commit()
+        post_id, second_id, other_id = self.post.id, second.id, other.id
+        self.user.downvoted_on.append(second)
+        second.downvotes = 1
+        db.session.commit()
+
+        app.config['VOTE_DURABILITY'] = 'buffered'
+        try:
+            self.login()
+            self.client.post('/vote/{}'.format(post_id), data={'upvote': ''})
+            self.client.post('/vote/{}'.format(post_id), data={'downvote': ''})
+            response = self.client.post('/api/posts/{}/vote'.format(second_id),
+                    data=json.dumps({'direction': 'upvote'}),
+                    content_type='application/json')
+            self.assertEqual((response.json['upvotes'],
+                    response.json['downvotes'], response.json['upvoted']),
+                    (2, 0, True))
+
+            buffer = get_vote_buffer()
+            self.assertEqual(len(buffer), 2)
+            self.assertEqual(buffer.pending_deltas(post_id), (0, 1))
+            self.assertIn('<span class="post-score">0</span>',
+                    self.client.get('/item/{}'.format(post_id))
+                    .get_data(as_text=True))
+            db.session.remove()
+            self.assertEqual(Post.query.get(post_id).downvotes, 0)
+
+            with app.test_request_context():
+                self.assertEqual(buffer.flush(), 2)
+            self.assertEqual(len(buffer), 0)
+            self.assertEqual(buffer.pending_deltas(post_id), (0, 0))
+        finally:
+            app.config['VOTE_DURABILITY'] = 'strict'
+
+        db.session.remove()
+        post, second = Post.query.get(post_id), Post.query.get(second_id)
+        self.assertEqual((post.upvotes, post.downvotes, post.version), (1, 1, 1))
+        self.assertEqual((second.upvotes, second.downvotes), (2, 0))
+        user = User.query.get(self.user.id)
+        self.assertEqual(user.upvoted_on, [second])
+        self.assertEqual(user.downvoted_on, [post])
+
+        roll_up_scores()
+        self.assertEqual(User.query.get(self.user.id).scores, 1)
+
+    def test_vote_buffer_counts_racing_votes_once(self):
+        """Tests whether a vote queued by another request of the same user
+           between add()'s check and its update is only counted once."""
+        buffer = get_vote_buffer()
+        check = votebuffer.check_if_upvoted
+
+        def racing_check(post, user):
+            upvoted = check(post, user)
+            votebuffer.check_if_upvoted = check
+            self.assertEqual(buffer.add(user, post, 'upvote'), 1)
+            return upvoted
+
+        votebuffer.check_if_upvoted = racing_check
+        try:
+            self.assertEqual(buffer.add(self.user, self.post, 'upvote'), 0)
+        finally:
+            votebuffer.check_if_upvoted = check
+        self.assertEqual(buffer.pending_deltas(self.post.id), (1, 0))
+        with app.test_request_context():
+            self.assertEqual(buffer.flush(), 1)
+
+    def test_full_vote_buffer_flushes_on_its_own_session(self):
+        """Tests whether a vote arriving at a full buffer flushes it without
+           going past max_size or touching the request's session."""
+        second = self.make_post("Second")
+        db.session.commit()
+        post_id, second_id = self.post.id, second.id
+        buffer = get_vote_buffer()
+        max_size, buffer.max_size = buffer.max_size, 1
+        try:
+            user = User.query.get(self.user.id)
+            buffer.add(user, self.post, 'downvote')
+            self.assertEqual(buffer.add(user, second, 'downvote'), 1)
+            self.assertEqual(len(buffer), 1)
+            # Committing the request's session would have expired them.
+            self.assertEqual(inspect(user).expired_attributes, set())
+            self.assertEqual(inspect(second).expired_attributes, set())
+        finally:
+            buffer.max_size = max_size
+            with app.test_request_context():
+                buffer.flush()
+
+        db.session.remove()
+        self.assertEqual(Post.query.get(post_id).downvotes, 1)
+        self.assertEqual(Post.query.get(second_id).downvotes, 1)
+
+    def test_vote_buffer_counts_flushed_votes_once(self):
+        """Tests whether a flushed vote is counted once by readers, whether
+           their copy of the post is from before or after the flush."""
+        post_id, version = self.post.id, self.post.version or 0
+        buffer = get_vote_buffer()
+        buffer.add(User.query.get(self.user.id), self.post, 'downvote')
+        recompute = votebuffer.recompute_hotness
+        seen = []
+
+        def committing_recompute(*args, **kwargs):
+            # The new version is known, but not yet committed.
+            seen.append((buffer.pending_deltas(post_id, version),
+                         buffer.pending_deltas(post_id, version + 1)))
+            return recompute(*args, **kwargs)
+
+        votebuffer.recompute_hotness = committing_recompute
+        try:
+            with app.test_request_context():
+                self.assertEqual(buffer.flush(), 1)
+        finally:
+            votebuffer.recompute_hotness = recompute
+
+        self.assertEqual(seen, [((0, 1), (0, 0))])
+        db.session.remove()
+        post = Post.query.get(post_id)
+        self.assertEqual((post.downvotes, post.version), (1, version + 1))
+        self.assertEqual(buffer.pending_deltas(post_id, version), (0, 1))
+        self.assertEqual(buffer.pending_deltas(post_id, post.version), (0, 0))
+
+    def test_vote_buffer_flushed_on_sigterm(self):
+        """Tests whether SIGTERM writes the queued votes before exiting."""
+        post_id = self.post.id
+        buffer = get_vote_buffer()
+        buffer.add(User.query.get(self.user.id), self.post, 'downvote')
+
+        previous = signal.getsignal(signal.SIGTERM)
+        try:
+            flush_on_sigterm(app)
+            with self.assertRaises(SystemExit):
+                signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(Post.query.get(post_id).downvotes, 1)
+
+    def test_comments(self):
+        """Tests whether comments keep the post's count up to date and are
+           shown oldest first, a page at a time."""
+        post_id = self.post.id
+        self.login()
+        for i in range(5):
+            self.client.post('/item/{}'.format(post_id),
+                    data={'comment': 'Comment {}'.format(i)})
+
+        db.session.remove()
+        self.assertEqual(Post.query.get(post_id).comment_count, 5)
+        self.assertIn('5 Comments', self.client.get('/index').get_data(as_text=True))
+
+        app.config['COMMENTS_PER_PAGE'] = 3
+        try:
+            response = self.client.get('/item/{}'.format(post_id))
+            first = re.findall(r'Comment \d', response.get_data(as_text=True))
+            second = re.findall(r'Comment \d', self.client.get(
+                    self.next_link(response)).get_data(as_text=True))
+        finally:
+            app.config['COMMENTS_PER_PAGE'] = 50
+        self.assertEqual(first + second, ['Comment {}'.format(i)
+                                          for i in range(5)])
+
+        comment = Comment.query.filter_by(text='Comment 0').first()
+        self.client.post('/delete_comment/{}/{}'.format(post_id, comment.id))
+        db.session.remove()
+        self.assertEqual(Post.query.get(post_id).comment_count, 4)
+
+    def test_search(self):
+        """Tests whether search matches prefixes in titles, topics and
+           events, best match first and a page at a time."""
+        for i in range(12):
+            self.make_post("Election result {}".format(i), topic="politics")
+        self.make_post("Weather report", event_name="Elections 2018")
+        self.make_post("Cooking", topic="food")
+        db.session.commit()
+
+        response = self.client.get('/search_result/elect')
+        first = self.page_titles(response)
+        self.assertEqual(len(first), 10)
+        self.assertTrue(first[0].startswith("Election result"))
+
+        second = self.page_titles(self.client.get(self.next_link(response)))
+        self.assertEqual(len(second), 3)
+        self.assertIn("Weather report", second)
+        self.assertEqual(len(set(first + second)), 13)
+
+        self.assertEqual(self.page_titles(
+                self.client.get('/search_result/politics%20result%2011')),
+                ["Election result 11"])
@@ -6,7 +6,9 @@ from flask_testing import TestCase
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app, db
-from app.models import Post, Topic, User
+from app.models import Post, Topic, User, ScoreEvent
+from app.karma import record_score_event, roll_up_scores, rebuild_scores, \
+        seed_ledger, VOTE_RECEIVED, IMPORTANCE_SPENT
 
 
 class UserTestCase(TestCase):
@@ -97,3 +99,43 @@ class UserTestCase(TestCase):
         db.session.commit()
 
         self.assertEqual(self.user.sum_post_scores(), 1)
+
+    def test_score_ledger(self):
+        """Tests whether score events are rolled up into the user's score
+           once, and whether the score can be rebuilt from the ledger."""
+        self.user = User(username="John", email="example@example.com", id=1)
+        self.user.importance_debt = 0
+        db.session.add(self.user)
+        db.session.commit()
+
+        record_score_event(self.user.id, 3, VOTE_RECEIVED)
+        record_score_event(self.user.id, -5, IMPORTANCE_SPENT)
+        db.session.commit()
+        self.assertIsNone(self.user.scores)
+
+        self.assertEqual(roll_up_scores(), 1)
+        self.assertEqual(self.user.scores, -2)
+        self.assertEqual(roll_up_scores(), 0)
+        self.assertEqual(self.user.scores, -2)
+
+        # Drifted scores get repaired from the ledger.
+        self.user.scores = 100
+        db.session.commit()
+        rebuild_scores()
+        self.assertEqual(self.user.scores, -2)
+
+    def test_seed_ledger(self):
+        """Tests whether the ledger can be seeded from existing posts."""
+        self.user = User(username="John", email="example@example.com", id=1)
+        self.user.importance_debt = 5
+        db.session.add(self.user)
+        db.session.commit()
+        self.post = Post(title="Title", text="Text", user_id=self.user.id)
+        self.post.score = 7
+        db.session.add(self.post)
+        db.session.commit()
+
+        self.assertEqual(seed_ledger(), 1)
+        rebuild_scores()
+        self.assertEqual(self.user.scores, self.user.sum_post_scores())
+        self.assertEqual(ScoreEvent.query.count(), 1)